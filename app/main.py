@@ -1,12 +1,72 @@
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+import asyncio
+import importlib
+import json
+from contextlib import asynccontextmanager
+from types import ModuleType
+from typing import AsyncIterator, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from provider.config import BATCH_CONCURRENCY, BATCH_MAX_QUESTIONS, INDEX_POLL_INTERVAL, OLLAMA_HEALTH_INTERVAL
 from provider.index import ChatMessage
-from provider.ollama import query_rag
+from provider.limiter import QueueFullError, Reservation
+
+
+async def rag() -> ModuleType:
+    """
+    Модуль provider.ollama: модели, БД и кэши. Вместе с ним импортируются LangChain и Chroma, а это несколько секунд,
+    поэтому он импортируется не при запуске, а в отдельном потоке при прогреве или первом запросе к ИИ.
+    Статические страницы отдаются сразу. Если импорт не удался, следующее обращение повторяет его
+    """
+    task = app.state.rag_import
+    if task is None or (task.done() and not task.cancelled() and task.exception() is not None):
+        task = app.state.rag_import = asyncio.ensure_future(asyncio.to_thread(importlib.import_module,
+                                                                              "provider.ollama"))
+    # Отмена одного запроса не должна прерывать общий импорт
+    return await asyncio.shield(task)
+
+
+async def warm_up_until_ready(app: FastAPI) -> None:
+    """Загружает модуль RAG и прогревает модели и БД, повторяя попытки, пока Ollama не станет доступна"""
+    delay = 1
+    while True:
+        try:
+            ollama = await rag()
+            if not app.state.watch_tasks:
+                # Переключение на новое поколение индекса, опубликованное ingest.py, без перезапуска сервера,
+                # и проверка доступности серверов Ollama
+                app.state.watch_tasks = [asyncio.create_task(ollama.index_manager.watch(INDEX_POLL_INTERVAL)),
+                                         asyncio.create_task(ollama.llm_pool.watch(OLLAMA_HEALTH_INTERVAL))]
+            await ollama.warm_up()
+            app.state.ready = True
+            print("Прогрев завершён, сервер готов принимать запросы")
+            return
+        except Exception as e:
+            print(f"Прогрев не удался ({e}), повтор через {delay} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Статические страницы доступны сразу, а готовность к запросам к ИИ показывает /health/ready
+    app.state.ready = False
+    app.state.rag_import = None
+    app.state.watch_tasks = []
+    warm_up_task = asyncio.create_task(warm_up_until_ready(app))
+    yield
+    warm_up_task.cancel()
+    for task in app.state.watch_tasks:
+        task.cancel()
+    # Сохраняем кэш ответов при остановке сервера, если модуль RAG успел загрузиться
+    task = app.state.rag_import
+    if task is not None and task.done() and not task.cancelled() and task.exception() is None:
+        task.result().answer_cache.save()
+
 
 # Инициализация приложения Fastapi
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,6 +76,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+# Очередь запросов к ИИ переполнена - просим клиента повторить позже
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    (await rag()).rag_rejected_total.inc()
+    return JSONResponse(status_code=429,
+                        content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
 # Монтируем папку front
 app.mount("/front", StaticFiles(directory="front"), name="front")
 
@@ -28,7 +97,111 @@ async def read_root():
 async def read_register():
     return FileResponse("./front/html/register.html")
 
-#
+# Готовность сервера: 200 только после прогрева моделей и БД. Также показывает текущее поколение индекса
+# и состояние серверов Ollama
+@app.get("/health/ready")
+async def health_ready():
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    ollama = await rag()
+    return {"status": "ready", "index": ollama.index_manager.stats(), "ollama": ollama.llm_pool.stats()}
+
+# Счётчики кэша ответов, кэша эмбеддингов вопросов и объединения одинаковых вопросов
+@app.get("/cache/stats")
+async def cache_stats():
+    ollama = await rag()
+    return {"answers": ollama.answer_cache.stats(), "query_embeddings": ollama.query_embedding_cache.stats(),
+            "coalescing": ollama.in_flight.stats()}
+
+# Метрики в текстовом формате Prometheus: время этапов, токены, очередь запросов
+@app.get("/metrics")
+async def read_metrics():
+    return PlainTextResponse((await rag()).metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Доля запросов, для которых замеряется время этапов. 0 - замеры выключены
+@app.get("/metrics/sampling")
+async def read_sampling():
+    return {"rate": (await rag()).metrics_sampler.rate}
+
+@app.put("/metrics/sampling")
+async def update_sampling(rate: float):
+    metrics_sampler = (await rag()).metrics_sampler
+    try:
+        metrics_sampler.set_rate(rate)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"rate": metrics_sampler.rate}
+
+
+def format_sse(event: str, data) -> str:
+    """Форматирует событие в формате Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ReservedStreamingResponse(StreamingResponse):
+    def __init__(self, reservation: Optional[Reservation], *args, **kwargs):
+        """
+        Потоковый ответ на запрос, для которого заранее занято место в очереди к ИИ.
+        Если поток так и не дошёл до генерации (например, клиент отключился до начала ответа), место освобождается
+        """
+        super().__init__(*args, **kwargs)
+        self.reservation = reservation
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.reservation is not None:
+                self.reservation.release()
+
+
+async def sse_events(ollama: ModuleType, events: AsyncIterator[tuple]) -> AsyncIterator[str]:
+    """
+    Преобразует события потокового RAG-запроса в формат Server-Sent Events.
+    Ошибка после начала потока отдаётся последним событием error: kind "overloaded" - очередь переполнена
+    (с retry_after), "internal" - любая другая ошибка (Ollama, БД)
+    """
+    try:
+        async for event, data in events:
+            yield format_sse(event, data)
+    except QueueFullError as e:
+        ollama.rag_rejected_total.inc()
+        yield format_sse("error", {"kind": "overloaded", "detail": str(e), "retry_after": e.retry_after})
+    except Exception as e:
+        print(f"Ошибка при потоковом ответе: {type(e).__name__}: {e}")
+        yield format_sse("error", {"kind": "internal", "detail": "Ошибка сервера при генерации ответа"})
+
+
+async def batch_lines(results: AsyncIterator[dict]) -> AsyncIterator[str]:
+    """Результаты пакета в формате JSONL"""
+    async for result in results:
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+
+
+# Пакет вопросов в теле запроса в формате JSONL. Ответы отдаются строками JSONL по мере готовности.
+# Объявлен до /chat/{chat_id}, иначе "batch" будет принят за идентификатор чата
+@app.post("/chat/batch")
+async def ask_batch(request: Request, concurrency: int = BATCH_CONCURRENCY):
+    await rag()
+    # provider.batch использует provider.ollama, поэтому импортируется после него
+    from provider.batch import parse_questions, run_batch
+    try:
+        items = parse_questions((await request.body()).decode().splitlines())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(items) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"В пакете больше {BATCH_MAX_QUESTIONS} вопросов")
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+    return StreamingResponse(batch_lines(run_batch(items, concurrency)), media_type="application/x-ndjson")
+
+
+# Запрос к ИИ. При stream=true ответ отдаётся по токенам в формате Server-Sent Events
 @app.post("/chat/{chat_id}")
-async def ask(chat_id: str, message: ChatMessage):
-    return {"response": query_rag(message, chat_id)}
\ No newline at end of file
+async def ask(chat_id: str, message: ChatMessage, stream: bool = False):
+    ollama = await rag()
+    if stream:
+        # Место в очереди занимается до начала потока, чтобы отказ вернуть обычным ответом 429
+        events, reservation = await ollama.stream_rag(message, chat_id)
+        return ReservedStreamingResponse(reservation, sse_events(ollama, events), media_type="text/event-stream",
+                                         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return {"response": await ollama.query_rag(message, chat_id)}
\ No newline at end of file
@@ -0,0 +1,76 @@
+# Пакетные ответы на вопросы без запуска сервера, например на вопросы для самоконтроля к лекциям
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Set
+
+from provider.batch import parse_questions, run_batch
+from provider.config import BATCH_CONCURRENCY
+from provider.ollama import answer_cache
+
+
+def load_done_ids(path: str) -> Set[str]:
+    """
+    Идентификаторы вопросов, ответы на которые уже записаны в файл результатов.
+    Вопросы, завершившиеся ошибкой, и недописанная последняя строка не учитываются
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in result:
+                done.add(str(result["id"]))
+    return done
+
+
+async def answer_file(input_path: str, output_path: str, concurrency: int) -> None:
+    """
+    Отвечает на вопросы из файла JSONL и дописывает результаты в файл JSONL по мере готовности.
+    При повторном запуске вопросы, на которые уже есть ответ, пропускаются
+    :param input_path: Файл с вопросами
+    :param output_path: Файл результатов
+    :param concurrency: Сколько вопросов обрабатывается одновременно
+    """
+    with open(input_path, encoding="utf-8") as f:
+        items = parse_questions(f)
+    done = load_done_ids(output_path)
+    items = [item for item in items if item.id not in done]
+    print(f"Вопросов: {len(items) + len(done)}, уже есть ответов: {len(done)}, осталось: {len(items)}")
+
+    start = time.perf_counter()
+    completed, errors = 0, 0
+    # Если прошлый запуск прервался посреди записи, последняя строка не заканчивается переводом строки
+    needs_newline = os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    if needs_newline:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    with open(output_path, "a", encoding="utf-8") as output:
+        if needs_newline:
+            output.write("\n")
+        async for result in run_batch(items, concurrency):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            completed += 1
+            errors += "error" in result
+            print(f"{completed}/{len(items)}: {result['id']} "
+                  f"{'ошибка: ' + result['error'] if 'error' in result else result['cache']}")
+    answer_cache.save()
+    print(f"Готово за {time.perf_counter() - start:.1f} с, ошибок: {errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пакетные ответы на вопросы из файла JSONL")
+    parser.add_argument("input", help="Файл JSONL: в каждой строке {\"question\": ...} и необязательные id и параметры поиска")
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="Файл результатов JSONL (дописывается)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="Сколько вопросов обрабатывается одновременно")
+    args = parser.parse_args()
+    asyncio.run(answer_file(args.input, args.output, args.concurrency))
@@ -0,0 +1,267 @@
+"""
+Нагрузочный бенчмарк /chat/{chat_id}.
+Воспроизводит вопросы студентов из bench/questions.jsonl с заданным числом одновременных клиентов и выводит
+задержку (p50/p95/p99), время до первого токена, пропускную способность и память процесса сервера.
+
+Против уже запущенного сервера:
+    python bench/bench_chat.py --url http://127.0.0.1:8000 --concurrency 4 --server-pid 12345
+
+Полностью локально, с заглушкой Ollama (сервер и заглушка запускаются и останавливаются автоматически,
+БД создаётся во временном каталоге через ingest.py с эмбеддингами заглушки):
+    python bench/bench_chat.py --spawn --concurrency 4 --requests 80 --stream
+
+С пулом из трёх заглушек Ollama (OLLAMA_BASE_URLS), одна из которых отвечает ошибкой на каждый пятый запрос:
+    python bench/bench_chat.py --spawn --backends 3 --failing-backend-args "--error-rate 0.2" \
+        --env RAG_MAX_CONCURRENCY=6 --env OLLAMA_BACKEND_CONCURRENCY=2
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+import httpx
+
+from common import (build_database, free_port, has_database, percentiles, rss_mb, start_fake_ollama, start_server,
+                    stop_process)
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.jsonl")
+
+
+def load_questions(path: str) -> List[str]:
+    """Вопросы из файла JSONL (по одному объекту {"question": ...} на строку)"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["question"] for line in f if line.strip()]
+
+
+class RequestResult:
+    def __init__(self, status: str, latency: float, ttft: Optional[float] = None):
+        """
+        :param status: "ok", "rejected" (429) или "error"
+        :param latency: Полное время ответа, секунды
+        :param ttft: Время до первого токена, секунды (только для потокового ответа)
+        """
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+
+
+async def ask(client: httpx.AsyncClient, question: str, chat_id: str, stream: bool) -> RequestResult:
+    """Один запрос к /chat/{chat_id}"""
+    start = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.post(f"/chat/{chat_id}", json={"question": question})
+            status = "ok" if response.status_code == 200 else "rejected" if response.status_code == 429 else "error"
+            return RequestResult(status, time.perf_counter() - start)
+
+        ttft = None
+        status = "ok"
+        async with client.stream("POST", f"/chat/{chat_id}", params={"stream": "true"},
+                                 json={"question": question}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return RequestResult("rejected" if response.status_code == 429 else "error",
+                                     time.perf_counter() - start)
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "token" and ttft is None:
+                        ttft = time.perf_counter() - start
+                elif line.startswith("data: ") and event == "error":
+                    status = "rejected" if json.loads(line[len("data: "):]).get("kind") == "overloaded" else "error"
+        return RequestResult(status, time.perf_counter() - start, ttft)
+    except httpx.HTTPError:
+        return RequestResult("error", time.perf_counter() - start)
+
+
+class RssSampler:
+    def __init__(self, pid: Optional[int], interval: float = 0.2):
+        """
+        Периодически измеряет память процесса сервера в отдельном потоке
+        :param pid: Идентификатор процесса. None - не измерять
+        """
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[float] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            value = rss_mb(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.pid is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+async def run_benchmark(url: str, questions: List[str], total: int, concurrency: int, stream: bool,
+                        server_pid: Optional[int], timeout: float) -> dict:
+    """
+    Отправляет total запросов с concurrency одновременными клиентами
+    :return: Сводка результатов
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(questions[i % len(questions)])
+    results: List[RequestResult] = []
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        while True:
+            try:
+                question = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # Каждый вопрос - первый в новом чате, как у студента, открывшего страницу
+            results.append(await ask(client, question, uuid.uuid4().hex, stream))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        rss_before = rss_mb(server_pid) if server_pid else None
+        with RssSampler(server_pid) as sampler:
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+
+    ok = [result for result in results if result.status == "ok"]
+    summary = {
+        "requests": total,
+        "concurrency": concurrency,
+        "stream": stream,
+        "ok": len(ok),
+        "rejected": sum(result.status == "rejected" for result in results),
+        "errors": sum(result.status == "error" for result in results),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "latency_s": percentiles([result.latency for result in ok]),
+        "ttft_s": percentiles([result.ttft for result in ok if result.ttft is not None]),
+        "rss_mb": {
+            "before": rss_before,
+            "peak": max(sampler.samples) if sampler.samples else None,
+            "after": rss_mb(server_pid) if server_pid else None,
+        },
+    }
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    def fmt(value, unit=""):
+        return "-" if value is None else f"{value:.3f}{unit}"
+
+    print(f"Запросов: {summary['requests']}, одновременно: {summary['concurrency']}, "
+          f"потоковый ответ: {'да' if summary['stream'] else 'нет'}")
+    print(f"Успешно: {summary['ok']}, отклонено (429): {summary['rejected']}, ошибок: {summary['errors']}")
+    print(f"Время: {summary['elapsed_s']:.2f} с, пропускная способность: {summary['throughput_rps']:.2f} запросов/с")
+    for name, title in (("latency_s", "Задержка"), ("ttft_s", "До первого токена")):
+        values = summary[name]
+        print(f"{title}: p50 {fmt(values['p50'], ' с')}, p95 {fmt(values['p95'], ' с')}, p99 {fmt(values['p99'], ' с')}")
+    rss = summary["rss_mb"]
+    print(f"Память сервера: до {fmt(rss['before'], ' МБ')}, пик {fmt(rss['peak'], ' МБ')}, "
+          f"после {fmt(rss['after'], ' МБ')}")
+    if summary.get("ollama"):
+        print(f"Серверы Ollama (повторов на другом сервере: {summary['ollama']['failovers']}):")
+        for backend in summary["ollama"]["backends"]:
+            print(f"  {backend['url']:<28} запросов {backend['requests']:>6}, ошибок {backend['failures']:>4}, "
+                  f"{'доступен' if backend['healthy'] else 'недоступен'}")
+
+
+def ollama_stats(url: str) -> Optional[dict]:
+    """Загрузка серверов Ollama из /health/ready или None, если сервер её не сообщает"""
+    try:
+        return httpx.get(f"{url}/health/ready", timeout=10).json().get("ollama")
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк /chat/{chat_id}")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Адрес запущенного сервера")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="Файл JSONL с вопросами")
+    parser.add_argument("--requests", type=int, default=0, help="Число запросов. По умолчанию - все вопросы один раз")
+    parser.add_argument("--concurrency", type=int, default=4, help="Число одновременных клиентов")
+    parser.add_argument("--stream", action="store_true", help="Потоковый ответ (SSE), измеряется время до первого токена")
+    parser.add_argument("--timeout", type=float, default=300, help="Таймаут одного запроса, с")
+    parser.add_argument("--server-pid", type=int, help="PID процесса сервера для измерения памяти")
+    parser.add_argument("--output", help="Сохранить сводку в файл JSON")
+    parser.add_argument("--spawn", action="store_true", help="Запустить заглушку Ollama и сервер автоматически")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Переменная окружения для запускаемого сервера (с --spawn), можно повторять")
+    parser.add_argument("--fake-args", default="", help="Аргументы bench/fake_ollama.py (с --spawn), одной строкой")
+    parser.add_argument("--backends", type=int, default=1, help="Сколько заглушек Ollama запустить (с --spawn)")
+    parser.add_argument("--db", help="Каталог готовой БД для сервера (с --spawn). По умолчанию БД создаётся "
+                                     "во временном каталоге через ingest.py с эмбеддингами заглушки")
+    parser.add_argument("--failing-backend-args", default="",
+                        help="Дополнительные аргументы первой заглушки Ollama (с --spawn), например \"--error-rate 0.2\"")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    total = args.requests or len(questions)
+
+    fakes, server, work_dir = [], None, None
+    url, server_pid = args.url, args.server_pid
+    try:
+        if args.spawn:
+            fake_urls = []
+            for number in range(args.backends):
+                fake_port = free_port()
+                fake_args = args.fake_args.split() + (args.failing_backend_args.split() if number == 0 else [])
+                fakes.append(start_fake_ollama(fake_port, fake_args))
+                fake_urls.append(f"http://127.0.0.1:{fake_port}")
+            server_port = free_port()
+            env = {"OLLAMA_BASE_URLS": ",".join(fake_urls)}
+            env.update(item.split("=", 1) for item in args.env)
+            db_path = args.db or env.get("CHROMA_PATH")
+            if db_path is None:
+                # Поиск по пустой БД занимал бы почти нулевое время, и задержки получились бы заниженными
+                work_dir = tempfile.mkdtemp(prefix="bench_chat_")
+                db_path = os.path.join(work_dir, "db")
+                ingest_log = os.path.join(tempfile.gettempdir(), "bench_chat_ingest.log")
+                print(f"Создание БД в {db_path} через ingest.py, вывод в {ingest_log}")
+                # Отдельный кэш эмбеддингов: эмбеддинги заглушки не должны попасть в кэш настоящей модели
+                build_database(db_path, {**env, "EMBEDDING_CACHE_PATH": os.path.join(work_dir, "embedding_cache")},
+                               ingest_log)
+            elif not has_database(db_path):
+                sys.exit(f"В {db_path} нет БД: создайте её через ingest.py или не указывайте --db")
+            env["CHROMA_PATH"] = db_path
+            log_path = os.path.join(tempfile.gettempdir(), "bench_chat_server.log")
+            print(f"Запуск сервера, вывод в {log_path}")
+            server = start_server(server_port, env, log_path)
+            url, server_pid = f"http://127.0.0.1:{server_port}", server.pid
+
+        summary = asyncio.run(run_benchmark(url, questions, total, args.concurrency, args.stream, server_pid,
+                                            args.timeout))
+        summary["ollama"] = ollama_stats(url)
+    finally:
+        stop_process(server)
+        for fake in fakes:
+            stop_process(fake)
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if summary["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
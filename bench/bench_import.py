@@ -0,0 +1,133 @@
+"""
+Время импорта app.main (python -X importtime) и время до первого ответа сервера на статическую страницу.
+При импорте app.main не должны загружаться LangChain, Chroma и клиент Ollama: они импортируются при прогреве
+в lifespan. Результат сравнивается с сохранённым в bench/import_baseline.json, чтобы замечать регрессии.
+
+    python bench/bench_import.py
+    python bench/bench_import.py --check            # код возврата 1 при регрессии
+    python bench/bench_import.py --save-baseline    # после намеренного изменения
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from common import BENCH_DIR, REPO_DIR, free_port, stop_process, wait_for_http
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "import_baseline.json")
+# Пакеты, которые не должны импортироваться при запуске сервера
+DEFERRED_PACKAGES = ["chromadb", "langchain_chroma", "langchain_classic", "langchain_core", "langchain_ollama",
+                     "ollama", "numpy"]
+
+
+def import_times(module: str) -> List[Dict]:
+    """
+    Импортирует модуль в отдельном процессе с -X importtime
+    :return: Записи {"name", "self_us", "cumulative_us", "depth"} в порядке вывода
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_DIR,
+                            check=True, capture_output=True, text=True).stderr
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        records.append({"name": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                        "depth": (len(name) - len(name.lstrip()) - 1) // 2})
+    return records
+
+
+def measure_import(module: str, repeat: int, top: int) -> dict:
+    """Лучшее из repeat время импорта модуля, самые тяжёлые прямые импорты и загруженные отложенные пакеты"""
+    best = None
+    for _ in range(repeat):
+        records = import_times(module)
+        total = next(record["cumulative_us"] for record in records if record["name"] == module)
+        if best is None or total < best[0]:
+            best = total, records
+    total, records = best
+    direct = sorted((record for record in records if record["depth"] == 1),
+                    key=lambda record: record["cumulative_us"], reverse=True)[:top]
+    loaded = {record["name"].split(".")[0] for record in records}
+    return {"total_ms": total / 1000, "modules": len(records),
+            "top": [{"name": record["name"], "ms": record["cumulative_us"] / 1000} for record in direct],
+            "deferred_loaded": [package for package in DEFERRED_PACKAGES if package in loaded]}
+
+
+def measure_startup(timeout: float = 60) -> Optional[float]:
+    """
+    Секунды от запуска uvicorn до первого ответа 200 на /register. Ollama для этого не нужна.
+    Прогрев в фоне открывает пустую БД во временном каталоге, чтобы не трогать рабочую
+    """
+    port = free_port()
+    work_dir = tempfile.mkdtemp(prefix="bench_import_")
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                                "--port", str(port), "--log-level", "warning"],
+                               cwd=REPO_DIR, env={**os.environ, "CHROMA_PATH": work_dir},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_http(f"http://127.0.0.1:{port}/register", timeout=timeout, process=process)
+        return time.perf_counter() - start
+    finally:
+        stop_process(process)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта app.main и запуска сервера")
+    parser.add_argument("--module", default="app.main", help="Модуль для замера")
+    parser.add_argument("--repeat", type=int, default=5, help="Сколько раз повторять импорт (лучшее время)")
+    parser.add_argument("--top", type=int, default=10, help="Сколько самых тяжёлых прямых импортов показать")
+    parser.add_argument("--no-startup", action="store_true", help="Не замерять время до первого ответа сервера")
+    parser.add_argument("--check", action="store_true", help="Сравнить с базовым замером и вернуть 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Во сколько раз время импорта может превышать базовое при --check")
+    parser.add_argument("--save-baseline", action="store_true", help="Сохранить замер как базовый")
+    parser.add_argument("--output", help="Сохранить результаты в файл JSON")
+    args = parser.parse_args()
+
+    result = measure_import(args.module, args.repeat, args.top)
+    result["module"] = args.module
+    result["python"] = platform.python_version()
+    if not args.no_startup:
+        result["startup_seconds"] = measure_startup()
+
+    print(f"Импорт {args.module}: {result['total_ms']:.0f} мс, модулей: {result['modules']}")
+    for record in result["top"]:
+        print(f"  {record['name']:<32}{record['ms']:>9.1f} мс")
+    if "startup_seconds" in result:
+        print(f"Первый ответ сервера на /register: {result['startup_seconds']:.2f} с после запуска")
+    if result["deferred_loaded"]:
+        print(f"При импорте загружены отложенные пакеты: {', '.join(result['deferred_loaded'])}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"Базовый замер сохранён в {BASELINE_PATH}")
+    if args.check:
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = []
+        if result["total_ms"] > baseline["total_ms"] * args.tolerance:
+            problems.append(f"импорт занял {result['total_ms']:.0f} мс, базовый - {baseline['total_ms']:.0f} мс")
+        if result["deferred_loaded"]:
+            problems.append(f"загружены отложенные пакеты: {', '.join(result['deferred_loaded'])}")
+        if problems:
+            print("Регрессия: " + "; ".join(problems))
+            sys.exit(1)
+        print(f"Регрессий нет (базовый импорт {baseline['total_ms']:.0f} мс)")
+
+
+if __name__ == "__main__":
+    main()
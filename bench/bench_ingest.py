@@ -0,0 +1,114 @@
+"""
+Микро-бенчмарки этапов ingest.py: загрузка PDF, разбиение на фрагменты, удаление дубликатов, эмбеддинги и запись в Chroma.
+Эмбеддинги вычисляет заглушка Ollama, БД и кэш эмбеддингов создаются во временном каталоге, поэтому рабочая БД не меняется.
+
+    python bench/bench_ingest.py
+    python bench/bench_ingest.py --max-pages 100 --repeat 3 --output ingest.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from common import REPO_DIR, free_port, rss_mb, start_fake_ollama, stop_process
+
+
+def measure(name: str, function, items: Optional[int], unit: str, results: dict, repeat: int = 1):
+    """
+    Выполняет этап repeat раз и сохраняет лучшее время
+    :param name: Название этапа
+    :param function: Функция без аргументов
+    :param items: Сколько объектов обрабатывает этап (для скорости в объектах/с). None - длина результата
+    :param unit: Название объектов
+    :param results: Словарь, в который записывается результат
+    :return: Результат последнего вызова функции
+    """
+    timings = []
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    if items is None:
+        items = len(value)
+    results[name] = {"seconds": best, "items": items, "unit": unit, "rate": items / best if best else None}
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микро-бенчмарки этапов ingest.py")
+    parser.add_argument("--data-path", default=os.path.join(REPO_DIR, "docs"), help="Каталог с PDF файлами")
+    parser.add_argument("--max-pages", type=int, default=0, help="Ограничить число страниц. 0 - все страницы")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз повторять быстрые этапы (лучшее время)")
+    parser.add_argument("--fake-args", default="", help="Аргументы bench/fake_ollama.py одной строкой")
+    parser.add_argument("--output", help="Сохранить результаты в файл JSON")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_ingest_")
+    fake_port = free_port()
+    # Настройки читаются при импорте provider.config, поэтому задаются до импорта ingest
+    os.environ["OLLAMA_BASE_URL"] = f"http://127.0.0.1:{fake_port}"
+    os.environ["CHROMA_PATH"] = os.path.join(work_dir, "db")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(work_dir, "embedding_cache")
+    sys.path.insert(0, REPO_DIR)
+    import ingest
+    from provider.embedding_cache import EmbeddingCache
+
+    fake = start_fake_ollama(fake_port, args.fake_args.split())
+    results = {}
+    try:
+        pdf_files = list(ingest.walk_through_pdf_files(args.data_path))
+
+        def load():
+            pages = []
+            for page in ingest.iter_pages(pdf_files):
+                pages.append(page)
+                if args.max_pages and len(pages) >= args.max_pages:
+                    break
+            return pages
+
+        pages = measure("load", load, None, "страниц", results)
+
+        chunks = measure("split", lambda: ingest.split_documents(pages), len(pages), "страниц", results, args.repeat)
+
+        def dedup():
+            ingest.global_unique_hashes.clear()
+            return ingest.deduplicate_chunks(chunks)
+
+        unique_chunks = measure("dedup", dedup, len(chunks), "фрагментов", results, args.repeat)
+
+        cache = EmbeddingCache(os.environ["EMBEDDING_CACHE_PATH"], ingest.EMBEDDING_MODEL)
+        embeddings = measure("embed", lambda: ingest.embed_chunks(unique_chunks, cache=cache),
+                             len(unique_chunks), "фрагментов", results)
+        measure("embed_cached", lambda: ingest.embed_chunks(unique_chunks, cache=cache),
+                len(unique_chunks), "фрагментов", results, args.repeat)
+        cache.close()
+
+        db = ingest.open_chroma()
+        measure("write", lambda: ingest.write_chunks(db, unique_chunks, embeddings),
+                len(unique_chunks), "фрагментов", results)
+        results["rss_mb"] = rss_mb(os.getpid())
+    finally:
+        stop_process(fake)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print(f"{'Этап':<14}{'Время, с':>10}{'Объектов':>10}  Скорость")
+    for name, result in results.items():
+        if name == "rss_mb":
+            continue
+        print(f"{name:<14}{result['seconds']:>10.3f}{result['items']:>10}  {result['rate']:.1f} {result['unit']}/с")
+    if results["rss_mb"] is not None:
+        print(f"Память процесса: {results['rss_mb']:.0f} МБ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
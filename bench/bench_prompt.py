@@ -0,0 +1,153 @@
+"""
+Обработка промпта в Ollama при разных порядках частей промпта.
+Воспроизводит чаты из нескольких вопросов из bench/questions.jsonl и отправляет промпты напрямую в Ollama
+(/api/generate), как это делает сервер, а затем сравнивает prompt_eval_count и prompt_eval_duration из ответов:
+- legacy - найденные фрагменты в конце системного промпта, переписка после них (порядок до provider/prompt.py);
+- current - неизменный системный промпт, затем переписка, затем фрагменты и вопрос (provider/prompt.py).
+Ollama повторно использует обработанное общее начало с предыдущим промптом (KV-кэш), поэтому чем дальше
+в промпте начинаются меняющиеся части, тем меньше токенов обрабатывается заново.
+Фрагменты берутся из индекса фрагментов БД (CHROMA_PATH), а если его нет - подставляется текст-заглушка.
+
+С заглушкой Ollama (запускается автоматически):
+    python bench/bench_prompt.py --chats 8 --turns 4
+
+С настоящей Ollama:
+    python bench/bench_prompt.py --ollama-url http://127.0.0.1:11434 --model qwen3:4b --num-ctx 8192
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+from common import REPO_DIR, free_port, start_fake_ollama, stop_process
+
+sys.path.insert(0, REPO_DIR)
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from ollama import Client
+
+from provider.chunk_index import ChunkIndex
+from provider.config import CHROMA_PATH
+from provider.generations import current_path
+from provider.prompt import SYSTEM_PROMPT, citation, document_prompt, prompt_template
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.jsonl")
+# Порядок частей промпта до выделения неизменного системного промпта
+LEGACY_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT + "                [INST]Отвечай на вопрос, основываясь только на следующем контексте:\n"
+                               "                {context}[/INST]\n            "),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{question}"),
+])
+LAYOUTS = {"legacy": LEGACY_TEMPLATE, "current": prompt_template}
+
+
+def load_questions(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["question"] for line in f if line.strip()]
+
+
+def context_for(question: str, chunks, k: int) -> str:
+    """Фрагменты для вопроса, оформленные как в create_stuff_documents_chain. Выбор детерминирован по вопросу"""
+    seed = int.from_bytes(hashlib.sha256(question.encode()).digest()[:8], "little")
+    if chunks is None or not len(chunks):
+        return "\n\n".join(f"[konspekt.pdf, стр. {seed % 300 + i}]\n" + f"Текст фрагмента конспекта {i}. " * 40
+                           for i in range(k))
+    numbers = np.random.default_rng(seed).choice(len(chunks), size=min(k, len(chunks)), replace=False)
+    parts = []
+    for number in numbers:
+        chunk = chunks.chunk(int(number))
+        parts.append(document_prompt.format(page_content=chunk.text, citation=citation(chunk.metadata)))
+    return "\n\n".join(parts)
+
+
+def run_layout(client: Client, template: ChatPromptTemplate, chats: List[List[str]], chunks, args) -> Dict:
+    """
+    Отправляет все чаты с одним порядком частей промпта
+    :return: Средние число токенов и время обработки промпта для первых и последующих вопросов чатов
+    """
+    options = {"num_predict": args.answer_tokens, "temperature": 0}
+    if args.num_ctx:
+        options["num_ctx"] = args.num_ctx
+    # Каждый порядок начинается с «чистого» KV-кэша: промпт, не похожий ни на один из проверяемых
+    client.generate(model=args.model, prompt="сброс", options=options, keep_alive=args.keep_alive)
+
+    stats = {"first": {"tokens": [], "ms": []}, "follow_up": {"tokens": [], "ms": []}}
+    histories = [[] for _ in chats]
+    # Либо чаты по очереди целиком, либо по одному вопросу из каждого чата, как при одновременной работе студентов
+    order = ([(chat, turn) for turn in range(args.turns) for chat in range(len(chats))] if args.interleave
+             else [(chat, turn) for chat in range(len(chats)) for turn in range(args.turns)])
+    for chat, turn in order:
+        question = chats[chat][turn]
+        prompt = template.invoke({"context": context_for(question, chunks, args.k), "question": question,
+                                  "chat_history": histories[chat]}).to_string()
+        response = client.generate(model=args.model, prompt=prompt, options=options, keep_alive=args.keep_alive)
+        histories[chat] += [HumanMessage(content=question), AIMessage(content=response.response)]
+        kind = stats["first" if turn == 0 else "follow_up"]
+        kind["tokens"].append(response.prompt_eval_count or 0)
+        kind["ms"].append((response.prompt_eval_duration or 0) / 1e6)
+
+    return {kind: {"requests": len(values["tokens"]),
+                   "prompt_eval_tokens": float(np.mean(values["tokens"])) if values["tokens"] else None,
+                   "prompt_eval_ms": float(np.mean(values["ms"])) if values["ms"] else None}
+            for kind, values in stats.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обработка промпта в Ollama при разных порядках частей промпта")
+    parser.add_argument("--ollama-url", help="Адрес Ollama. Без него запускается bench/fake_ollama.py")
+    parser.add_argument("--model", default="bench", help="Модель ответов")
+    parser.add_argument("--chats", type=int, default=8, help="Сколько чатов")
+    parser.add_argument("--turns", type=int, default=4, help="Сколько вопросов в каждом чате")
+    parser.add_argument("--k", type=int, default=3, help="Сколько фрагментов в промпте")
+    parser.add_argument("--interleave", action="store_true", help="Чередовать вопросы разных чатов")
+    parser.add_argument("--answer-tokens", type=int, default=64, help="Ограничение длины ответа (num_predict)")
+    parser.add_argument("--num-ctx", type=int, default=0, help="Размер контекста модели. 0 - по умолчанию")
+    parser.add_argument("--keep-alive", type=int, default=1800, help="keep_alive для Ollama, секунды")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="Файл JSONL с вопросами")
+    parser.add_argument("--fake-args", default="", help="Аргументы bench/fake_ollama.py одной строкой")
+    parser.add_argument("--output", help="Сохранить результаты в файл JSON")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    chats = [[questions[(chat * args.turns + turn) % len(questions)] for turn in range(args.turns)]
+             for chat in range(args.chats)]
+    chunks = ChunkIndex.open(current_path(CHROMA_PATH))
+    if chunks is None:
+        print(f"Индекс фрагментов в {CHROMA_PATH} не найден, в промпт подставляется текст-заглушка")
+
+    fake = None
+    url = args.ollama_url
+    if url is None:
+        port = free_port()
+        fake = start_fake_ollama(port, ["--token-latency", "0", *args.fake_args.split()])
+        url = f"http://127.0.0.1:{port}"
+    results = {}
+    try:
+        client = Client(host=url)
+        for name, template in LAYOUTS.items():
+            results[name] = run_layout(client, template, chats, chunks, args)
+    finally:
+        stop_process(fake)
+        if chunks is not None:
+            chunks.close()
+
+    print(f"{'Порядок':<10}{'Вопросы':<14}{'Запросов':>9}{'Токенов заново':>16}{'Обработка, мс':>15}")
+    for name, result in results.items():
+        for kind, label in (("first", "первые"), ("follow_up", "уточняющие")):
+            values = result[kind]
+            if not values["requests"]:
+                continue
+            print(f"{name:<10}{label:<14}{values['requests']:>9}{values['prompt_eval_tokens']:>16.0f}"
+                  f"{values['prompt_eval_ms']:>15.1f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Сравнение векторного поиска через Chroma и компактного индекса vector_index/ (float16 и int8) на готовой БД:
+полнота (recall@k) относительно Chroma и точного поиска по исходным векторам, задержка одного запроса и память.
+Каждый вариант работает в отдельном процессе, чтобы память не смешивалась. Ollama не нужна: запросы -
+векторы фрагментов БД с шумом, часть запросов - с фильтром по лекции.
+
+    python bench/bench_vector.py
+    python bench/bench_vector.py --db ./db_metadata --queries 500 --k 10 --output vector.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import REPO_DIR, percentiles, rss_mb
+
+BACKENDS = ("chroma", "float16", "int8")
+
+
+def worker(backend: str, path: str, queries_path: str, k: int) -> dict:
+    """
+    Открывает индекс, выполняет запросы и возвращает время, память и найденные идентификаторы
+    :param backend: "chroma" или тип значений компактного индекса
+    :param path: Каталог БД (для chroma) или каталог с компактным индексом
+    :param queries_path: Файл JSON с векторами запросов и фильтрами
+    :param k: Сколько фрагментов искать
+    """
+    with open(queries_path, encoding="utf-8") as f:
+        queries = json.load(f)
+    rss_start = rss_mb(os.getpid())
+    start = time.perf_counter()
+    if backend == "chroma":
+        import chromadb
+        collection = chromadb.PersistentClient(path).get_collection("langchain")
+    else:
+        from provider.vector_index import VectorIndex
+        collection = VectorIndex.open(path)
+    collection.query(query_embeddings=[queries[0]["vector"]], n_results=k)
+    open_seconds = time.perf_counter() - start
+    rss_open = rss_mb(os.getpid())
+
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query["vector"]], n_results=k, where=query["where"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append(result["ids"][0])
+    return {"open_seconds": open_seconds, "rss_start_mb": rss_start, "rss_open_mb": rss_open,
+            "rss_end_mb": rss_mb(os.getpid()), "latency_ms": percentiles(latencies), "ids": ids}
+
+
+def run_worker(backend: str, path: str, queries_path: str, k: int) -> dict:
+    """Запускает worker в отдельном процессе"""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", backend, "--db", path,
+                             "--queries-file", queries_path, "--k", str(k)],
+                            cwd=REPO_DIR, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def exact_search(vectors: np.ndarray, metadatas: list, query: np.ndarray, where, k: int) -> list:
+    """Номера k ближайших по L2 векторов перебором в float32"""
+    from provider.bm25 import metadata_matches
+    candidates = np.flatnonzero([metadata_matches(metadata, where) for metadata in metadatas])
+    distances = ((vectors[candidates] - query) ** 2).sum(axis=1)
+    return candidates[np.argsort(distances, kind="stable")[:k]].tolist()
+
+
+def recall(found: list, expected: list) -> float:
+    """Средняя доля ожидаемых фрагментов среди найденных"""
+    return float(np.mean([len(set(a) & set(b)) / max(len(b), 1) for a, b in zip(found, expected)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Векторный поиск: Chroma против компактного индекса")
+    parser.add_argument("--db", help="Каталог БД. По умолчанию CHROMA_PATH из настроек")
+    parser.add_argument("--queries", type=int, default=300, help="Сколько запросов выполнить")
+    parser.add_argument("--k", type=int, default=10, help="Сколько фрагментов искать")
+    parser.add_argument("--noise", type=float, default=0.05, help="Шум, добавляемый к векторам фрагментов")
+    parser.add_argument("--filter-share", type=float, default=0.25, help="Доля запросов с фильтром по лекции")
+    parser.add_argument("--output", help="Сохранить результаты в файл JSON")
+    parser.add_argument("--worker", choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument("--queries-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    if args.worker:
+        print(json.dumps(worker(args.worker, args.db, args.queries_file, args.k)))
+        return
+
+    import chromadb
+    from provider.config import CHROMA_PATH
+    from provider.generations import current_path
+    from provider.chunk_index import CHUNK_INDEX_DIR
+    from provider.vector_index import build_vector_index, collection_space
+
+    db_path = current_path(args.db or CHROMA_PATH)
+    client = chromadb.PersistentClient(db_path)
+    collection = client.get_collection("langchain")
+    data = collection.get(include=["metadatas", "embeddings"])
+    space = collection_space(collection)
+    client.close()
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    print(f"БД {db_path}: {len(vectors)} векторов размерности {vectors.shape[1]}, метрика {space}")
+
+    rng = np.random.default_rng(0)
+    queries = []
+    for number in rng.integers(0, len(vectors), args.queries):
+        query = vectors[number] + rng.normal(0, args.noise, vectors.shape[1]).astype(np.float32)
+        lecture = data["metadatas"][number].get("lecture")
+        where = {"lecture": lecture} if lecture is not None and rng.random() < args.filter_share else None
+        queries.append({"vector": query.tolist(), "where": where})
+
+    work_dir = tempfile.mkdtemp(prefix="bench_vector_")
+    results = {}
+    try:
+        queries_path = os.path.join(work_dir, "queries.json")
+        with open(queries_path, "w", encoding="utf-8") as f:
+            json.dump(queries, f)
+        # Компактные индексы обоих типов строятся во временном каталоге рядом с копией индекса фрагментов
+        for dtype in BACKENDS[1:]:
+            index_dir = os.path.join(work_dir, dtype)
+            shutil.copytree(os.path.join(db_path, CHUNK_INDEX_DIR), os.path.join(index_dir, CHUNK_INDEX_DIR))
+            build_vector_index(index_dir, data["ids"], vectors, dtype, space)
+        for backend in BACKENDS:
+            results[backend] = run_worker(backend, db_path if backend == "chroma" else os.path.join(work_dir, backend),
+                                          queries_path, args.k)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    exact = [[data["ids"][number] for number in exact_search(vectors, data["metadatas"], np.asarray(query["vector"]),
+                                                              query["where"], args.k)]
+             for query in queries]
+    print()
+    print(f"{'Вариант':<10}{'recall@' + str(args.k) + ' к Chroma':>18}{'к точному':>11}{'p50, мс':>9}{'p95, мс':>9}"
+          f"{'открытие, с':>13}{'память, МБ':>12}")
+    for backend, result in results.items():
+        result["recall_vs_chroma"] = recall(result["ids"], results["chroma"]["ids"])
+        result["recall_vs_exact"] = recall(result["ids"], exact)
+        memory = (result["rss_end_mb"] - result["rss_start_mb"]
+                  if result["rss_end_mb"] is not None and result["rss_start_mb"] is not None else float("nan"))
+        print(f"{backend:<10}{result['recall_vs_chroma']:>18.3f}{result['recall_vs_exact']:>11.3f}"
+              f"{result['latency_ms']['p50']:>9.2f}{result['latency_ms']['p95']:>9.2f}"
+              f"{result['open_seconds']:>13.2f}{memory:>12.0f}")
+    for result in results.values():
+        del result["ids"]
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
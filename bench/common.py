@@ -0,0 +1,124 @@
+"""
+Общие функции бенчмарков: запуск заглушки Ollama и сервера, ожидание готовности, память процесса, перцентили.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+import httpx
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port() -> int:
+    """Свободный TCP порт на localhost"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_http(url: str, timeout: float = 120, process: Optional[subprocess.Popen] = None) -> None:
+    """
+    Ждёт, пока адрес не начнёт отвечать 200
+    :param url: Адрес для проверки
+    :param timeout: Сколько секунд ждать
+    :param process: Процесс сервера. Если он завершился, ждать дальше нет смысла
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Процесс завершился с кодом {process.returncode}, не дождавшись {url}")
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} не ответил за {timeout} с")
+
+
+def start_fake_ollama(port: int, args: Sequence[str] = ()) -> subprocess.Popen:
+    """Запускает bench/fake_ollama.py в отдельном процессе и ждёт, пока он начнёт отвечать"""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_ollama.py"), "--port", str(port), *args],
+                               stdout=subprocess.DEVNULL)
+    wait_for_http(f"http://127.0.0.1:{port}/api/version", timeout=30, process=process)
+    return process
+
+
+def has_database(path: str) -> bool:
+    """Есть ли в каталоге БД (в текущем поколении или без поколений) заполненная БД Chroma"""
+    current = ""
+    try:
+        with open(os.path.join(path, "current"), encoding="utf-8") as f:
+            current = f.read().strip()
+    except FileNotFoundError:
+        pass
+    db_path = os.path.join(path, "generations", current) if current else path
+    return os.path.exists(os.path.join(db_path, "chroma.sqlite3"))
+
+
+def build_database(path: str, env: Dict[str, str], log_path: str) -> None:
+    """
+    Создаёт БД из конспектов в docs/ через ingest.py. Эмбеддинги вычисляет заглушка Ollama из env,
+    поэтому они согласованы с эмбеддингами вопросов на сервере, который использует ту же заглушку
+    :param path: Каталог БД (CHROMA_PATH)
+    :param env: Переменные окружения ingest.py, в том числе OLLAMA_BASE_URLS заглушки
+    :param log_path: Файл для вывода ingest.py
+    """
+    with open(log_path, "w", encoding="utf-8") as log:
+        subprocess.run([sys.executable, "ingest.py"], cwd=REPO_DIR, env={**os.environ, **env, "CHROMA_PATH": path},
+                       stdout=log, stderr=subprocess.STDOUT, check=True)
+    if not has_database(path):
+        raise RuntimeError(f"ingest.py не создал БД в {path}, см. {log_path}")
+
+
+def start_server(port: int, env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    """
+    Запускает приложение через uvicorn и ждёт окончания прогрева (/health/ready)
+    :param port: Порт сервера
+    :param env: Дополнительные переменные окружения (настройки из provider/config.py)
+    :param log_path: Файл для вывода сервера
+    """
+    log = open(log_path, "w", encoding="utf-8")
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                                "--port", str(port), "--log-level", "warning"],
+                               cwd=REPO_DIR, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT)
+    wait_for_http(f"http://127.0.0.1:{port}/health/ready", process=process)
+    return process
+
+
+def stop_process(process: Optional[subprocess.Popen]) -> None:
+    """Останавливает процесс, при необходимости принудительно"""
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    """Резидентная память процесса в МБ (Linux). None, если узнать не удалось"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentiles(values: List[float], points: Sequence[int] = (50, 95, 99)) -> Dict[str, Optional[float]]:
+    """Перцентили значений: {"p50": ..., "p95": ..., "p99": ...}"""
+    if not values:
+        return {f"p{point}": None for point in points}
+    result = np.percentile(values, points)
+    return {f"p{point}": float(value) for point, value in zip(points, result)}
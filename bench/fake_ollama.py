@@ -0,0 +1,230 @@
+"""
+Детерминированная замена сервера Ollama для бенчмарков и проверок без GPU и сети.
+
+Поддерживаются запросы, которые использует приложение: /api/generate (в том числе потоковый), /api/chat,
+/api/embed, /api/embeddings, /api/tags, /api/version.
+- Эмбеддинги строятся по хэшам слов (сумма псевдослучайных векторов слов), поэтому похожие тексты
+  получают близкие векторы, а одинаковые - одинаковые.
+- Генерация выдаёт фиксированное число токенов с фиксированной задержкой на токен.
+- Обработка промпта занимает время, пропорциональное числу новых токенов. Как и настоящая Ollama,
+  сервер помнит последний промпт каждой модели и не обрабатывает повторно общий с ним префикс.
+- Часть запросов генерации и эмбеддингов может завершаться ошибкой 500 (--error-rate) для проверки пула серверов.
+- Сервер может принимать запросы генерации и эмбеддингов и не отвечать на них (--hang) - как зависшая Ollama,
+  которая при этом отвечает на проверку доступности.
+
+Запуск:
+    python bench/fake_ollama.py --port 11435 --token-latency 0.02
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class FakeOllamaConfig:
+    def __init__(self, dim: int = 768, embed_latency: float = 0.005, token_latency: float = 0.02,
+                 answer_tokens: int = 40, prompt_token_latency: float = 0.0002, chars_per_token: float = 3,
+                 error_rate: float = 0, hang: float = 0):
+        """
+        :param dim: Размерность эмбеддингов
+        :param embed_latency: Задержка одного запроса эмбеддингов, секунды
+        :param token_latency: Задержка генерации одного токена, секунды
+        :param answer_tokens: Сколько токенов в каждом ответе
+        :param prompt_token_latency: Время обработки одного нового токена промпта, секунды
+        :param chars_per_token: Среднее число символов на токен промпта
+        :param error_rate: Доля запросов генерации и эмбеддингов, на которые отвечается ошибка 500
+        :param hang: Сколько секунд сервер молчит, прежде чем ответить на запрос генерации или эмбеддингов
+        """
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.prompt_token_latency = prompt_token_latency
+        self.chars_per_token = chars_per_token
+        self.error_rate = error_rate
+        self.hang = hang
+
+
+@lru_cache(maxsize=65536)
+def _word_vector(word: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def embed(text: str, dim: int) -> List[float]:
+    """Детерминированный эмбеддинг текста: нормированная сумма векторов слов"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower().replace("ё", "е")):
+        vector += _word_vector(word, dim)
+    norm = np.linalg.norm(vector)
+    if not norm:
+        vector = _word_vector("", dim)
+        norm = np.linalg.norm(vector)
+    return (vector / norm).tolist()
+
+
+def common_prefix_length(left: str, right: str) -> int:
+    """Длина общего начала двух строк"""
+    size = min(len(left), len(right))
+    for i in range(size):
+        if left[i] != right[i]:
+            return i
+    return size
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = FakeOllamaConfig()
+    # Последний промпт каждой модели - аналог KV-кэша Ollama
+    last_prompts = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: dict) -> None:
+        body = (json.dumps(data, ensure_ascii=False) + "\n").encode()
+        self.wfile.write(f"{len(body):x}\r\n".encode() + body + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            return self._send_json({"models": []})
+        if self.path == "/api/version":
+            return self._send_json({"version": "0.0.0-fake"})
+        if self.path == "/":
+            return self._send_json({"status": "Ollama is running"})
+        self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.config.hang:
+            time.sleep(self.config.hang)
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            return self._send_json({"error": "fake failure"}, status=500)
+        if self.path == "/api/embed":
+            return self._embed(request)
+        if self.path == "/api/embeddings":
+            time.sleep(self.config.embed_latency)
+            return self._send_json({"embedding": embed(request.get("prompt", ""), self.config.dim)})
+        if self.path == "/api/generate":
+            return self._generate(request, request.get("prompt") or "", chat=False)
+        if self.path == "/api/chat":
+            prompt = "\n".join(message.get("content", "") for message in request.get("messages", []))
+            return self._generate(request, prompt, chat=True)
+        self._send_json({"error": "not found"}, status=404)
+
+    def _embed(self, request: dict) -> None:
+        texts = request.get("input", "")
+        texts = [texts] if isinstance(texts, str) else texts
+        time.sleep(self.config.embed_latency)
+        self._send_json({"model": request.get("model"),
+                         "embeddings": [embed(text, self.config.dim) for text in texts]})
+
+    def _evaluate_prompt(self, model: str, prompt: str) -> tuple:
+        """Имитирует обработку промпта с повторным использованием общего префикса. Возвращает (токены, наносекунды)"""
+        with self.lock:
+            cached = common_prefix_length(self.last_prompts.get(model, ""), prompt)
+            self.last_prompts[model] = prompt
+        new_tokens = int((len(prompt) - cached) / self.config.chars_per_token)
+        start = time.perf_counter_ns()
+        time.sleep(new_tokens * self.config.prompt_token_latency)
+        return new_tokens, time.perf_counter_ns() - start
+
+    def _generate(self, request: dict, prompt: str, chat: bool) -> None:
+        model = request.get("model", "")
+        # Пустой промпт - только загрузка модели в память
+        if not prompt:
+            return self._send_json({"model": model, "response": "", "done": True, "done_reason": "load"})
+
+        prompt_eval_count, prompt_eval_duration = self._evaluate_prompt(model, prompt)
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        tokens = [f"ответ{digest[i % 32:i % 32 + 4]} " for i in range(self.config.answer_tokens)]
+        final = {
+            "model": model,
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": prompt_eval_duration,
+            "eval_count": len(tokens),
+            "eval_duration": int(len(tokens) * self.config.token_latency * 1e9),
+        }
+
+        def part(text: str) -> dict:
+            if chat:
+                return {"message": {"role": "assistant", "content": text}}
+            return {"response": text}
+
+        if not request.get("stream", True):
+            time.sleep(len(tokens) * self.config.token_latency)
+            return self._send_json({**final, **part("".join(tokens))})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(self.config.token_latency)
+            self._send_chunk({"model": model, "done": False, **part(token)})
+        self._send_chunk({**final, **part("")})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def create_server(host: str, port: int, config: FakeOllamaConfig) -> ThreadingHTTPServer:
+    """Создаёт сервер с отдельной конфигурацией и отдельным кэшем промптов"""
+    handler = type("ConfiguredFakeOllamaHandler", (FakeOllamaHandler,),
+                   {"config": config, "last_prompts": {}, "lock": threading.Lock()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Детерминированная замена сервера Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--dim", type=int, default=768, help="Размерность эмбеддингов")
+    parser.add_argument("--embed-latency", type=float, default=0.005, help="Задержка запроса эмбеддингов, с")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Задержка на один токен ответа, с")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="Число токенов в ответе")
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0002,
+                        help="Время обработки одного нового токена промпта, с")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Доля запросов генерации и эмбеддингов, на которые отвечается ошибка 500")
+    parser.add_argument("--hang", type=float, default=0,
+                        help="Сколько секунд молчать, прежде чем ответить на запрос генерации или эмбеддингов")
+    args = parser.parse_args()
+
+    config = FakeOllamaConfig(dim=args.dim, embed_latency=args.embed_latency, token_latency=args.token_latency,
+                              answer_tokens=args.answer_tokens, prompt_token_latency=args.prompt_token_latency,
+                              error_rate=args.error_rate, hang=args.hang)
+    server = create_server(args.host, args.port, config)
+    print(f"Fake Ollama слушает http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -51,6 +51,73 @@ function addMessageToChat(content, isUser = false) {
     
     // Прокручиваем чат вниз
     chatMessages.scrollTop = chatMessages.scrollHeight;
+
+    return textDiv;
+}
+
+// Функция для отображения источников под ответом ИИ
+function addSourcesToMessage(textDiv, sources) {
+    if (!sources || sources.length === 0) return;
+
+    const sourcesDiv = document.createElement('div');
+    sourcesDiv.className = 'message-sources';
+    sourcesDiv.textContent = 'Источники: ' + sources
+        .map(source => `${source.source}, стр. ${source.page}`)
+        .join('; ');
+
+    textDiv.parentNode.insertBefore(sourcesDiv, textDiv.nextSibling);
+}
+
+// Функция для разбора одного события Server-Sent Events
+function parseSseEvent(rawEvent) {
+    let event = 'message';
+    const dataLines = [];
+
+    for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event:')) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            dataLines.push(line.slice(5).trimStart());
+        }
+    }
+
+    return { event, data: dataLines.length ? JSON.parse(dataLines.join('\n')) : null };
+}
+
+// Функция для чтения потокового ответа сервера и вывода токенов по мере поступления
+async function readStreamingResponse(response) {
+    const textDiv = addMessageToChat('');
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+
+        // События разделяются пустой строкой
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+
+            const { event, data } = parseSseEvent(rawEvent);
+            if (event === 'sources') {
+                addSourcesToMessage(textDiv, data);
+            } else if (event === 'token') {
+                textDiv.textContent += data;
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            } else if (event === 'error' && data.kind === 'overloaded') {
+                textDiv.textContent = `Сервер перегружен. Пожалуйста, повторите запрос через ${data.retry_after} с.`;
+            } else if (event === 'error') {
+                // Начатый ответ оставляем, чтобы было видно, где он прервался
+                const notice = 'Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.';
+                textDiv.textContent = textDiv.textContent ? `${textDiv.textContent} (${notice})` : notice;
+            }
+        }
+    }
 }
 
 // Функция для отправки сообщения на сервер
@@ -67,7 +134,7 @@ async function sendMessage() {
     
     // Отправляем сообщение на сервер
     try {
-        const response = await fetch(`/chat/${chatId}`, {
+        const response = await fetch(`/chat/${chatId}?stream=true`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -76,9 +143,11 @@ async function sendMessage() {
         });
         
         if (response.ok) {
-            const data = await response.json();
-            // Добавление ответа ИИ в чат
-            addMessageToChat(data.response);
+            // Добавление ответа ИИ в чат по мере генерации
+            await readStreamingResponse(response);
+        } else if (response.status === 429) {
+            const retryAfter = response.headers.get('Retry-After');
+            addMessageToChat(`Сервер перегружен. Пожалуйста, повторите запрос через ${retryAfter} с.`);
         } else {
             addMessageToChat('Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.');
         }
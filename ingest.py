@@ -1,18 +1,59 @@
 # Импорт необходимых библиотек
+import argparse
 import hashlib
+import json
 import os
-import shutil
-from typing import List, Generator
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_text_splitters import MarkdownTextSplitter
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Generator, Optional, Sequence, Set, Tuple
+from pypdf import PdfReader
+from langchain_chroma import Chroma
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from langchain_ollama import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
+from provider.bm25 import BM25Index
+from provider.chunk_index import CHUNK_INDEX_DIR, build_chunk_index
+from provider.cache import write_index_version
+from provider.config import (CHROMA_PATH, INDEX_KEEP_GENERATIONS, EMBEDDING_MODEL, OLLAMA_BASE_URLS,
+                             OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT, EMBED_BATCH_SIZE, EMBED_CONCURRENCY,
+                             EMBED_MAX_RETRIES, EMBED_RETRY_DELAY, EMBEDDING_CACHE_PATH, PDF_WORKERS,
+                             PDF_PAGES_PER_TASK, PDF_PAGE_WINDOW, VECTOR_INDEX_DTYPE)
+from provider.embedding_cache import EmbeddingCache
+from provider.generations import (create_generation, generation_path, publish_generation, read_current,
+                                  remove_generations)
+from provider.metrics import MetricsRegistry, StageTimer, current_timer, stage
+from provider.pool import OllamaPool, PooledOllamaEmbeddings
+from provider.vector_index import VECTOR_INDEX_DIR, build_vector_index, collection_space
 
-# Путь до директории ChromaDB
-CHROMA_PATH = "./db_metadata"
 DATA_PATH = "./docs"
+# Манифест с хэшами файлов и идентификаторами их фрагментов для инкрементального обновления БД
+MANIFEST_FILE = "manifest.json"
+# Версия разбиения на фрагменты. Если в манифесте другая версия, БД пересоздаётся полностью
+CHUNKER_VERSION = 3
+# Отточия в строках оглавления: "Лекция 1 ............ 8"
+DOT_LEADER_PATTERN = re.compile(r"\.{5,}|(?:\. ){4,}")
+# Страница с таким числом отточий считается оглавлением и не попадает в БД
+TOC_MIN_DOT_LEADERS = 5
+# Заголовок лекции - отдельная строка "ЛЕКЦИЯ 3" или "Лекция 15"
+LECTURE_PATTERN = re.compile(r"^\s*лекция\s+(\d+)\s*$", re.IGNORECASE)
+# Заголовок раздела - строка "1.1.2. Название" или "2.9.3 Название". Название начинается с заглавной буквы
+# и строчных букв, чтобы не путать заголовок с числом и единицей измерения ("1.5 МэВ")
+SECTION_PATTERN = re.compile(r"^\s*([1-9]\d?(?:\.\d{1,2})+)\.?\s+([А-ЯЁA-Z][а-яёa-z]{2,}.*?)\s*$")
 global_unique_hashes = set()
+# Эмбеддинги фрагментов распределяются между серверами Ollama из OLLAMA_BASE_URLS, как запросы сервера.
+# Сервер, не ответивший на запрос, до конца работы скрипта получает запросы, только если недоступны все остальные
+embedding_pool = OllamaPool(OLLAMA_BASE_URLS, connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                            read_timeout=OLLAMA_READ_TIMEOUT)
+embedding_function = PooledOllamaEmbeddings(embedding_pool, EMBEDDING_MODEL)
+# Текущие лекция и раздел каждого файла: путь -> (лекция, номер раздела, название раздела).
+# Страницы файла приходят по порядку, поэтому заголовок действует до следующего заголовка
+current_headings: Dict[str, Tuple[int, str, str]] = {}
+# Разница между напечатанным номером страницы и её порядковым номером в каждом файле: путь -> разница.
+# Нужна для страниц без напечатанного номера (обложка, последняя страница)
+page_number_offsets: Dict[str, int] = {}
 
 
 def walk_through_pdf_files(path: str) -> Generator[str, None, None]:
@@ -23,31 +64,99 @@ def walk_through_pdf_files(path: str) -> Generator[str, None, None]:
                 yield os.path.join(dir_path, filename)
 
 
-def load_documents() -> List[Document]:
+def load_page_range(pdf_file: str, start: int, end: int) -> List[Document]:
     """
-    Загружаем PDF документы из каталога docs
-    :return:
-    Список объектов документа
+    Загружаем диапазон страниц PDF документа. Выполняется в отдельном процессе
+    :param pdf_file: Путь до PDF файла
+    :param start: Номер первой страницы (с нуля)
+    :param end: Номер страницы после последней
+    :return: Список страниц документа с тем же текстом и метаданными source/page, что и у PyPDFLoader
+    :raises RuntimeError: Страницы не удалось прочитать. Файл нельзя записывать в манифест без части страниц:
+        следующий запуск счёл бы его неизменным и не разобрал бы заново
     """
-    documents = []
+    try:
+        reader = PdfReader(pdf_file)
+        documents = []
+        for page_number in range(start, end):
+            text = reader.pages[page_number].extract_text(extraction_mode="plain").strip()
+            documents.append(Document(page_content=text, metadata={
+                "source": pdf_file,
+                "total_pages": len(reader.pages),
+                "page": page_number,
+                "page_label": reader.page_labels[page_number],
+            }))
+        return documents
+    except Exception as e:
+        raise RuntimeError(f"Ошибка при загрузке страниц {start + 1}-{end} из {pdf_file}: {e}") from None
+
+
+def _load_page_range_task(task: Tuple[str, int, int]) -> List[Document]:
+    return load_page_range(*task)
 
-    # Загрузка только PDF файлов
-    pdf_files = []
-    for (dir_path, _, filenames) in os.walk(DATA_PATH):
-        for filename in filenames:
-            if filename.lower().endswith(".pdf"):
-                pdf_files.append(os.path.join(dir_path, filename))
 
+def plan_page_ranges(pdf_files: Iterable[str], pages_per_task: int) -> List[Tuple[str, int, int]]:
+    """
+    Делит PDF файлы на диапазоны страниц, чтобы большие файлы разбирались несколькими процессами
+    :param pdf_files: Пути до PDF файлов
+    :param pages_per_task: Количество страниц в одном диапазоне
+    :return: Список задач (путь, первая страница, страница после последней)
+    :raises RuntimeError: Файл не удалось открыть
+    """
+    tasks = []
     for pdf_file in pdf_files:
         try:
-            loader = PyPDFLoader(pdf_file)
-            documents.extend(loader.load())
-            print(f"Загружен PDF: {pdf_file}")
+            page_count = len(PdfReader(pdf_file).pages)
         except Exception as e:
-            print(f"Ошибка при загрузке {pdf_file}: {e}")
+            raise RuntimeError(f"Ошибка при загрузке {pdf_file}: {e}") from None
+        for start in range(0, page_count, pages_per_task):
+            tasks.append((pdf_file, start, min(start + pages_per_task, page_count)))
+    return tasks
+
+
+def iter_pages(pdf_files: Iterable[str], workers: int = PDF_WORKERS,
+               pages_per_task: int = PDF_PAGES_PER_TASK) -> Generator[Document, None, None]:
+    """
+    Разбирает PDF файлы в пуле процессов и отдаёт страницы по порядку по мере готовности.
+    Одновременно выполняется не больше 2 * workers задач, поэтому в памяти находится только окно страниц.
+    :param pdf_files: Пути до PDF файлов
+    :param workers: Количество процессов
+    :param pages_per_task: Количество страниц в одной задаче
+    :return: Генератор страниц
+    """
+    tasks = iter(plan_page_ranges(pdf_files, pages_per_task))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append((task, pool.submit(_load_page_range_task, task)))
+            if len(in_flight) >= 2 * workers:
+                break
+        while in_flight:
+            _, future = in_flight.popleft()
+            next_task = next(tasks, None)
+            if next_task is not None:
+                in_flight.append((next_task, pool.submit(_load_page_range_task, next_task)))
+            yield from future.result()
 
-    print(f"Всего загружено {len(documents)} страниц из PDF файлов")
-    return documents
+
+def iter_page_windows(pdf_files: Iterable[str], window: int = PDF_PAGE_WINDOW) -> Generator[List[Document], None, None]:
+    """Группирует страницы в окна фиксированного размера"""
+    pages = []
+    for page in iter_pages(pdf_files):
+        pages.append(page)
+        if len(pages) >= window:
+            yield pages
+            pages = []
+    if pages:
+        yield pages
+
+
+def hash_file(path: str) -> str:
+    """Генерирует SHA-256 хэш содержимого файла"""
+    hash_object = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hash_object.update(block)
+    return hash_object.hexdigest()
 
 
 def hash_text(text: str) -> str:
@@ -56,23 +165,111 @@ def hash_text(text: str) -> str:
     return hash_object.hexdigest()
 
 
-def split_text(documents: List[Document]) -> List[Document]:
+def is_toc_page(page: Document) -> bool:
+    """Страница оглавления: много строк с отточиями"""
+    return len(DOT_LEADER_PATTERN.findall(page.page_content)) >= TOC_MIN_DOT_LEADERS
+
+
+def printed_page_number(page: Document) -> Optional[int]:
+    """Номер, напечатанный на странице: отдельная строка из цифр в начале текста страницы"""
+    lines = page.page_content.strip().split("\n", 1)
+    return int(lines[0]) if lines[0].strip().isdigit() else None
+
+
+def citation_page_number(page: Document) -> int:
+    """
+    Номер страницы для ссылок и фильтров page_number - номер, напечатанный на странице.
+    Метка страницы PDF (page_label) с ним не всегда совпадает: в konspket-part1.pdf метка на единицу меньше.
+    На странице без напечатанного номера он продолжает нумерацию предыдущих страниц файла,
+    а до первого напечатанного номера равен порядковому номеру страницы в PDF (с 1)
+    :param page: Страница PDF файла
+    :return: Номер страницы, начиная с 1
+    """
+    source, index = page.metadata["source"], page.metadata.get("page", 0) + 1
+    printed = printed_page_number(page)
+    if printed is None:
+        return index + page_number_offsets.get(source, 0)
+    if printed - index != page_number_offsets.get(source, 0):
+        label = page.metadata.get("page_label")
+        print(f"{os.path.basename(source)}: на странице {index} напечатан номер {printed} (метка PDF: {label}), "
+              f"для ссылок используется напечатанный номер")
+        page_number_offsets[source] = printed - index
+    return printed
+
+
+def split_page_sections(page: Document) -> List[Document]:
+    """
+    Делит страницу на части по заголовкам лекций и разделов.
+    Каждая часть получает метаданные source_file, page_number, lecture (0 - до первой лекции), section и section_title
+    :param page: Страница PDF файла
+    :return: Части страницы. Заголовок относится к части, которую он начинает
+    """
+    source = page.metadata["source"]
+    page_number = citation_page_number(page)
+    lecture, section, section_title = current_headings.get(source, (0, "", ""))
+    sections = []
+    lines: List[str] = []
+
+    def flush() -> None:
+        text = "\n".join(lines).strip()
+        if text:
+            sections.append(Document(page_content=text, metadata={
+                **page.metadata,
+                "source_file": os.path.basename(source),
+                "page_number": page_number,
+                "lecture": lecture,
+                "section": section,
+                "section_title": section_title,
+            }))
+
+    # Есть ли в текущей части текст, кроме заголовков и номера страницы
+    has_body = False
+    for line in page.page_content.split("\n"):
+        lecture_match = LECTURE_PATTERN.match(line)
+        section_match = None if lecture_match else SECTION_PATTERN.match(line)
+        if lecture_match or section_match:
+            # Заголовок лекции и следующий за ним заголовок раздела остаются в одной части
+            if has_body:
+                flush()
+                lines, has_body = [], False
+            if lecture_match:
+                lecture = int(lecture_match.group(1))
+            else:
+                section, section_title = section_match.group(1), section_match.group(2)
+        elif line.strip() and not line.strip().isdigit():
+            has_body = True
+        lines.append(line)
+    flush()
+
+    current_headings[source] = (lecture, section, section_title)
+    return sections
+
+
+def split_documents(documents: List[Document]) -> List[Document]:
     """
-    Разделяет текстовое содержимое документов на более мелкие фрагменты
-    :param documents: Список объектов документа, содержащих текстовое содержимое для разделения.
+    Разделяет текстовое содержимое документов на более мелкие фрагменты без удаления дубликатов.
+    Страницы оглавления пропускаются, а фрагменты не пересекают границы страниц, лекций и разделов
+    :param documents: Страницы PDF файлов по порядку
     :return: Список объектов документа, представляющих разделенные текстовые фрагменты (chunks).
     """
     # Разделение текста с данными параметрами
-    text_splitter = MarkdownTextSplitter(
+    text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,  # Размер каждого фрагмента в символах
         chunk_overlap=100, # Размер накладного слоя (конец одного chunk накладывается на начало второго chunk)
         length_function=len,  # Функция для вычисления длины текста
+        separators=["\n\n", "\n", " ", ""],
     )
+    pages = [page for page in documents if not is_toc_page(page)]
+    sections = [section for page in pages for section in split_page_sections(page)]
     # Разделение документов на более мелкие фрагменты функцией text_splitter
-    chunks = text_splitter.split_documents(documents)
-    print(f"Документы {len(documents)} разделены на {len(chunks)} частей.")
+    chunks = text_splitter.split_documents(sections)
+    print(f"Документы {len(documents)} (страниц оглавления: {len(documents) - len(pages)}) "
+          f"разделены на {len(chunks)} частей.")
+    return chunks
+
 
-    # Убираем дубликаты
+def deduplicate_chunks(chunks: List[Document]) -> List[Document]:
+    """Убирает фрагменты, текст которых уже встречался"""
     unique_chunks = []
     for chunk in chunks:
         chunk_hash = hash_text(chunk.page_content)
@@ -85,36 +282,326 @@ def split_text(documents: List[Document]) -> List[Document]:
     return unique_chunks
 
 
-def save_to_chroma(chunks: List[Document]) -> None:
+def open_chroma(path: str = CHROMA_PATH) -> Chroma:
     """
-    Сохранение заданных объектов документа в Chroma DB.
-    :param chunks: Список объектов документов, представляющих фрагменты текста для сохранения.
-    :return: None
+    Открывает БД Chroma. Эмбеддинги фрагментов вычисляются отдельно в embed_chunks
+    :param path: Каталог поколения БД
     """
-    # Удаление существующего каталога БД, если он существует
-    if os.path.exists(CHROMA_PATH):
-        shutil.rmtree(CHROMA_PATH)
+    return Chroma(persist_directory=path, embedding_function=embedding_function)
 
-    # Создание новой БД на основе документов, используя Ollama embeddings
-    db = Chroma.from_documents(
-        documents=chunks,
-        embedding=OllamaEmbeddings(model="nomic-embed-text-v2-moe"),
-        persist_directory=CHROMA_PATH
-    )
 
-    # Запись данных в БД
-    print(f"Сохранено {len(chunks)} фрагментов в директории {CHROMA_PATH}")
+def embed_batch(embeddings: Embeddings, texts: List[str], max_retries: int) -> List[List[float]]:
+    """
+    Эмбеддинги одного пакета текстов с повтором при ошибке
+    :param embeddings: Модель эмбеддингов
+    :param texts: Тексты пакета
+    :param max_retries: Сколько раз повторять запрос
+    :return: Векторы текстов
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = EMBED_RETRY_DELAY * 2 ** attempt
+            print(f"Ошибка при получении эмбеддингов ({e}), повтор через {delay:.1f} с")
+            time.sleep(delay)
 
 
-def generate_data_store() -> None:
-    """Создание векторной БД в Chroma из документов"""
-    documents = load_documents()  # Загрузка документов из источника
-    if documents:  # Проверяем, что документы загрузились
-        chunks = split_text(documents)  # Разделение документов на фрагменты
-        save_to_chroma(chunks)  # Сохранение обработанных данных в хранилище
-    else:
+def embed_chunks(chunks: List[Document], cache: Optional[EmbeddingCache] = None, batch_size: int = EMBED_BATCH_SIZE,
+                 concurrency: int = EMBED_CONCURRENCY) -> List[List[float]]:
+    """
+    Вычисляет эмбеддинги фрагментов пакетами в несколько параллельных запросов к Ollama.
+    Векторы сохраняются в кэш по хэшу текста, поэтому уже встречавшиеся тексты повторно не отправляются.
+    :param chunks: Список фрагментов
+    :param cache: Кэш эмбеддингов. По умолчанию открывается кэш из EMBEDDING_CACHE_PATH
+    :param batch_size: Количество фрагментов в одном запросе
+    :param concurrency: Количество одновременных запросов
+    :return: Векторы фрагментов в том же порядке
+    """
+    own_cache = cache is None
+    if own_cache:
+        cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_MODEL)
+    keys = [hash_text(chunk.page_content) for chunk in chunks]
+    texts = {key: chunk.page_content for key, chunk in zip(keys, chunks)}
+    missing = cache.missing(keys)
+    print(f"Эмбеддинги: {len(keys) - len(missing)} из кэша, {len(missing)} нужно вычислить")
+
+    if missing:
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        start = time.perf_counter()
+        done = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(embed_batch, embedding_function, [texts[key] for key in batch], EMBED_MAX_RETRIES): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                # Кэш дописывается только из основного потока
+                cache.add(batch, future.result())
+                done += len(batch)
+                elapsed = time.perf_counter() - start
+                print(f"Эмбеддинги: {done}/{len(missing)}, {done / elapsed:.1f} фрагментов/с")
+
+    vectors = cache.get(keys).tolist()
+    if own_cache:
+        cache.close()
+    return vectors
+
+
+def write_chunks(db: Chroma, chunks: Sequence[Document], embeddings: Sequence[Sequence[float]]) -> None:
+    """
+    Записывает фрагменты с готовыми эмбеддингами в Chroma пакетами допустимого размера
+    :param db: БД Chroma
+    :param chunks: Фрагменты
+    :param embeddings: Векторы фрагментов
+    """
+    batch_size = db._client.get_max_batch_size()
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        db._collection.upsert(ids=[hash_text(chunk.page_content) for chunk in batch],
+                              embeddings=embeddings[i:i + batch_size],
+                              documents=[chunk.page_content for chunk in batch],
+                              metadatas=[chunk.metadata for chunk in batch])
+
+
+def process_files(db: Chroma, pdf_files: List[str], ids_before: Set[str],
+                  ids_unchanged: Set[str]) -> Dict[str, List[str]]:
+    """
+    Потоковая обработка PDF файлов: страницы окнами проходят разбиение на фрагменты, эмбеддинги и запись в БД.
+    :param db: БД Chroma
+    :param pdf_files: Пути до PDF файлов
+    :param ids_before: Идентификаторы фрагментов, которые уже есть в БД. Они повторно не записываются
+    :param ids_unchanged: Идентификаторы фрагментов неизменённых файлов. Их метаданные не обновляются
+    :return: Идентификаторы фрагментов каждого файла
+    """
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_MODEL)
+    file_chunk_ids = {pdf_file: {} for pdf_file in pdf_files}
+    global_unique_hashes.clear()
+    current_headings.clear()
+    page_number_offsets.clear()
+    page_count, added, updated = 0, 0, 0
+    start = time.perf_counter()
+
+    windows = iter_page_windows(pdf_files)
+    while True:
+        with stage("load"):
+            pages = next(windows, None)
+        if pages is None:
+            break
+        page_count += len(pages)
+        with stage("split"):
+            chunks = split_documents(pages)
+        for chunk in chunks:
+            # dict сохраняет порядок фрагментов и убирает повторы внутри файла
+            file_chunk_ids[chunk.metadata["source"]][hash_text(chunk.page_content)] = None
+
+        with stage("dedup"):
+            unique_chunks = deduplicate_chunks(chunks)
+        new_chunks = [chunk for chunk in unique_chunks if hash_text(chunk.page_content) not in ids_before]
+        kept_chunks = [chunk for chunk in unique_chunks
+                       if hash_text(chunk.page_content) in ids_before - ids_unchanged]
+
+        if new_chunks:
+            with stage("embed"):
+                embeddings = embed_chunks(new_chunks, cache)
+            with stage("write"):
+                write_chunks(db, new_chunks, embeddings)
+        if kept_chunks:
+            # Текст не изменился, но страница могла сместиться - обновляем только метаданные без эмбеддинга
+            with stage("write"):
+                db._collection.update(ids=[hash_text(chunk.page_content) for chunk in kept_chunks],
+                                      metadatas=[chunk.metadata for chunk in kept_chunks])
+        added += len(new_chunks)
+        updated += len(kept_chunks)
+
+    cache.close()
+    elapsed = time.perf_counter() - start
+    print(f"Обработано {page_count} страниц из {len(pdf_files)} файлов за {elapsed:.1f} с. "
+          f"Добавлено фрагментов: {added}, обновлено метаданных: {updated}")
+    return {pdf_file: list(chunk_ids) for pdf_file, chunk_ids in file_chunk_ids.items()}
+
+
+def save_indexes(db: Chroma, path: str) -> None:
+    """
+    Строит по всем фрагментам БД и сохраняет рядом с ней лексический индекс BM25,
+    индекс фрагментов для просмотра и поиска в check_chunk.py и компактный векторный индекс
+    :param db: БД Chroma
+    :param path: Каталог поколения БД
+    """
+    start = time.perf_counter()
+    with stage("bm25"):
+        data = db._collection.get(include=["documents", "metadatas", "embeddings"])
+        BM25Index.build(data["ids"], data["documents"], data["metadatas"]).save(path)
+    print(f"Индекс BM25 по {len(data['ids'])} фрагментам построен за {time.perf_counter() - start:.1f} с")
+
+    start = time.perf_counter()
+    with stage("chunk_index"):
+        build_chunk_index(path, data["ids"], data["documents"], data["metadatas"])
+    print(f"Индекс фрагментов построен за {time.perf_counter() - start:.1f} с")
+
+    start = time.perf_counter()
+    with stage("vector_index"):
+        build_vector_index(path, data["ids"], data["embeddings"], VECTOR_INDEX_DTYPE, collection_space(db._collection))
+    print(f"Векторный индекс ({VECTOR_INDEX_DTYPE}) построен за {time.perf_counter() - start:.1f} с")
+
+
+def load_manifest(path: str) -> Dict:
+    """Загружает манифест поколения БД. Если его нет, возвращает пустой манифест"""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {"embedding_model": EMBEDDING_MODEL, "chunker_version": CHUNKER_VERSION, "files": {}}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict, path: str) -> None:
+    """Атомарно сохраняет манифест поколения БД"""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def publish(path: str, name: str) -> None:
+    """
+    Записывает версию индекса, делает поколение текущим и удаляет старые поколения.
+    Последние INDEX_KEEP_GENERATIONS поколений остаются: их ещё может использовать сервер, не успевший переключиться
+    """
+    write_index_version(path)
+    publish_generation(CHROMA_PATH, name)
+    remove_generations(CHROMA_PATH, INDEX_KEEP_GENERATIONS)
+    print(f"Опубликовано поколение индекса {name}")
+
+
+def rebuild_data_store(file_hashes: Dict[str, str]) -> None:
+    """
+    Полное пересоздание векторной БД в Chroma из документов в новом поколении
+    :param file_hashes: Хэши содержимого PDF файлов
+    """
+    if not file_hashes:
         print("Не найдено PDF файлов для обработки")
+        return
+
+    # Новое поколение создаётся рядом с текущим, которое сервер продолжает использовать до переключения.
+    # Идентификатор фрагмента - хэш его текста, чтобы при обновлении БД он не менялся
+    name, path = create_generation(CHROMA_PATH)
+    db = open_chroma(path)
+    file_chunk_ids = process_files(db, list(file_hashes), set(), set())
+
+    files = {pdf_file: {"sha256": file_hash, "chunk_ids": file_chunk_ids[pdf_file]}
+             for pdf_file, file_hash in file_hashes.items()}
+    save_manifest({"embedding_model": EMBEDDING_MODEL, "chunker_version": CHUNKER_VERSION, "files": files}, path)
+    print(f"Сохранено {db._collection.count()} фрагментов в директории {path}")
+    save_indexes(db, path)
+    db._client.close()
+
+    # Новая версия индекса сбрасывает кэш ответов на сервере
+    publish(path, name)
+
+
+def update_data_store(file_hashes: Dict[str, str], manifest: Dict, current: str) -> None:
+    """
+    Инкрементальное обновление векторной БД в копии текущего поколения.
+    Заново обрабатываются только изменённые и новые файлы, в БД добавляются только новые фрагменты,
+    а фрагменты удалённых файлов удаляются. Если ничего не изменилось, Ollama не вызывается
+    и новое поколение не создаётся.
+    :param file_hashes: Хэши содержимого PDF файлов
+    :param manifest: Манифест текущей БД
+    :param current: Каталог текущего поколения БД
+    """
+    files = manifest["files"]
+    changed_files = [pdf_file for pdf_file, file_hash in file_hashes.items()
+                     if files.get(pdf_file, {}).get("sha256") != file_hash]
+    removed_files = [pdf_file for pdf_file in files if pdf_file not in file_hashes]
+
+    if not changed_files and not removed_files:
+        print("Изменений в PDF файлах нет, БД актуальна")
+        if not all(os.path.exists(os.path.join(current, index_dir)) for index_dir in (CHUNK_INDEX_DIR, VECTOR_INDEX_DIR)):
+            # БД создана до появления индекса фрагментов или векторного индекса. Индексы только добавляются,
+            # сервер БД не меняет
+            save_indexes(open_chroma(current), current)
+        return
+
+    print(f"Изменено или добавлено файлов: {len(changed_files)}, удалено файлов: {len(removed_files)}")
+    ids_before = {chunk_id for info in files.values() for chunk_id in info["chunk_ids"]}
+    # Фрагменты файлов, которые не менялись. Их метаданные не трогаем
+    ids_unchanged = {chunk_id for pdf_file, info in files.items()
+                     if pdf_file not in changed_files and pdf_file not in removed_files
+                     for chunk_id in info["chunk_ids"]}
+
+    # Обрабатываем только изменённые файлы в копии текущего поколения, которое сервер продолжает использовать
+    with stage("copy"):
+        name, path = create_generation(CHROMA_PATH, copy_from=current)
+    db = open_chroma(path)
+    file_chunk_ids = process_files(db, changed_files, ids_before, ids_unchanged)
+
+    for pdf_file in removed_files:
+        del files[pdf_file]
+    for pdf_file in changed_files:
+        files[pdf_file] = {"sha256": file_hashes[pdf_file], "chunk_ids": file_chunk_ids[pdf_file]}
+    ids_after = {chunk_id for info in files.values() for chunk_id in info["chunk_ids"]}
+
+    deleted_ids = sorted(ids_before - ids_after)
+    if deleted_ids:
+        with stage("delete"):
+            db.delete(ids=deleted_ids)
+
+    save_manifest(manifest, path)
+    save_indexes(db, path)
+    db._client.close()
+    print(f"Удалено фрагментов: {len(deleted_ids)}")
+    publish(path, name)
+
+
+def save_metrics(registry: MetricsRegistry, path: str) -> None:
+    """Атомарно сохраняет метрики в текстовом формате Prometheus (для textfile collector node_exporter)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def generate_data_store(rebuild: bool = False, metrics_file: str = "") -> None:
+    """
+    Создание или обновление векторной БД в Chroma из документов.
+    Время каждого этапа выводится в журнал одной строкой JSON
+    :param rebuild: Пересоздать БД полностью, а не обновлять инкрементально
+    :param metrics_file: Файл для сохранения времени этапов в формате Prometheus. Пустая строка - не сохранять
+    """
+    registry = MetricsRegistry()
+    timer = StageTimer(registry.histogram("ingest_stage_seconds", "Время этапов ingest.py", ["stage"]))
+    current_timer.set(timer)
+
+    with stage("hash"):
+        file_hashes = {pdf_file: hash_file(pdf_file) for pdf_file in walk_through_pdf_files(DATA_PATH)}
+    current = generation_path(CHROMA_PATH, read_current(CHROMA_PATH))
+    manifest = load_manifest(current)
+
+    if (rebuild or not manifest["files"] or manifest.get("embedding_model") != EMBEDDING_MODEL
+            or manifest.get("chunker_version") != CHUNKER_VERSION):
+        # БД создана старой версией скрипта, другой моделью эмбеддингов или другим разбиением на фрагменты -
+        # инкрементальное обновление невозможно
+        mode = "rebuild"
+        rebuild_data_store(file_hashes)
+    else:
+        mode = "update"
+        update_data_store(file_hashes, manifest, current)
+
+    timer.log("ingest", mode=mode, files=len(file_hashes))
+    if metrics_file:
+        save_metrics(registry, metrics_file)
 
 
 if __name__ == "__main__":
-    generate_data_store()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Создание векторной БД из PDF файлов")
+    parser.add_argument("--rebuild", action="store_true", help="Пересоздать БД полностью")
+    parser.add_argument("--metrics-file", default="", help="Сохранить время этапов в файл в формате Prometheus")
+    args = parser.parse_args()
+    try:
+        generate_data_store(rebuild=args.rebuild, metrics_file=args.metrics_file)
+    except RuntimeError as e:
+        # Новое поколение не опубликовано, сервер продолжает работать с текущим
+        print(f"{e}. БД не изменена")
+        sys.exit(1)
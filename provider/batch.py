@@ -0,0 +1,114 @@
+"""
+Пакетные ответы на вопросы из JSONL: для /chat/batch и batch_answer.py.
+Каждая строка входных данных - объект JSON с полем question, необязательным id и параметрами поиска ChatMessage.
+Векторный поиск для всех вопросов выполняется заранее одним запросом эмбеддингов и одним запросом к Chroma,
+а ответы генерируются с ограничением числа одновременных запросов и отдаются по мере готовности.
+"""
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterable, List
+
+from provider.index import ChatMessage
+from provider.limiter import QueueFullError
+from provider.ollama import (answer_events, finish_timer, prefetch_vector_search, prefetched_searches, search_filter,
+                             start_timer)
+from provider.retrieval import RetrievalParams, params_from_message
+
+
+@dataclass
+class BatchItem:
+    """Вопрос пакета"""
+    id: str
+    message: ChatMessage
+
+
+def parse_questions(lines: Iterable[str]) -> List[BatchItem]:
+    """
+    Разбирает вопросы в формате JSONL. Пустые строки пропускаются
+    :param lines: Строки входных данных
+    :return: Вопросы. Если id не указан, им становится номер строки
+    :raises ValueError: Строка не является объектом JSON с полем question
+    """
+    items = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError(f"ожидался объект JSON, получено: {type(data).__name__}")
+            item_id = str(data.pop("id", line_number))
+            items.append(BatchItem(item_id, ChatMessage(**data)))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Строка {line_number}: {e}") from None
+    return items
+
+
+async def answer_item(item: BatchItem, params: RetrievalParams) -> dict:
+    """
+    Ответ на один вопрос пакета без истории переписки.
+    Если очередь запросов к ИИ переполнена, запрос повторяется после паузы
+    :return: Результат: id, question, answer, sources, cache, elapsed_ms или id, question, error
+    """
+    start = time.perf_counter()
+    while True:
+        try:
+            timer = start_timer(item.id, "batch")
+            response_parts = []
+            sources, context = [], None
+            async for event, data in answer_events(item.message.question, [], params):
+                if event == "sources":
+                    sources = data
+                elif event == "token":
+                    response_parts.append(data)
+                elif event == "context":
+                    context = data
+            break
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            return {"id": item.id, "question": item.message.question, "error": str(e)}
+
+    answer = "".join(response_parts)
+    finish_timer(timer, context, answer, False)
+    return {"id": item.id, "question": item.message.question, "answer": answer, "sources": sources,
+            "cache": context.cache_status, "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+
+async def run_batch(items: List[BatchItem], concurrency: int) -> AsyncIterator[dict]:
+    """
+    Отвечает на вопросы пакета и отдаёт результаты по мере готовности (не в порядке вопросов).
+    Если чтение результатов прекращено, оставшиеся ответы отменяются
+    :param items: Вопросы
+    :param concurrency: Сколько вопросов обрабатывается одновременно
+    :return: Генератор результатов answer_item
+    """
+    if not items:
+        return
+    params = [params_from_message(item.message) for item in items]
+    try:
+        searches = await prefetch_vector_search([item.message.question for item in items],
+                                                [search_filter(item.message.question, item_params)
+                                                 for item, item_params in zip(items, params)],
+                                                max(item_params.fetch_k for item_params in params))
+    except Exception as e:
+        # Без заранее выполненного поиска каждый вопрос найдёт фрагменты сам
+        print(f"Не удалось выполнить поиск для пакета вопросов ({e})")
+        searches = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item: BatchItem, item_params: RetrievalParams) -> dict:
+        # Задача выполняется в своей копии контекста, поэтому значение не видно другим запросам
+        prefetched_searches.set(searches)
+        async with semaphore:
+            return await answer_item(item, item_params)
+
+    tasks = [asyncio.create_task(run(item, item_params)) for item, item_params in zip(items, params)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        for task in tasks:
+            task.cancel()
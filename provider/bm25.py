@@ -0,0 +1,178 @@
+"""
+Лексический поиск BM25 по фрагментам.
+Индекс строится в ingest.py и хранится рядом с БД Chroma в файле bm25.json.
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+BM25_FILE = "bm25.json"
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Частые окончания русских слов, от длинных к коротким
+ENDINGS = sorted("""
+    иями ями ами иях иям ого его ому ему ыми ими ией ой ей ий ый ая яя ое ее ые ие ов ев ах ях ам ям ом ем ую юю
+    ия ии ию ья ие ье ью а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+STOP_WORDS = {
+    "а", "без", "бы", "в", "во", "все", "вы", "да", "для", "до", "его", "ее", "если", "же", "за", "и", "из", "или",
+    "к", "ко", "как", "какой", "когда", "кто", "ли", "мне", "может", "мы", "на", "над", "не", "нет", "но", "о", "об",
+    "от", "по", "под", "при", "про", "с", "со", "так", "такое", "такой", "то", "у", "что", "чем", "это", "этот", "я",
+    "объясни", "расскажи", "скажи", "пожалуйста",
+}
+
+
+# Операторы сравнения фильтра по метаданным, как в where-фильтрах Chroma
+OPERATORS = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value is not None and value > target,
+    "$gte": lambda value, target: value is not None and value >= target,
+    "$lt": lambda value, target: value is not None and value < target,
+    "$lte": lambda value, target: value is not None and value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target,
+}
+
+
+def metadata_matches(metadata: dict, where: Optional[Dict[str, Any]]) -> bool:
+    """
+    Проверяет метаданные фрагмента фильтром в формате where Chroma:
+    {"lecture": 3}, {"page_number": {"$gte": 10}}, {"$and": [...]}, {"$or": [...]}
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(metadata_matches(metadata, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(metadata_matches(metadata, part) for part in condition):
+                return False
+        elif isinstance(condition, dict):
+            if not all(OPERATORS[operator](metadata.get(key), target) for operator, target in condition.items()):
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def stem(word: str) -> str:
+    """Упрощённый стемминг: отрезает одно окончание, если остаётся основа не короче трёх букв"""
+    if not word.isalpha():
+        return word
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на основы слов: нижний регистр, ё -> е, без стоп-слов. Числа и обозначения сохраняются"""
+    text = text.lower().replace("ё", "е")
+    return [stem(token) for token in TOKEN_PATTERN.findall(text) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    def __init__(self, ids: List[str], texts: List[str], metadatas: List[dict],
+                 postings: Dict[str, List[List[int]]], lengths: List[int], k1: float = 1.5, b: float = 0.75):
+        """
+        Инвертированный индекс BM25
+        :param ids: Идентификаторы фрагментов
+        :param texts: Тексты фрагментов
+        :param metadatas: Метаданные фрагментов
+        :param postings: Основа слова -> список пар [номер фрагмента, число вхождений]
+        :param lengths: Число основ в каждом фрагменте
+        """
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.postings = postings
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    @classmethod
+    def build(cls, ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[dict]) -> "BM25Index":
+        """Строит индекс по фрагментам"""
+        postings: Dict[str, List[List[int]]] = {}
+        lengths = []
+        for number, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for token, count in Counter(tokens).items():
+                postings.setdefault(token, []).append([number, count])
+        return cls(list(ids), list(texts), list(metadatas), postings, lengths)
+
+    def save(self, index_dir: str) -> None:
+        """Атомарно сохраняет индекс в каталог БД"""
+        path = os.path.join(index_dir, BM25_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas,
+                       "postings": self.postings, "lengths": self.lengths}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, index_dir: str) -> Optional["BM25Index"]:
+        """Загружает индекс из каталога БД или возвращает None, если индекса нет"""
+        path = os.path.join(index_dir, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["texts"], data["metadatas"], data["postings"], data["lengths"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int, where: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[int, float]], int]:
+        """
+        Поиск фрагментов по запросу
+        :param query: Текст запроса
+        :param k: Количество результатов
+        :param where: Фильтр по метаданным фрагментов в формате where Chroma. None - без фильтра
+        :return: Пары (номер фрагмента, оценка) по убыванию оценки и число различных основ запроса
+        """
+        terms = set(tokenize(query))
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.ids) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for number, count in postings:
+                if where and not metadata_matches(self.metadatas[number], where):
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[number] / self.average_length)
+                scores[number] = scores.get(number, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return top, len(terms)
+
+    def matched_terms(self, query: str, number: int) -> int:
+        """Сколько различных основ запроса встречается во фрагменте"""
+        return len(set(tokenize(query)) & set(tokenize(self.texts[number])))
+
+    def document(self, number: int) -> Document:
+        """Фрагмент по номеру"""
+        return Document(id=self.ids[number], page_content=self.texts[number], metadata=self.metadatas[number])
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60) -> List[str]:
+    """
+    Объединяет несколько ранжированных списков идентификаторов: оценка = сумма 1 / (k + позиция)
+    :param rankings: Списки идентификаторов, каждый по убыванию релевантности
+    :param k: Сглаживающая константа
+    :return: Идентификаторы по убыванию общей оценки
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for position, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + position + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,310 @@
+"""
+Кэши в памяти сервера.
+В кэше ответов ИИ повторный вопрос находится по хэшу нормализованного текста, похожий вопрос - по косинусной близости
+эмбеддингов при совпадении найденных фрагментов.
+"""
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+# Файл в каталоге БД с версией индекса. Перезаписывается при каждом запуске ingest.py
+INDEX_VERSION_FILE = "index_version"
+
+
+def normalize_question(question: str) -> str:
+    """Приводит вопрос к нормальной форме: нижний регистр, ё -> е, без лишних пробелов и знаков в конце"""
+    question = question.lower().replace("ё", "е")
+    question = re.sub(r"\s+", " ", question)
+    return question.strip(" ?!.,;:")
+
+
+def question_hash(question: str) -> str:
+    """SHA-256 от нормализованного вопроса"""
+    return hashlib.sha256(normalize_question(question).encode()).hexdigest()
+
+
+def write_index_version(chroma_path: str) -> str:
+    """
+    Записывает новую версию индекса в каталог БД. Все ответы, закэшированные для старой версии, становятся недействительными.
+    :param chroma_path: Путь к каталогу БД
+    :return: Новая версия индекса
+    """
+    version = uuid.uuid4().hex
+    with open(os.path.join(chroma_path, INDEX_VERSION_FILE), "w", encoding="utf-8") as f:
+        f.write(version)
+    return version
+
+
+def read_index_version(chroma_path: str) -> str:
+    """Текущая версия индекса или пустая строка, если БД создана без неё"""
+    try:
+        with open(os.path.join(chroma_path, INDEX_VERSION_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        """
+        Простой LRU-кэш в памяти
+        :param max_size: Максимальное число записей
+        """
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, object]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        """Значение по ключу или None"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value) -> None:
+        """Сохраняет значение, вытесняя самую давно использованную запись"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов"""
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+@dataclass
+class CacheEntry:
+    """Закэшированный ответ на вопрос"""
+    key: str
+    embedding: Optional[np.ndarray]
+    chunk_ids: Tuple[str, ...]
+    answer: str
+    sources: List[dict]
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def size(self) -> int:
+        """Примерный объём записи в байтах"""
+        embedding_size = self.embedding.nbytes if self.embedding is not None else 0
+        return len(self.answer.encode()) + embedding_size + 64 * (len(self.chunk_ids) + len(self.sources) + 1)
+
+
+class AnswerCache:
+    def __init__(self, index_version: str, similarity_threshold: float = 0.95, ttl: float = 86400,
+                 max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024, persist_path: str = "",
+                 persist_interval: float = 60):
+        """
+        LRU-кэш ответов с ограничением по времени жизни и объёму
+        :param index_version: Версия индекса. При её смене кэш сбрасывается
+        :param similarity_threshold: Минимальная косинусная близость эмбеддингов похожих вопросов
+        :param ttl: Время жизни записи в секундах
+        :param max_entries: Максимальное число записей
+        :param max_bytes: Максимальный объём кэша в байтах
+        :param persist_path: Файл для сохранения кэша на диск. Пустая строка - кэш только в памяти
+        :param persist_interval: Как часто (в секундах) сохранять кэш на диск
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # Записи, сгруппированные по набору найденных фрагментов, для поиска похожих вопросов
+        self.by_chunks: Dict[Tuple[str, ...], Set[str]] = {}
+        self.size = 0
+        self.index_version = index_version
+        self._last_save = time.time()
+        # Фоновое сохранение на диск, чтобы put не блокировал цикл событий сервера
+        self._save_thread: Optional[threading.Thread] = None
+        self._save_lock = threading.Lock()
+
+        # Число поисков ответа: каждый начинается с get_exact, get_similar вызывается только после промаха get_exact
+        self.lookups = 0
+        self.hits_exact = 0
+        self.hits_similar = 0
+        self.evictions = 0
+
+        self.load()
+
+    def set_index_version(self, version: str) -> None:
+        """Сбрасывает кэш, если сервер переключился на индекс другой версии"""
+        if version != self.index_version:
+            self.clear()
+            self.index_version = version
+
+    def _remove(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        keys = self.by_chunks.get(entry.chunk_ids)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_chunks[entry.chunk_ids]
+
+    def _is_expired(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.created_at > self.ttl
+
+    def clear(self) -> None:
+        """Удаляет все записи"""
+        self.entries.clear()
+        self.by_chunks.clear()
+        self.size = 0
+
+    def get_exact(self, question: str) -> Optional[CacheEntry]:
+        """
+        Поиск ответа на точно такой же вопрос
+        :param question: Текст вопроса
+        :return: Запись кэша или None
+        """
+        self.lookups += 1
+        key = question_hash(question)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry):
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        self.hits_exact += 1
+        return entry
+
+    def get_similar(self, embedding: Sequence[float], chunk_ids: Sequence[str]) -> Optional[CacheEntry]:
+        """
+        Поиск ответа на похожий вопрос, для которого были найдены те же фрагменты
+        :param embedding: Эмбеддинг вопроса
+        :param chunk_ids: Идентификаторы найденных фрагментов
+        :return: Запись кэша или None
+        """
+        query = _normalize_vector(embedding)
+        best_key, best_similarity = None, self.similarity_threshold
+        for key in list(self.by_chunks.get(tuple(sorted(chunk_ids)), ())):
+            entry = self.entries[key]
+            if self._is_expired(entry):
+                self._remove(key)
+                continue
+            if entry.embedding is None:
+                continue
+            similarity = float(np.dot(query, entry.embedding))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+
+        if best_key is None:
+            return None
+        self.entries.move_to_end(best_key)
+        self.hits_similar += 1
+        return self.entries[best_key]
+
+    def put(self, question: str, embedding: Optional[Sequence[float]], chunk_ids: Sequence[str],
+            answer: str, sources: List[dict]) -> None:
+        """
+        Сохраняет ответ в кэш
+        :param question: Текст вопроса
+        :param embedding: Эмбеддинг вопроса
+        :param chunk_ids: Идентификаторы фрагментов, по которым сгенерирован ответ
+        :param answer: Ответ ИИ
+        :param sources: Источники ответа
+        """
+        key = question_hash(question)
+        if key in self.entries:
+            self._remove(key)
+
+        entry = CacheEntry(key=key,
+                           embedding=_normalize_vector(embedding) if embedding is not None else None,
+                           chunk_ids=tuple(sorted(chunk_ids)),
+                           answer=answer,
+                           sources=sources)
+        self.entries[key] = entry
+        self.by_chunks.setdefault(entry.chunk_ids, set()).add(key)
+        self.size += entry.size
+
+        # Вытесняем самые давно использованные записи
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        if self.persist_path and time.time() - self._last_save >= self.persist_interval:
+            self.save_in_background()
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов"""
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits_exact": self.hits_exact,
+            "hits_similar": self.hits_similar,
+            "misses": self.lookups - self.hits_exact - self.hits_similar,
+            "evictions": self.evictions,
+        }
+
+    def save(self) -> None:
+        """Сохраняет кэш на диск, если задан persist_path"""
+        if self.persist_path:
+            self._write({"index_version": self.index_version, "entries": list(self.entries.values())})
+
+    def save_in_background(self) -> None:
+        """
+        Сохраняет кэш на диск в отдельном потоке. Список записей копируется сразу, а запись файла
+        (до max_bytes) выполняется в потоке. Если предыдущее сохранение ещё идёт, новое не начинается
+        """
+        if not self.persist_path or (self._save_thread is not None and self._save_thread.is_alive()):
+            return
+        # Время обновляется сразу, чтобы следующие put не запускали сохранение, пока идёт это
+        self._last_save = time.time()
+        snapshot = {"index_version": self.index_version, "entries": list(self.entries.values())}
+        self._save_thread = threading.Thread(target=self._write, args=(snapshot,), daemon=True)
+        self._save_thread.start()
+
+    def _write(self, data: dict) -> None:
+        with self._save_lock:
+            try:
+                directory = os.path.dirname(self.persist_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                tmp_path = self.persist_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(data, f)
+                os.replace(tmp_path, self.persist_path)
+            except OSError as e:
+                print(f"Не удалось сохранить кэш ответов {self.persist_path}: {e}")
+            self._last_save = time.time()
+
+    def load(self) -> None:
+        """Загружает кэш с диска, если файл существует и построен для текущей версии индекса"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print(f"Не удалось загрузить кэш ответов {self.persist_path}: {e}")
+            return
+        if data.get("index_version") != self.index_version:
+            return
+        for entry in data["entries"]:
+            if self._is_expired(entry):
+                continue
+            self.entries[entry.key] = entry
+            self.by_chunks.setdefault(entry.chunk_ids, set()).add(entry.key)
+            self.size += entry.size
+
+
+def _normalize_vector(vector: Sequence[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
@@ -0,0 +1,198 @@
+"""
+Компактный индекс фрагментов для просмотра и поиска без загрузки БД Chroma.
+Строится в ingest.py и хранится в каталоге БД (chunk_index/):
+- records.npy - по записи на фрагмент: идентификатор, файл, страница и смещения текста и метаданных в chunks.bin;
+- chunks.bin - тексты и метаданные (JSON) фрагментов в UTF-8 подряд, читается через mmap;
+- trigram_keys.npy, trigram_offsets.npy, trigram_postings.npy - инвертированный индекс триграмм
+  для поиска подстроки: триграмма -> номера фрагментов, в которых она встречается;
+- sources.json - пути до файлов-источников.
+Все массивы открываются через mmap, поэтому индекс открывается мгновенно при любом числе фрагментов.
+"""
+import json
+import mmap
+import os
+import shutil
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CHUNK_INDEX_DIR = "chunk_index"
+
+RECORD_DTYPE = np.dtype([
+    ("id", "S64"),
+    ("source", np.int32),
+    ("page", np.int32),
+    ("text_offset", np.int64),
+    ("text_length", np.int32),
+    ("meta_offset", np.int64),
+    ("meta_length", np.int32),
+])
+
+
+def trigram_codes(text: str) -> np.ndarray:
+    """
+    Коды различных триграмм текста в нижнем регистре.
+    Код триграммы - три кода символов Unicode (по 21 биту) в одном int64
+    """
+    chars = np.frombuffer(text.lower().encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    if len(chars) < 3:
+        return np.empty(0, dtype=np.int64)
+    return np.unique((chars[:-2] << 42) | (chars[1:-1] << 21) | chars[2:])
+
+
+def page_number(metadata: dict) -> int:
+    """Номер страницы, начиная с 1"""
+    return int(metadata.get("page_number", metadata.get("page", 0) + 1))
+
+
+def build_chunk_index(index_dir: str, ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[dict]) -> None:
+    """
+    Строит индекс фрагментов и атомарно заменяет им старый.
+    Фрагменты упорядочиваются по файлу и странице
+    :param index_dir: Каталог БД
+    :param ids: Идентификаторы фрагментов
+    :param texts: Тексты фрагментов
+    :param metadatas: Метаданные фрагментов
+    """
+    order = sorted(range(len(ids)), key=lambda i: (metadatas[i].get("source", ""), page_number(metadatas[i])))
+    sources = sorted({metadata.get("source", "") for metadata in metadatas})
+    source_numbers = {source: number for number, source in enumerate(sources)}
+
+    target = os.path.join(index_dir, CHUNK_INDEX_DIR)
+    tmp_dir = target + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    records = np.zeros(len(order), dtype=RECORD_DTYPE)
+    codes, numbers = [], []
+    offset = 0
+    with open(os.path.join(tmp_dir, "chunks.bin"), "wb") as blob:
+        for number, i in enumerate(order):
+            text = texts[i].encode()
+            metadata = json.dumps(metadatas[i], ensure_ascii=False).encode()
+            blob.write(text)
+            blob.write(metadata)
+            records[number] = (ids[i].encode(), source_numbers[metadatas[i].get("source", "")],
+                               page_number(metadatas[i]), offset, len(text), offset + len(text), len(metadata))
+            offset += len(text) + len(metadata)
+
+            chunk_codes = trigram_codes(texts[i])
+            codes.append(chunk_codes)
+            numbers.append(np.full(len(chunk_codes), number, dtype=np.int32))
+
+    codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+    numbers = np.concatenate(numbers) if numbers else np.empty(0, dtype=np.int32)
+    # Сортировка по триграмме, внутри - по номеру фрагмента
+    by_code = np.lexsort((numbers, codes))
+    codes, numbers = codes[by_code], numbers[by_code]
+    keys, starts = np.unique(codes, return_index=True)
+
+    np.save(os.path.join(tmp_dir, "records.npy"), records)
+    np.save(os.path.join(tmp_dir, "trigram_keys.npy"), keys)
+    np.save(os.path.join(tmp_dir, "trigram_offsets.npy"), np.append(starts, len(codes)).astype(np.int64))
+    np.save(os.path.join(tmp_dir, "trigram_postings.npy"), numbers)
+    with open(os.path.join(tmp_dir, "sources.json"), "w", encoding="utf-8") as f:
+        json.dump(sources, f, ensure_ascii=False)
+
+    # Каталог нельзя заменить одним os.replace, поэтому старый индекс сначала переименовывается
+    old_dir = target + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, old_dir)
+    os.replace(tmp_dir, target)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+@dataclass
+class Chunk:
+    """Фрагмент из индекса"""
+    number: int
+    id: str
+    source: str
+    page: int
+    text: str
+    metadata: dict
+
+
+class ChunkIndex:
+    def __init__(self, path: str):
+        """
+        Индекс фрагментов, открытый через mmap
+        :param path: Каталог индекса (chunk_index в каталоге БД)
+        """
+        self.path = path
+        self.records = np.load(os.path.join(path, "records.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(path, "trigram_keys.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "trigram_offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(path, "trigram_postings.npy"), mmap_mode="r")
+        with open(os.path.join(path, "sources.json"), encoding="utf-8") as f:
+            self.sources: List[str] = json.load(f)
+        self._blob_file = open(os.path.join(path, "chunks.bin"), "rb")
+        size = os.fstat(self._blob_file.fileno()).st_size
+        self.blob = mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @classmethod
+    def open(cls, index_dir: str) -> Optional["ChunkIndex"]:
+        """Открывает индекс из каталога БД или возвращает None, если индекса нет"""
+        path = os.path.join(index_dir, CHUNK_INDEX_DIR)
+        if not os.path.exists(os.path.join(path, "records.npy")):
+            return None
+        return cls(path)
+
+    def close(self) -> None:
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self._blob_file.close()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def text(self, number: int) -> str:
+        """Текст фрагмента по номеру (с 0)"""
+        record = self.records[number]
+        offset = int(record["text_offset"])
+        return self.blob[offset:offset + int(record["text_length"])].decode()
+
+    def chunk(self, number: int) -> Chunk:
+        """Фрагмент по номеру (с 0)"""
+        record = self.records[number]
+        offset = int(record["meta_offset"])
+        metadata = json.loads(self.blob[offset:offset + int(record["meta_length"])].decode())
+        return Chunk(number=number, id=record["id"].decode(), source=self.sources[int(record["source"])],
+                     page=int(record["page"]), text=self.text(number), metadata=metadata)
+
+    def _candidates(self, term: str) -> Sequence[int]:
+        """Номера фрагментов, содержащих все триграммы запроса"""
+        codes = trigram_codes(term)
+        if not len(codes):
+            # Запрос короче триграммы - проверяем все фрагменты
+            return range(len(self))
+        positions = np.searchsorted(self.keys, codes)
+        if np.any(positions >= len(self.keys)) or np.any(self.keys[np.minimum(positions, len(self.keys) - 1)] != codes):
+            return []
+        # Начинаем с самых редких триграмм, чтобы пересечение быстро сокращалось
+        lists = sorted((self.postings[self.offsets[i]:self.offsets[i + 1]] for i in positions), key=len)
+        candidates = np.asarray(lists[0])
+        for postings in lists[1:]:
+            candidates = np.intersect1d(candidates, postings, assume_unique=True)
+            if not len(candidates):
+                break
+        return candidates.tolist()
+
+    def search(self, term: str, max_results: int = 10) -> List[Tuple[int, int]]:
+        """
+        Поиск подстроки без учёта регистра
+        :param term: Текст для поиска
+        :param max_results: Максимальное количество результатов
+        :return: Пары (номер фрагмента, позиция в тексте) в порядке номеров
+        """
+        term = term.lower()
+        results = []
+        for number in self._candidates(term):
+            position = self.text(number).lower().find(term)
+            if position != -1:
+                results.append((number, position))
+                if len(results) >= max_results:
+                    break
+        return results
@@ -0,0 +1,121 @@
+"""
+Настройки RAG-сервиса.
+Значения по умолчанию можно переопределить переменными окружения.
+"""
+import os
+
+# Путь до директории ChromaDB
+CHROMA_PATH = os.getenv("CHROMA_PATH", "./db_metadata")
+# Как часто (в секундах) сервер проверяет, не опубликовал ли ingest.py новое поколение индекса
+INDEX_POLL_INTERVAL = float(os.getenv("INDEX_POLL_INTERVAL", "5"))
+# Сколько последних поколений индекса хранит ingest.py (не меньше 3). Сервер, не успевший переключиться
+# на новое поколение, продолжает работать со старым, поэтому его нельзя удалять сразу
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", "3"))
+# Векторный поиск: "chroma" - через БД Chroma, "numpy" - по компактному индексу vector_index/ без загрузки Chroma
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+# Тип значений компактного векторного индекса, который строит ingest.py: "float16" или "int8"
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float16")
+
+# Адрес сервера Ollama. Пустая строка - адрес по умолчанию (или из переменной OLLAMA_HOST)
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL") or None
+# Адреса нескольких серверов Ollama через запятую. Запросы распределяются между ними (provider/pool.py).
+# Пустая строка - один сервер OLLAMA_BASE_URL
+OLLAMA_BASE_URLS = ([url.strip() for url in os.getenv("OLLAMA_BASE_URLS", "").split(",") if url.strip()]
+                    or [OLLAMA_BASE_URL])
+# Сколько генераций выполняет одновременно каждый сервер Ollama. 0 - без ограничения (только RAG_MAX_CONCURRENCY)
+OLLAMA_BACKEND_CONCURRENCY = int(os.getenv("OLLAMA_BACKEND_CONCURRENCY", "0"))
+# Как часто (в секундах) проверяется доступность серверов Ollama
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+# Сколько секунд ждать соединения с сервером Ollama и очередной части ответа. Сервер, не уложившийся в таймаут,
+# считается недоступным, и запрос повторяется на другом. OLLAMA_READ_TIMEOUT=0 - без ограничения
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+# Модель для ответов и модель эмбеддингов
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen3:4b")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text-v2-moe")
+# Сколько секунд Ollama держит модели в памяти после запроса. -1 - не выгружать никогда
+OLLAMA_KEEP_ALIVE = int(os.getenv("OLLAMA_KEEP_ALIVE", "1800"))
+# Размер контекста модели ответов в токенах (num_ctx). 0 - размер по умолчанию из Ollama.
+# Промпт длиннее контекста Ollama обрезает с начала, и обработанный ранее системный промпт не используется повторно
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "0"))
+# Сколько эмбеддингов вопросов хранится в памяти (LRU)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+
+# Максимальное число одновременно обрабатываемых запросов к ИИ
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "2"))
+# Максимальное число запросов, ожидающих в очереди. Остальные получают ответ 429
+RAG_MAX_QUEUE = int(os.getenv("RAG_MAX_QUEUE", "16"))
+# Через сколько секунд клиенту предлагается повторить запрос (заголовок Retry-After)
+RAG_RETRY_AFTER = int(os.getenv("RAG_RETRY_AFTER", "15"))
+
+# Сколько вопросов пакета (/chat/batch, batch_answer.py) обрабатывается одновременно.
+# Запросы пакета занимают общие места RAG_MAX_CONCURRENCY наравне с вопросами из чата
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+# Максимальное число вопросов в одном запросе к /chat/batch
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+
+# Хранилище истории переписки: "memory" - в памяти процесса, "sqlite" - в файле, общем для всех процессов uvicorn
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "memory")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "./chat_history.sqlite3")
+# Сколько последних пар «вопрос - ответ» хранится для одного чата
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "20"))
+# Через сколько секунд без сообщений чат удаляется
+HISTORY_TTL = float(os.getenv("HISTORY_TTL", "86400"))
+# Сколько чатов одновременно хранится в памяти (для HISTORY_BACKEND=memory)
+HISTORY_MAX_SESSIONS = int(os.getenv("HISTORY_MAX_SESSIONS", "10000"))
+
+# Поиск фрагментов: "hybrid" - BM25 и векторный поиск, объединённые через reciprocal rank fusion, "vector" - только векторный
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Сколько фрагментов передаётся ИИ
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "3"))
+# Сколько кандидатов берётся из каждого поиска перед объединением и отбором MMR
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "10"))
+# Отбор фрагментов через maximal marginal relevance: вместо почти одинаковых фрагментов берутся разные
+RETRIEVAL_MMR = os.getenv("RETRIEVAL_MMR", "0") == "1"
+# Баланс MMR: 1 - только близость к вопросу, 0 - только разнообразие
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.5"))
+# Минимальная косинусная близость фрагмента к вопросу. Если для первого вопроса в чате таких фрагментов нет,
+# ИИ не вызывается и возвращается ответ, что в конспектах этого нет. 0 - порог не проверяется
+RETRIEVAL_SCORE_THRESHOLD = float(os.getenv("RETRIEVAL_SCORE_THRESHOLD", "0"))
+# Константа k в формуле reciprocal rank fusion
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Если лучший фрагмент BM25 содержит все слова запроса и его оценка во столько раз выше второй,
+# векторный поиск (и запрос эмбеддинга к Ollama) пропускается. 0 - не пропускать никогда
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv("LEXICAL_FAST_PATH_MARGIN", "1.5"))
+
+# Сколько токенов может занимать промпт: системный промпт, фрагменты, история переписки и вопрос
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Среднее число символов на токен для оценки длины текста
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3"))
+
+# Кэш ответов ИИ на первые вопросы в чате
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+# Минимальная косинусная близость вопросов, при которой ответ берётся из кэша
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# Время жизни ответа в кэше в секундах
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Файл для сохранения кэша между перезапусками. Пустая строка - хранить только в памяти
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+
+# Доля запросов, для которых замеряется время этапов и пишется журнал с замерами (от 0 до 1).
+# Счётчики запросов и токенов в /metrics ведутся всегда. Меняется без перезапуска через PUT /metrics/sampling
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1"))
+
+# Эмбеддинги при создании БД (ingest.py)
+# Сколько фрагментов отправляется в Ollama одним запросом
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# Сколько запросов к Ollama выполняется одновременно
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Сколько раз повторять запрос при ошибке. Пауза между попытками растёт вдвое, начиная с EMBED_RETRY_DELAY секунд
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "3"))
+EMBED_RETRY_DELAY = float(os.getenv("EMBED_RETRY_DELAY", "1"))
+# Каталог кэша эмбеддингов. Кэш не удаляется при пересоздании БД
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache")
+# Сколько процессов разбирают PDF файлы
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+# Сколько страниц одного PDF файла разбирает процесс за одну задачу
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Сколько страниц одновременно проходят разбиение, эмбеддинги и запись в БД
+PDF_PAGE_WINDOW = int(os.getenv("PDF_PAGE_WINDOW", "64"))
@@ -0,0 +1,139 @@
+"""
+Сборка контекста для промпта с ограничением по числу токенов.
+Фрагменты очищаются от повторов, последние сообщения переписки передаются дословно,
+а более старые сокращаются до списка заданных ранее вопросов или отбрасываются.
+"""
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+# Минимальная длина совпадающего текста, которую считаем перекрытием соседних фрагментов
+MIN_OVERLAP = 20
+# Максимальная длина перекрытия (chunk_overlap в ingest.py с запасом на пробелы)
+MAX_OVERLAP = 200
+# Сколько символов каждого старого вопроса остаётся в краткой сводке переписки
+SUMMARY_QUESTION_CHARS = 120
+
+
+def estimate_tokens(text: str, chars_per_token: float) -> int:
+    """Примерное число токенов в тексте"""
+    return math.ceil(len(text) / chars_per_token) if text else 0
+
+
+def _overlap(left: str, right: str) -> int:
+    """Длина самого длинного окончания left, с которого начинается right"""
+    for size in range(min(len(left), len(right), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def deduplicate_documents(documents: List[Document]) -> List[Document]:
+    """
+    Убирает повторы фрагментов и перекрывающийся текст соседних фрагментов одного файла
+    :param documents: Фрагменты в порядке релевантности
+    :return: Фрагменты в том же порядке без повторяющегося текста
+    """
+    kept: List[Document] = []
+    seen_ids = set()
+    for document in documents:
+        if document.id is not None and document.id in seen_ids:
+            continue
+        text = document.page_content
+        for other in kept:
+            if other.metadata.get("source") != document.metadata.get("source"):
+                continue
+            if text in other.page_content:
+                text = ""
+                break
+            # Фрагмент продолжает уже выбранный или предшествует ему
+            text = text[_overlap(other.page_content, text):]
+            overlap = _overlap(text, other.page_content)
+            if overlap:
+                text = text[:-overlap]
+        if not text.strip():
+            continue
+        seen_ids.add(document.id)
+        kept.append(document if text == document.page_content else
+                    Document(id=document.id, page_content=text, metadata=document.metadata))
+    return kept
+
+
+def summarize_history(messages: List[BaseMessage]) -> str:
+    """Краткая сводка старой переписки: только вопросы пользователя"""
+    questions = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            question = " ".join(str(message.content).split())
+            if len(question) > SUMMARY_QUESTION_CHARS:
+                question = question[:SUMMARY_QUESTION_CHARS] + "..."
+            questions.append(f"- {question}")
+    if not questions:
+        return ""
+    return "Ранее в этом чате студент спрашивал:\n" + "\n".join(questions)
+
+
+class ContextBuilder:
+    def __init__(self, token_budget: int, chars_per_token: float, system_prompt: str,
+                 format_document: Optional[Callable[[Document], str]] = None):
+        """
+        :param token_budget: Сколько токенов может занимать промпт (без ответа модели)
+        :param chars_per_token: Среднее число символов на токен для оценки длины текста
+        :param system_prompt: Текст системного промпта без контекста
+        :param format_document: Текст фрагмента в том виде, в котором он попадает в промпт (с подписью источника).
+            None - только текст фрагмента
+        """
+        self.token_budget = token_budget
+        self.chars_per_token = chars_per_token
+        self.system_tokens = estimate_tokens(system_prompt, chars_per_token)
+        self.format_document = format_document or (lambda document: document.page_content)
+
+    def tokens(self, text: str) -> int:
+        return estimate_tokens(text, self.chars_per_token)
+
+    def build(self, documents: List[Document], history: List[BaseMessage],
+              question: str) -> Tuple[List[Document], List[BaseMessage], Dict[str, int]]:
+        """
+        Подбирает фрагменты и историю переписки, которые помещаются в бюджет токенов.
+        Фрагменты важнее истории: они отбрасываются, начиная с наименее релевантного, только если не помещаются сами.
+        :param documents: Найденные фрагменты в порядке релевантности
+        :param history: История переписки
+        :param question: Вопрос пользователя
+        :return: Фрагменты, история и оценка числа токенов по частям промпта
+        """
+        remaining = self.token_budget - self.system_tokens - self.tokens(question)
+
+        documents = deduplicate_documents(documents)
+        document_tokens = [self.tokens(self.format_document(document)) for document in documents]
+        while len(documents) > 1 and sum(document_tokens) > remaining:
+            documents, document_tokens = documents[:-1], document_tokens[:-1]
+        remaining -= sum(document_tokens)
+
+        # Последние пары «вопрос - ответ» целиком, пока помещаются
+        kept_from = len(history)
+        history_tokens = 0
+        while kept_from >= 2:
+            turn_tokens = sum(self.tokens(str(message.content)) for message in history[kept_from - 2:kept_from])
+            if history_tokens + turn_tokens > remaining:
+                break
+            history_tokens += turn_tokens
+            kept_from -= 2
+        prompt_history = list(history[kept_from:])
+
+        # Более старые сообщения заменяем сводкой, если она помещается
+        summary = summarize_history(history[:kept_from])
+        summary_tokens = self.tokens(summary)
+        if summary and history_tokens + summary_tokens <= remaining:
+            prompt_history.insert(0, SystemMessage(content=summary))
+            history_tokens += summary_tokens
+
+        tokens = {
+            "system": self.system_tokens,
+            "documents": sum(document_tokens),
+            "history": history_tokens,
+            "question": self.tokens(question),
+        }
+        tokens["total"] = sum(tokens.values())
+        return documents, prompt_history, tokens
@@ -0,0 +1,135 @@
+"""
+Кэш эмбеддингов на диске.
+Векторы хранятся в одном файле float32, который читается через memory map, а индекс (хэш текста -> номер строки)
+лежит рядом в JSON. Ключи, добавленные после сохранения индекса, дописываются в журнал keys.log, поэтому запись
+пакета не переписывает весь индекс. close() переносит журнал в индекс. Для каждой модели эмбеддингов используется
+свой каталог.
+"""
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.json"
+KEYS_LOG_FILE = "keys.log"
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, model: str):
+        """
+        Открывает (или создаёт) кэш эмбеддингов модели
+        :param path: Корневой каталог кэша
+        :param model: Название модели эмбеддингов
+        """
+        self.model = model
+        self.directory = os.path.join(path, re.sub(r"[^\w.-]", "_", model))
+        self.vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        self.index_path = os.path.join(self.directory, INDEX_FILE)
+        self.log_path = os.path.join(self.directory, KEYS_LOG_FILE)
+        self.dim: Optional[int] = None
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self._vectors: Optional[np.memmap] = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            self.dim = index["dim"]
+            self.keys = index["keys"]
+            self.rows = {key: row for row, key in enumerate(self.keys)}
+        if self.dim is not None and os.path.exists(self.log_path):
+            self._read_log()
+
+        # Отбрасываем векторы, записанные после последнего сохранения ключей (например, при сбое)
+        expected_size = len(self.keys) * (self.dim or 0) * 4
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != expected_size:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(expected_size)
+
+    def _read_log(self) -> None:
+        """
+        Добавляет ключи из журнала. Векторы записываются раньше ключей, поэтому ключ без вектора или
+        недописанная последняя строка означают сбой при записи и пропускаются
+        """
+        rows_on_disk = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n") or len(self.keys) >= rows_on_disk:
+                    break
+                key = line.rstrip("\n")
+                # Ключ мог попасть и в индекс, если сбой случился между сохранением индекса и удалением журнала
+                if key not in self.rows:
+                    self.rows[key] = len(self.keys)
+                    self.keys.append(key)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Все векторы кэша в виде матрицы, отображённой в память"""
+        if self._vectors is None or len(self._vectors) != len(self.keys):
+            if not self.keys:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                      shape=(len(self.keys), self.dim))
+        return self._vectors
+
+    def missing(self, keys: Iterable[str]) -> List[str]:
+        """Ключи, для которых ещё нет вектора, без повторов"""
+        return [key for key in dict.fromkeys(keys) if key not in self.rows]
+
+    def get(self, keys: Sequence[str]) -> np.ndarray:
+        """
+        Векторы по ключам
+        :param keys: Хэши текстов
+        :return: Матрица векторов в порядке ключей
+        """
+        return np.asarray(self.vectors[[self.rows[key] for key in keys]])
+
+    def add(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """
+        Дописывает векторы в конец файла, а их ключи - в журнал
+        :param keys: Хэши текстов
+        :param vectors: Векторы в том же порядке
+        """
+        new = [(key, vector) for key, vector in zip(keys, vectors) if key not in self.rows]
+        if not new:
+            return
+        matrix = np.asarray([vector for _, vector in new], dtype=np.float32)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Размерность эмбеддингов {matrix.shape[1]} не совпадает с кэшем ({self.dim})")
+
+        with open(self.vectors_path, "ab") as f:
+            f.write(matrix.tobytes())
+        first = not os.path.exists(self.index_path)
+        for key, _ in new:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        if first:
+            # Первый индекс хранит размерность векторов, без которой журнал нельзя прочитать
+            self._save_index()
+        else:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write("".join(key + "\n" for key, _ in new))
+
+    def close(self) -> None:
+        """Сохраняет индекс со всеми ключами и удаляет журнал"""
+        if os.path.exists(self.log_path):
+            self._save_index()
+            os.remove(self.log_path)
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model, "dim": self.dim, "keys": self.keys}, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,193 @@
+"""
+Поколения индекса для обновления БД без остановки сервера.
+ingest.py создаёт каждое новое состояние БД в отдельном каталоге generations/<имя> внутри CHROMA_PATH
+вместе с манифестом, индексом BM25, индексом фрагментов и версией индекса, а затем атомарно записывает имя
+поколения в файл current. Сервер замечает новое поколение, открывает его в фоне, переключает на него новые запросы
+и закрывает старое, когда завершатся запросы, которые его используют.
+Если файла current нет, БД находится прямо в CHROMA_PATH (как до появления поколений).
+"""
+import asyncio
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+CURRENT_FILE = "current"
+GENERATIONS_DIR = "generations"
+# Меньше трёх поколений хранить нельзя: если два запуска ingest.py уложатся в интервал проверки сервера,
+# сервер может ещё использовать поколение, предшествовавшее предыдущему
+MIN_KEEP_GENERATIONS = 3
+
+
+def read_current(root: str) -> str:
+    """Имя текущего поколения или пустая строка, если БД создана без поколений"""
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def generation_path(root: str, name: str) -> str:
+    """Каталог поколения. Для пустого имени - сам каталог БД"""
+    return os.path.join(root, GENERATIONS_DIR, name) if name else root
+
+
+def current_path(root: str) -> str:
+    """Каталог текущего поколения БД"""
+    return generation_path(root, read_current(root))
+
+
+def create_generation(root: str, copy_from: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Создаёт каталог нового поколения
+    :param root: Каталог БД
+    :param copy_from: Каталог поколения, содержимое которого копируется в новое. None - пустое поколение
+    :return: Имя и каталог нового поколения
+    """
+    name = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    path = generation_path(root, name)
+    if copy_from is None:
+        os.makedirs(path)
+    else:
+        # При копировании из каталога БД без поколений пропускаем сами поколения
+        shutil.copytree(copy_from, path, ignore=shutil.ignore_patterns(GENERATIONS_DIR, CURRENT_FILE,
+                                                                       CURRENT_FILE + ".tmp"))
+    return name, path
+
+
+def publish_generation(root: str, name: str) -> None:
+    """Атомарно делает поколение текущим"""
+    path = os.path.join(root, CURRENT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp_path, path)
+
+
+def remove_generations(root: str, keep: int) -> None:
+    """
+    Удаляет старые поколения, кроме keep последних и текущего. Старые поколения ещё может использовать сервер,
+    который не успел переключиться на новое
+    :param root: Каталог БД
+    :param keep: Сколько последних поколений сохранить (не меньше MIN_KEEP_GENERATIONS)
+    """
+    generations_dir = os.path.join(root, GENERATIONS_DIR)
+    if not os.path.isdir(generations_dir):
+        return
+    # Имя поколения начинается с времени создания, поэтому сортировка по имени - это сортировка по времени
+    names = sorted(os.listdir(generations_dir))
+    kept = set(names[-max(keep, MIN_KEEP_GENERATIONS):]) | {read_current(root)}
+    for name in names:
+        if name not in kept:
+            # Файлы, открытые другим процессом, в Windows удалить нельзя - удалим при следующем запуске
+            shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+
+
+class IndexGeneration:
+    def __init__(self, name: str, path: str, db, bm25, version: str, collection=None):
+        """
+        Открытое поколение индекса
+        :param name: Имя поколения (пустое для БД без поколений)
+        :param path: Каталог поколения
+        :param db: БД Chroma или None, если векторный поиск идёт по компактному индексу
+        :param bm25: Индекс BM25 или None
+        :param version: Версия индекса для сброса кэша ответов
+        :param collection: Объект с методами query и get коллекции Chroma. None - коллекция из db
+        """
+        self.name = name
+        self.path = path
+        self.db = db
+        self.collection = collection if collection is not None else db._collection
+        self.bm25 = bm25
+        self.version = version
+        # Сколько запросов сейчас используют поколение
+        self.users = 0
+        # Поколение заменено новым и закрывается, когда его перестанут использовать
+        self.retired = False
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db._client.close()
+        else:
+            self.collection.close()
+        print(f"Поколение индекса {self.name or '(без поколений)'} закрыто")
+
+
+class IndexManager:
+    def __init__(self, root: str, opener: Callable[[str, str], IndexGeneration],
+                 on_swap: Optional[Callable[[IndexGeneration], None]] = None):
+        """
+        Текущее поколение индекса с подменой без остановки сервера
+        :param root: Каталог БД
+        :param opener: Открывает поколение по имени и каталогу
+        :param on_swap: Вызывается в цикле событий после переключения на новое поколение
+        """
+        self.root = root
+        self.opener = opener
+        self.on_swap = on_swap
+        self.swaps = 0
+        self._lock = threading.Lock()
+        # Поколение, которое не удалось открыть. Повторно его не открываем
+        self._failed = ""
+        name = read_current(root)
+        self.current = opener(name, generation_path(root, name))
+
+    @contextmanager
+    def acquire(self) -> Iterator[IndexGeneration]:
+        """Текущее поколение. Пока оно используется, оно не закрывается, даже если появилось новое"""
+        with self._lock:
+            generation = self.current
+            generation.users += 1
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                generation.users -= 1
+                drained = generation.retired and not generation.users
+            if drained:
+                generation.close()
+
+    def check(self) -> bool:
+        """
+        Переключается на новое поколение, если ingest.py его опубликовал. Поколение открывается до переключения,
+        поэтому запросы не ждут открытия БД. Выполняется в отдельном потоке
+        :return: Было ли переключение
+        """
+        name = read_current(self.root)
+        if name == self.current.name or name == self._failed:
+            return False
+        try:
+            generation = self.opener(name, generation_path(self.root, name))
+        except Exception as e:
+            self._failed = name
+            print(f"Не удалось открыть поколение индекса {name}: {e}")
+            return False
+
+        with self._lock:
+            old = self.current
+            self.current = generation
+            old.retired = True
+            drained = not old.users
+            self.swaps += 1
+        if drained:
+            old.close()
+        print(f"Индекс переключён на поколение {name}")
+        return True
+
+    async def watch(self, interval: float) -> None:
+        """Проверяет появление нового поколения каждые interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.check) and self.on_swap is not None:
+                    self.on_swap(self.current)
+            except Exception as e:
+                print(f"Ошибка при проверке поколения индекса: {e}")
+
+    def stats(self) -> dict:
+        """Текущее поколение и число переключений"""
+        return {"generation": self.current.name, "version": self.current.version, "swaps": self.swaps}
@@ -0,0 +1,198 @@
+"""
+Хранилище истории переписки пользователей с ИИ.
+Поддерживается хранение в памяти процесса (LRU) и в SQLite, которое можно использовать из нескольких процессов uvicorn.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Deque, List, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+
+class SessionStore(ABC):
+    def __init__(self, max_turns: int, ttl: float):
+        """
+        :param max_turns: Сколько последних пар «вопрос - ответ» хранится для одного чата
+        :param ttl: Через сколько секунд без сообщений чат удаляется
+        """
+        self.max_turns = max_turns
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, session_id: str) -> List[BaseMessage]:
+        """История переписки чата, от старых сообщений к новым"""
+
+    @abstractmethod
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        """Добавляет в историю чата вопрос пользователя и ответ ИИ"""
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Удаляет чаты без сообщений дольше ttl. Возвращает число удалённых чатов"""
+
+    async def aget(self, session_id: str) -> List[BaseMessage]:
+        """get для вызова из цикла событий"""
+        return self.get(session_id)
+
+    async def aappend(self, session_id: str, question: str, answer: str) -> None:
+        """append для вызова из цикла событий"""
+        self.append(session_id, question, answer)
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, max_turns: int, ttl: float, max_sessions: int):
+        """
+        История в памяти процесса
+        :param max_sessions: Сколько чатов хранится одновременно. Давно неактивные вытесняются
+        """
+        super().__init__(max_turns, ttl)
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, Tuple[Deque[BaseMessage], float]]" = OrderedDict()
+
+    def get(self, session_id: str) -> List[BaseMessage]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return []
+        messages, last_seen = session
+        if time.time() - last_seen > self.ttl:
+            del self.sessions[session_id]
+            return []
+        return list(messages)
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        session = self.sessions.pop(session_id, None)
+        messages = session[0] if session is not None else deque(maxlen=2 * self.max_turns)
+        messages.append(HumanMessage(content=question))
+        messages.append(AIMessage(content=answer))
+        self.sessions[session_id] = (messages, time.time())
+
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        self.purge_expired()
+
+    def purge_expired(self) -> int:
+        deadline = time.time() - self.ttl
+        expired = 0
+        # Чаты упорядочены по времени последнего сообщения
+        while self.sessions:
+            session_id, (_, last_seen) = next(iter(self.sessions.items()))
+            if last_seen > deadline:
+                break
+            del self.sessions[session_id]
+            expired += 1
+        return expired
+
+
+class SQLiteSessionStore(SessionStore):
+    # Как часто (в секундах) удалять устаревшие чаты при добавлении сообщений
+    PURGE_INTERVAL = 600
+
+    def __init__(self, max_turns: int, ttl: float, path: str):
+        """
+        История в файле SQLite в режиме WAL
+        :param path: Путь к файлу БД
+        """
+        super().__init__(max_turns, ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                last_seen REAL NOT NULL,
+                next_seq INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+        """)
+
+    def get(self, session_id: str) -> List[BaseMessage]:
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT m.role, m.content FROM messages m JOIN sessions s ON s.session_id = m.session_id
+                WHERE m.session_id = ? AND s.last_seen > ?
+                ORDER BY m.seq
+            """, (session_id, time.time() - self.ttl)).fetchall()
+        return [HumanMessage(content=content) if role == "human" else AIMessage(content=content)
+                for role, content in rows]
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        now = time.time()
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT next_seq FROM sessions WHERE session_id = ?",
+                                         (session_id,)).fetchone()
+                seq = row[0] if row is not None else 0
+                connection.execute("""
+                    INSERT INTO sessions (session_id, last_seen, next_seq) VALUES (?, ?, ?)
+                    ON CONFLICT (session_id) DO UPDATE SET last_seen = excluded.last_seen, next_seq = excluded.next_seq
+                """, (session_id, now, seq + 2))
+                connection.executemany("INSERT INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                                       [(session_id, seq, "human", question), (session_id, seq + 1, "ai", answer)])
+                # Оставляем только последние max_turns пар сообщений
+                connection.execute("DELETE FROM messages WHERE session_id = ? AND seq < ?",
+                                   (session_id, seq + 2 - 2 * self.max_turns))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        deadline = time.time() - self.ttl
+        with self._lock:
+            self._last_purge = time.time()
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("""
+                    DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_seen <= ?)
+                """, (deadline,))
+                expired = connection.execute("DELETE FROM sessions WHERE last_seen <= ?", (deadline,)).rowcount
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return expired
+
+    # Запись может ждать блокировку файла до 30 с, пока пишут другие процессы uvicorn,
+    # поэтому запросы к SQLite выполняются в отдельном потоке и не останавливают цикл событий
+    async def aget(self, session_id: str) -> List[BaseMessage]:
+        return await asyncio.to_thread(self.get, session_id)
+
+    async def aappend(self, session_id: str, question: str, answer: str) -> None:
+        await asyncio.to_thread(self.append, session_id, question, answer)
+
+
+def create_session_store(backend: str, max_turns: int, ttl: float, max_sessions: int, path: str) -> SessionStore:
+    """
+    Создаёт хранилище истории по названию
+    :param backend: "memory" или "sqlite"
+    :param max_turns: Сколько последних пар «вопрос - ответ» хранится для одного чата
+    :param ttl: Через сколько секунд без сообщений чат удаляется
+    :param max_sessions: Сколько чатов хранится в памяти (для "memory")
+    :param path: Путь к файлу БД (для "sqlite")
+    :return: SessionStore
+    """
+    if backend == "memory":
+        return MemorySessionStore(max_turns, ttl, max_sessions)
+    if backend == "sqlite":
+        return SQLiteSessionStore(max_turns, ttl, path)
+    raise ValueError(f"Неизвестное хранилище истории: {backend}")
@@ -1,5 +1,18 @@
-from pydantic import BaseModel
+from typing import Optional
+
+from pydantic import BaseModel, Field
 
 
 class ChatMessage(BaseModel):
-    question: str
\ No newline at end of file
+    question: str
+    # Параметры поиска фрагментов. None - значение из настроек сервера
+    k: Optional[int] = Field(None, ge=1, le=20, description="Сколько фрагментов передаётся ИИ")
+    fetch_k: Optional[int] = Field(None, ge=1, le=100, description="Сколько кандидатов берётся из каждого поиска")
+    mmr: Optional[bool] = Field(None, description="Отбор разнообразных фрагментов (maximal marginal relevance)")
+    lambda_mult: Optional[float] = Field(None, ge=0, le=1, description="Баланс MMR: 1 - близость, 0 - разнообразие")
+    score_threshold: Optional[float] = Field(None, ge=0, le=1, description="Минимальная косинусная близость фрагмента")
+    # Фильтры по метаданным фрагментов
+    file: Optional[str] = Field(None, description="Имя файла конспекта, например konspket-part1.pdf")
+    lecture: Optional[int] = Field(None, ge=0, description="Номер лекции")
+    page_from: Optional[int] = Field(None, ge=1, description="Первая страница")
+    page_to: Optional[int] = Field(None, ge=1, description="Последняя страница")
@@ -0,0 +1,92 @@
+"""
+Ограничение числа одновременных запросов к ИИ с очередью ожидания.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+
+class QueueFullError(Exception):
+    """Очередь запросов переполнена, запрос нужно повторить позже"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Очередь запросов переполнена, повторите через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class Reservation:
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        """
+        Место в очереди, занятое до начала обработки запроса (ConcurrencyLimiter.reserve).
+        Место освобождается, когда запрос получает слот, или через release, если обработка так и не началась
+        """
+        self._limiter = limiter
+        self._held = True
+        # Место передано в ConcurrencyLimiter.slot и освобождается там
+        self.claimed = False
+
+    def _free(self) -> None:
+        if self._held:
+            self._held = False
+            self._limiter.waiting -= 1
+
+    def release(self) -> None:
+        """Освобождает место, если запрос так и не дошёл до обработки (например, клиент отключился)"""
+        if not self.claimed:
+            self._free()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrency: int, max_queue: int, retry_after: int):
+        """
+        Ограничитель одновременных запросов
+        :param max_concurrency: Сколько запросов обрабатывается одновременно
+        :param max_queue: Сколько запросов может ожидать своей очереди
+        :param retry_after: Рекомендуемая пауза перед повтором запроса в секундах
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def is_full(self) -> bool:
+        """Все места заняты и очередь заполнена"""
+        return self.active >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def check(self) -> None:
+        """Выбрасывает QueueFullError, если новый запрос не поместится в очередь"""
+        if self.is_full():
+            raise QueueFullError(self.retry_after)
+
+    def reserve(self) -> Reservation:
+        """
+        Сразу занимает место в очереди, не дожидаясь обработки. Нужно, чтобы отказ (QueueFullError) был известен
+        до начала потокового ответа: между проверкой и началом потока очередь могут заполнить другие запросы
+        :return: Место в очереди для slot
+        """
+        self.check()
+        self.waiting += 1
+        return Reservation(self)
+
+    @asynccontextmanager
+    async def slot(self, reservation: Optional[Reservation] = None) -> AsyncIterator[None]:
+        """
+        Занимает место для обработки запроса, при необходимости ожидая в очереди
+        :param reservation: Место, занятое заранее через reserve. Такой запрос уже принят, и очередь не проверяется
+        """
+        if reservation is None:
+            reservation = self.reserve()
+        reservation.claimed = True
+        try:
+            await self._semaphore.acquire()
+        finally:
+            reservation._free()
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
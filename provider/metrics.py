@@ -0,0 +1,237 @@
+"""
+Метрики сервиса в текстовом формате Prometheus и замеры времени этапов обработки запросов.
+Замеры этапов выполняются только для выбранной доли запросов (sampling), долю можно менять без перезапуска сервера.
+"""
+import json
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Границы корзин для числа токенов
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        """
+        :param name: Имя метрики
+        :param help: Описание метрики
+        :param labelnames: Имена меток
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        """Строки значений метрики в формате Prometheus"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self.values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, function: Callable[[], float]):
+        """
+        Значение, которое вычисляется в момент чтения метрик
+        :param function: Функция, возвращающая текущее значение
+        """
+        super().__init__(name, help)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.function())}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        :param buckets: Верхние границы корзин по возрастанию
+        """
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # Метки -> (счётчики корзин, сумма, количество)
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Набор метрик, которые отдаются вместе"""
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, function: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class Sampler:
+    def __init__(self, rate: float):
+        """
+        Выбор запросов для подробных замеров
+        :param rate: Доля запросов от 0 (замеры выключены) до 1 (все запросы)
+        """
+        self.rate = 0.0
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        if not 0 <= rate <= 1:
+            raise ValueError("Доля запросов должна быть от 0 до 1")
+        self.rate = rate
+
+    def sample(self) -> bool:
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+
+class StageTimer:
+    def __init__(self, histogram: Histogram, sampled: bool = True, **fields):
+        """
+        Замеры времени этапов одного запроса или одного запуска ingest.py
+        :param histogram: Гистограмма с меткой stage, в которую записывается время этапов
+        :param sampled: Выполнять ли замеры. Если нет, этапы не замеряются и журнал не пишется
+        :param fields: Поля для журнала, например chat_id
+        """
+        self.histogram = histogram
+        self.sampled = sampled
+        self.fields = fields
+        self.stages: Dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Замеряет время этапа"""
+        if not self.sampled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        """Записывает время этапа, измеренное отдельно"""
+        if not self.sampled:
+            return
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.histogram.observe(seconds, stage=name)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def log(self, event: str, **fields) -> None:
+        """Выводит строку JSON с временем этапов в миллисекундах"""
+        if not self.sampled:
+            return
+        record = {"event": event, **self.fields, **fields, "total_ms": round(self.elapsed() * 1000, 1),
+                  "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}}
+        print(json.dumps(record, ensure_ascii=False))
+
+
+# Таймер текущего запроса. Позволяет замерять этапы во вложенных функциях, не передавая таймер явно
+current_timer: ContextVar[Optional[StageTimer]] = ContextVar("current_timer", default=None)
+
+
+def stage(name: str):
+    """Замер этапа текущего запроса. Вне запроса ничего не делает"""
+    timer = current_timer.get()
+    return timer.stage(name) if timer is not None else nullcontext()
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """Записывает время этапа текущего запроса, измеренное отдельно. Вне запроса ничего не делает"""
+    timer = current_timer.get()
+    if timer is not None:
+        timer.record(name, seconds)
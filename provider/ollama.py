@@ -1,65 +1,607 @@
-from langchain_chroma import Chroma
-from langchain_core.prompts import  ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_ollama import OllamaEmbeddings, OllamaLLM
+import asyncio
+import json
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import replace
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.documents import Document
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
+from provider.cache import AnswerCache, LRUCache, normalize_question, question_hash, read_index_version
+from provider.config import (CHROMA_PATH, OLLAMA_BASE_URLS, LLM_MODEL, EMBEDDING_MODEL, OLLAMA_KEEP_ALIVE,
+                             OLLAMA_NUM_CTX, OLLAMA_BACKEND_CONCURRENCY, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT,
+                             QUERY_EMBEDDING_CACHE_SIZE,
+                             RAG_MAX_CONCURRENCY, RAG_MAX_QUEUE, RAG_RETRY_AFTER, ANSWER_CACHE_ENABLED,
+                             ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES,
+                             ANSWER_CACHE_MAX_BYTES, ANSWER_CACHE_PATH, HISTORY_BACKEND, HISTORY_DB_PATH,
+                             HISTORY_MAX_TURNS, HISTORY_TTL, HISTORY_MAX_SESSIONS, CONTEXT_TOKEN_BUDGET,
+                             CONTEXT_CHARS_PER_TOKEN, RETRIEVAL_MODE, RRF_K, LEXICAL_FAST_PATH_MARGIN,
+                             METRICS_SAMPLE_RATE, VECTOR_BACKEND)
+from provider.bm25 import BM25Index, reciprocal_rank_fusion
+from provider.context import ContextBuilder, estimate_tokens
+from provider.generations import IndexGeneration, IndexManager
+from provider.history import create_session_store
 from provider.index import ChatMessage
+from provider.limiter import ConcurrencyLimiter, Reservation
+from provider.pool import OllamaPool, PooledOllamaEmbeddings, PooledOllamaLLM
+from provider.prompt import (QUESTION_PROMPT, SYSTEM_PROMPT, citation, document_prompt, format_document,
+                             prompt_template)
+from provider.metrics import TOKEN_BUCKETS, MetricsRegistry, Sampler, StageTimer, current_timer, record_stage, stage
+from provider.retrieval import (NO_MATCHING_FRAGMENTS_ANSWER, NOT_IN_COURSE_ANSWER, RetrievalParams,
+                                cosine_similarities, maximal_marginal_relevance, params_from_message, question_filter)
+from provider.singleflight import SingleFlight
+from provider.vector_index import VectorIndex
 
-CHROMA_PATH = "./db_metadata"
-# Инициализируем модель Gemma3 для ответов и mxbai-embed для обработки файлов
-model = OllamaLLM(model="qwen3:4b", temperature=0.1)
-embedding_function = OllamaEmbeddings(model="nomic-embed-text-v2-moe")
-# Подготовка БД
-db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
-# Переменная, в которой содержится переписка пользователя с ИИ
-chat_history = {}
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            """
-                [INST]Ты помощник по изучению курса физики, который проходят студенты УрФУ. 
-                Твоя цель - это помогать студентам по физике, предлагая параграфы/страницы из учебных пособий, которые загружены в базу знаний.
-                Сейчас я даю тебе 3 файла, из которых нужно брать информацию и на них ссылаться. В первой находятся содержание этих двух конспектов. Остальные файлы сами конспекты, которыми нужно делиться.
-                В конце лекций есть вопросы по этим лекциям. Если студент просит помочь ответить на вопросы, то ты находишь эти вопросы и объясняешь ему, как ответить на эти вопросы.
-                Вот твои ограничения:
-                1. Ты не решаешь задачи за студентов, а объясняешь. Если он просит решить, то говори, что не делаешь этого и объясни, как решать задачу.
-                2. Ты используешь базу знаний. Нельзя ссылаться на другие источники.
-                3. Ты отвечаешь только по вопросам, связанные с физикой. Если спрашивает про другой предмет, отказывайся от ответа. Если вопрос связан с физикой и другим предметом, то ответь только про физику.
-                Вот, что твой ответ должен содержать:
-                1. Ты должен объяснить максимально подробно непонятную студенту тему вопроса, ссылаясь на конспекты, которые в базе знаний.
-                2. Указываешь лекцию, которую ты используешь для ответа, чтобы студент мог прочитать больше про тему вопроса и изучить материал сам. Не генерируй ссылки.
-                3. Используй кодировку UTF-8 в написаниях ответов и формул
-                4. Побольше цитируй конспекты, чтобы ответ был как можно подробным.
-                5. Ты пишешь, откуда взял информацию, а именно какой конспект (файл konspekt-part1.pdf или konspekt-part2.pdf) и на какой странице находится информация?
-                6. Отправляешь ему эту ссылку с архивом конспектов, чтобы он мог прочитать их. Отправляй ссылку как есть. Не изменяй её, не дополняй. Другие ссылки не отправлять. Вот ссылка (не дополняй её): "https://storage.yandexcloud.net/easy-physics/notes.zip"
-                7. Ссылку "https://storage.yandexcloud.net/easy-physics/notes.zip" никак не меняй. Цифры не дописывай. Ссылку не трогай. Отправь её только один раз в конце своего ответа.[/INST]
-                [INST]Отвечай на вопрос, основываясь только на следующем контексте:
-                {context}[/INST]
-            """
-        ),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{question}")
-    ]
-)
-
-document_chain = create_stuff_documents_chain(llm=model, prompt=prompt_template)
-
-
-def query_rag(message: ChatMessage, session_id: str = "") -> str:
+# Серверы Ollama, между которыми распределяются запросы к моделям
+llm_pool = OllamaPool(OLLAMA_BASE_URLS, OLLAMA_BACKEND_CONCURRENCY, connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                      read_timeout=OLLAMA_READ_TIMEOUT)
+# Инициализируем модель для ответов и модель эмбеддингов для поиска по БД
+model = PooledOllamaLLM(pool=llm_pool, model=LLM_MODEL, temperature=0.1, keep_alive=OLLAMA_KEEP_ALIVE,
+                        num_ctx=OLLAMA_NUM_CTX or None)
+if OLLAMA_NUM_CTX and OLLAMA_NUM_CTX < CONTEXT_TOKEN_BUDGET:
+    print(f"OLLAMA_NUM_CTX={OLLAMA_NUM_CTX} меньше CONTEXT_TOKEN_BUDGET={CONTEXT_TOKEN_BUDGET}: "
+          f"длинные промпты будут обрезаны, а системный промпт будет обрабатываться заново")
+embedding_function = PooledOllamaEmbeddings(llm_pool, EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE)
+# Эмбеддинги уже встречавшихся вопросов
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+
+
+def open_generation(name: str, path: str) -> IndexGeneration:
+    """
+    Открывает поколение индекса: БД Chroma (или компактный векторный индекс при VECTOR_BACKEND=numpy)
+    и индекс BM25, построенные ingest.py.
+    Пробный поиск по вектору из самой БД загружает векторный индекс в память без запроса к Ollama
+    """
+    db = None
+    collection = VectorIndex.open(path) if VECTOR_BACKEND == "numpy" else None
+    if collection is None:
+        if VECTOR_BACKEND == "numpy":
+            print(f"Векторный индекс не найден в {path}, поиск идёт через Chroma. Запустите ingest.py, чтобы построить его")
+        # langchain_chroma и chromadb импортируются около секунды и не нужны при VECTOR_BACKEND=numpy
+        from langchain_chroma import Chroma
+        db = Chroma(persist_directory=path, embedding_function=embedding_function)
+        collection = db._collection
+    sample = collection.get(limit=1, include=["embeddings"])
+    if sample["ids"]:
+        collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1)
+    return IndexGeneration(name, path, db, BM25Index.load(path), read_index_version(path), collection)
+
+
+# Подготовка БД. Новые поколения индекса подключаются без перезапуска сервера (см. provider/generations.py)
+index_manager = IndexManager(CHROMA_PATH, open_generation,
+                             on_swap=lambda generation: answer_cache.set_index_version(generation.version))
+# Хранилище, в котором содержится переписка пользователя с ИИ
+chat_history = create_session_store(HISTORY_BACKEND,
+                                    max_turns=HISTORY_MAX_TURNS,
+                                    ttl=HISTORY_TTL,
+                                    max_sessions=HISTORY_MAX_SESSIONS,
+                                    path=HISTORY_DB_PATH)
+# Ограничение числа одновременных запросов к ИИ
+rag_limiter = ConcurrencyLimiter(RAG_MAX_CONCURRENCY, RAG_MAX_QUEUE, RAG_RETRY_AFTER)
+# Кэш ответов на первые вопросы в чате
+answer_cache = AnswerCache(index_manager.current.version,
+                           similarity_threshold=ANSWER_CACHE_SIMILARITY,
+                           ttl=ANSWER_CACHE_TTL,
+                           max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                           max_bytes=ANSWER_CACHE_MAX_BYTES,
+                           persist_path=ANSWER_CACHE_PATH)
+# Выполняющиеся генерации ответов на первые вопросы в чатах. Одинаковые вопросы получают общий ответ
+in_flight = SingleFlight()
+# Метрики для /metrics и выбор запросов для замеров времени этапов
+metrics = MetricsRegistry()
+metrics_sampler = Sampler(METRICS_SAMPLE_RATE)
+rag_requests_total = metrics.counter("rag_requests_total", "Обработанные запросы к ИИ", ["mode", "cache"])
+rag_rejected_total = metrics.counter("rag_rejected_total", "Запросы, отклонённые из-за переполненной очереди")
+rag_request_seconds = metrics.histogram("rag_request_seconds", "Полное время обработки запроса к ИИ", ["mode"])
+rag_first_token_seconds = metrics.histogram("rag_first_token_seconds", "Время до первого токена потокового ответа")
+rag_stage_seconds = metrics.histogram("rag_stage_seconds", "Время этапов обработки запроса к ИИ", ["stage"])
+rag_prompt_tokens = metrics.histogram("rag_prompt_tokens", "Оценка числа токенов в промпте", buckets=TOKEN_BUCKETS)
+rag_answer_tokens_total = metrics.counter("rag_answer_tokens_total", "Оценка числа токенов в ответах ИИ")
+rag_prompt_eval_tokens = metrics.histogram("rag_prompt_eval_tokens",
+                                           "Токены промпта, которые Ollama обработала заново (без общего начала)",
+                                           buckets=TOKEN_BUCKETS)
+rag_prompt_eval_seconds = metrics.histogram("rag_prompt_eval_seconds", "Время обработки промпта в Ollama")
+rag_off_topic_total = metrics.counter("rag_off_topic_total", "Вопросы без близких фрагментов, на которые ИИ не вызывался")
+metrics.gauge("rag_queue_waiting", "Запросы, ожидающие в очереди", lambda: rag_limiter.waiting)
+metrics.gauge("rag_queue_active", "Запросы в обработке", lambda: rag_limiter.active)
+metrics.gauge("rag_in_flight", "Выполняющиеся генерации, к которым могут присоединиться одинаковые вопросы",
+              lambda: len(in_flight))
+metrics.gauge("rag_ollama_backends_healthy", "Доступные серверы Ollama", lambda: llm_pool.healthy)
+metrics.gauge("rag_ollama_outstanding", "Выполняющиеся запросы к серверам Ollama", lambda: llm_pool.outstanding)
+rag_ollama_failovers_total = metrics.counter("rag_ollama_failovers_total",
+                                             "Запросы, повторённые на другом сервере Ollama, по отказавшему серверу",
+                                             ["backend"])
+llm_pool.on_failover = lambda backend: rag_ollama_failovers_total.inc(backend=backend.name)
+document_chain = create_stuff_documents_chain(llm=model, prompt=prompt_template, document_prompt=document_prompt)
+# Результаты векторного поиска, выполненного заранее для пакета вопросов (prefetch_vector_search):
+# (поколение индекса, нормализованный вопрос, фильтр) -> (эмбеддинг, фрагменты, векторы, сколько фрагментов запрашивалось)
+prefetched_searches: ContextVar[Optional[Dict[Tuple[str, str, str], tuple]]] = ContextVar("prefetched_searches",
+                                                                                    default=None)
+# Подбор фрагментов и истории переписки под бюджет токенов
+context_builder = ContextBuilder(CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN, SYSTEM_PROMPT + QUESTION_PROMPT,
+                                 format_document=format_document)
+
+
+def get_sources(documents: List[Document]) -> List[dict]:
+    """
+    Краткое описание найденных фрагментов для отображения пользователю.
+    :param documents: Список фрагментов, найденных в БД
+    :return: Список словарей с названием файла и номером страницы
+    """
+    sources = []
+    for document in documents:
+        source = document.metadata.get("source_file") or os.path.basename(document.metadata.get("source", "Неизвестно"))
+        page = document.metadata.get("page_number", document.metadata.get("page", 0) + 1)
+        sources.append({"source": source, "page": page})
+    return sources
+
+
+async def embed_question(question: str) -> List[float]:
+    """Эмбеддинг вопроса. Для уже встречавшихся вопросов берётся из кэша без запроса к Ollama"""
+    key = normalize_question(question)
+    query_embedding = query_embedding_cache.get(key)
+    if query_embedding is None:
+        with stage("embed"):
+            query_embedding = await embedding_function.aembed_query(question)
+        query_embedding_cache.put(key, query_embedding)
+    return query_embedding
+
+
+async def embed_questions(questions: Sequence[str]) -> List[List[float]]:
+    """Эмбеддинги нескольких вопросов. Вопросы, которых нет в кэше, отправляются в Ollama одним запросом"""
+    keys = [normalize_question(question) for question in questions]
+    missing = {}
+    for key, question in zip(keys, questions):
+        if query_embedding_cache.get(key) is None:
+            missing.setdefault(key, question)
+    if missing:
+        with stage("embed"):
+            embeddings = await embedding_function.aembed_documents(list(missing.values()))
+        for key, query_embedding in zip(missing, embeddings):
+            query_embedding_cache.put(key, query_embedding)
+    return [query_embedding_cache.get(key) for key in keys]
+
+
+async def warm_up() -> None:
+    """
+    Прогрев перед приёмом запросов: загружает обе модели в память каждого сервера Ollama с keep_alive
+    и открывает коллекцию Chroma и индекс BM25. Достаточно, чтобы ответил хотя бы один сервер:
+    остальные помечаются недоступными до следующей проверки пула.
+    """
+    # Запрос генерации без промпта только загружает модель. Размер контекста тот же, что у запросов,
+    # иначе Ollama перезагрузит модель при первом вопросе
+    options = {"num_ctx": OLLAMA_NUM_CTX} if OLLAMA_NUM_CTX else None
+    await llm_pool.broadcast(lambda client: client.generate(model=LLM_MODEL, keep_alive=OLLAMA_KEEP_ALIVE,
+                                                            options=options))
+    responses = await llm_pool.broadcast(lambda client: client.embed(model=EMBEDDING_MODEL, input=["прогрев"],
+                                                                     keep_alive=OLLAMA_KEEP_ALIVE))
+    query_embedding = list(responses[0].embeddings[0])
+    with index_manager.acquire() as index:
+        await asyncio.to_thread(index.collection.query, query_embeddings=[query_embedding], n_results=1)
+
+
+async def vector_search(index: IndexGeneration, question: str, k: int,
+                        where: Optional[dict] = None) -> Tuple[List[float], List[Document], np.ndarray]:
+    """
+    Асинхронный векторный поиск фрагментов в БД Chroma или компактном векторном индексе.
+    Эмбеддинг вопроса запрашивается у Ollama асинхронно, а поиск выполняется в отдельном потоке,
+    чтобы не блокировать цикл событий.
+    :param index: Поколение индекса
+    :param question: Текст вопроса
+    :param k: Количество фрагментов
+    :param where: Фильтр по метаданным фрагментов в формате where Chroma. None - без фильтра
+    :return: Эмбеддинг вопроса, список найденных фрагментов и их векторы
+    """
+    prefetched = prefetched_searches.get()
+    hit = prefetched.get(search_key(index, question, where)) if prefetched else None
+    if hit is not None and hit[3] >= k:
+        query_embedding, documents, vectors, _ = hit
+        return query_embedding, documents[:k], vectors[:k]
+
+    query_embedding = await embed_question(question)
+    with stage("vector_search"):
+        result = await asyncio.to_thread(index.collection.query, query_embeddings=[query_embedding], n_results=k,
+                                         where=where, include=["documents", "metadatas", "embeddings"])
+    return query_embedding, *query_result_documents(result, 0)
+
+
+def search_key(index: IndexGeneration, question: str, where: Optional[dict]) -> Tuple[str, str, str]:
+    """Ключ заранее выполненного векторного поиска"""
+    return index.name, normalize_question(question), json.dumps(where, sort_keys=True, ensure_ascii=False)
+
+
+def query_result_documents(result: dict, row: int) -> Tuple[List[Document], np.ndarray]:
+    """Фрагменты и их векторы для одного вектора запроса из результата collection.query"""
+    documents = [Document(id=doc_id, page_content=text, metadata=metadata or {})
+                 for doc_id, text, metadata in zip(result["ids"][row], result["documents"][row],
+                                                   result["metadatas"][row])]
+    return documents, np.asarray(result["embeddings"][row], dtype=np.float32)
+
+
+async def prefetch_vector_search(questions: Sequence[str], wheres: Sequence[Optional[dict]],
+                                 k: int) -> Dict[Tuple[str, str, str], tuple]:
+    """
+    Векторный поиск сразу для пакета вопросов: эмбеддинги вычисляются одним запросом к Ollama,
+    а поиск в Chroma выполняется одним запросом для всех вопросов с одинаковым фильтром.
+    Результат нужно передать в prefetched_searches, тогда vector_search возьмёт его оттуда
+    :param questions: Тексты вопросов
+    :param wheres: Фильтр по метаданным для каждого вопроса
+    :param k: Сколько фрагментов найти для каждого вопроса
+    :return: Словарь для prefetched_searches
+    """
+    embeddings = await embed_questions(questions)
+    groups: Dict[str, List[int]] = {}
+    for i, where in enumerate(wheres):
+        groups.setdefault(json.dumps(where, sort_keys=True, ensure_ascii=False), []).append(i)
+
+    searches = {}
+    with index_manager.acquire() as index:
+        for where_key, indices in groups.items():
+            result = await asyncio.to_thread(index.collection.query,
+                                             query_embeddings=[embeddings[i] for i in indices],
+                                             n_results=k, where=json.loads(where_key),
+                                             include=["documents", "metadatas", "embeddings"])
+            for row, i in enumerate(indices):
+                documents, vectors = query_result_documents(result, row)
+                searches[search_key(index, questions[i], wheres[i])] = (embeddings[i], documents, vectors, k)
+    return searches
+
+
+def document_vectors(index: IndexGeneration, documents: List[Document], known: dict) -> np.ndarray:
+    """Векторы фрагментов. Векторы, которых нет в known, запрашиваются у векторного индекса"""
+    missing = [document.id for document in documents if document.id not in known]
+    if missing:
+        data = index.collection.get(ids=missing, include=["embeddings"])
+        known = {**known, **dict(zip(data["ids"], data["embeddings"]))}
+    return np.asarray([known[document.id] for document in documents], dtype=np.float32)
+
+
+async def retrieve(question: str,
+                   params: Optional[RetrievalParams] = None) -> Tuple[Optional[List[float]], List[Document], bool]:
+    """
+    Поиск фрагментов для ответа.
+    В гибридном режиме результаты BM25 и векторного поиска объединяются через reciprocal rank fusion.
+    Если BM25 находит фрагмент, явно лучший остальных и содержащий все слова запроса,
+    векторный поиск не выполняется и эмбеддинг не запрашивается.
+    Фрагменты векторного поиска с близостью ниже порога отбрасываются. Если не остаётся ни одного, возвращается
+    пустой список. При включённом MMR из fetch_k кандидатов отбираются k разнообразных
+    :param question: Текст вопроса
+    :param params: Параметры поиска. None - параметры из настроек сервера
+    :return: Эмбеддинг вопроса (None, если он не вычислялся), список найденных фрагментов и были ли
+        подходящие под фильтр фрагменты до отсечения по порогу близости
+    """
+    # Весь поиск выполняется по одному поколению индекса, даже если во время поиска появилось новое
+    with index_manager.acquire() as index:
+        return await search_index(index, question, params or RetrievalParams())
+
+
+async def search_index(index: IndexGeneration, question: str,
+                       params: RetrievalParams) -> Tuple[Optional[List[float]], List[Document], bool]:
+    """Поиск фрагментов в поколении индекса (см. retrieve)"""
+    bm25_index = index.bm25 if RETRIEVAL_MODE == "hybrid" else None
+    lexical = []
+    if bm25_index is not None:
+        with stage("bm25"):
+            lexical, term_count = bm25_index.search(question, params.fetch_k, params.where)
+            # Для MMR нужны векторы фрагментов, поэтому векторный поиск не пропускается
+            fast_path = (LEXICAL_FAST_PATH_MARGIN > 0 and not params.mmr and lexical and term_count
+                         and bm25_index.matched_terms(question, lexical[0][0]) == term_count
+                         and (len(lexical) == 1 or lexical[0][1] >= LEXICAL_FAST_PATH_MARGIN * lexical[1][1]))
+        if fast_path:
+            return None, [bm25_index.document(number) for number, _ in lexical[:params.k]], True
+
+    fetch_k = params.fetch_k if lexical or params.mmr else params.k
+    query_embedding, vector_documents, vectors = await vector_search(index, question, fetch_k, params.where)
+    matched = bool(lexical) or len(vector_documents) > 0
+    if params.score_threshold > 0 and len(vector_documents):
+        keep = cosine_similarities(query_embedding, vectors) >= params.score_threshold
+        vector_documents = [document for document, kept in zip(vector_documents, keep) if kept]
+        vectors = vectors[keep]
+        if not vector_documents:
+            return query_embedding, [], matched
+
+    candidates = vector_documents
+    if lexical:
+        documents = {document.id: document for document in vector_documents}
+        for number, _ in lexical:
+            documents.setdefault(bm25_index.ids[number], bm25_index.document(number))
+        ranking = reciprocal_rank_fusion([[document.id for document in vector_documents],
+                                          [bm25_index.ids[number] for number, _ in lexical]], RRF_K)
+        candidates = [documents[doc_id] for doc_id in ranking[:params.fetch_k]]
+
+    if not params.mmr:
+        return query_embedding, candidates[:params.k], matched
+    with stage("mmr"):
+        known = {document.id: vector for document, vector in zip(vector_documents, vectors)}
+        candidate_vectors = await asyncio.to_thread(document_vectors, index, candidates, known)
+        selected = maximal_marginal_relevance(query_embedding, candidate_vectors, params.k, params.lambda_mult)
+    return query_embedding, [candidates[i] for i in selected], matched
+
+
+def build_prompt_input(context: "RagContext", history: list) -> dict:
+    """
+    Входные данные для document_chain в пределах бюджета токенов. Оценка числа токенов сохраняется в context.tokens
+    :param context: Подготовленные фрагменты
+    :param history: Полная история переписки
+    :return: Словарь с контекстом, вопросом и историей
+    """
+    with stage("prompt"):
+        documents, prompt_history, tokens = context_builder.build(context.documents, history, context.question)
+        documents = [Document(id=document.id, page_content=document.page_content,
+                              metadata={**document.metadata, "citation": citation(document.metadata)})
+                     for document in documents]
+    context.tokens = tokens
+    rag_prompt_tokens.observe(tokens["total"])
+    return {"context": documents, "question": context.question, "chat_history": prompt_history}
+
+
+class PromptEvalRecorder(AsyncCallbackHandler):
+    """Сохраняет, сколько токенов промпта Ollama обработала заново и за какое время"""
+
+    def __init__(self):
+        self.tokens: Optional[int] = None
+        self.seconds: Optional[float] = None
+
+    async def on_llm_end(self, response, **kwargs) -> None:
+        if not response.generations or not response.generations[0]:
+            return
+        info = response.generations[0][0].generation_info or {}
+        if info.get("prompt_eval_count") is not None:
+            self.tokens = info["prompt_eval_count"]
+            rag_prompt_eval_tokens.observe(self.tokens)
+        if info.get("prompt_eval_duration") is not None:
+            self.seconds = info["prompt_eval_duration"] / 1e9
+            rag_prompt_eval_seconds.observe(self.seconds)
+
+
+class RagContext:
+    """Данные, подготовленные для генерации ответа"""
+
+    def __init__(self, question: str, use_cache: bool):
+        self.question = question
+        self.use_cache = use_cache
+        # Близких к вопросу фрагментов нет - вместо генерации отдаётся NOT_IN_COURSE_ANSWER
+        self.off_topic = False
+        # В пределах явного фильтра запроса фрагментов нет - отдаётся NO_MATCHING_FRAGMENTS_ANSWER.
+        # Вопрос при этом может относиться к курсу, поэтому он не считается вопросом не по теме
+        self.no_match = False
+        self.embedding: Optional[List[float]] = None
+        self.documents: List[Document] = []
+        self.sources: List[dict] = []
+        # Ответ из кэша, если он найден
+        self.cached_answer: Optional[str] = None
+        # Результат поиска в кэше для метрик: "exact", "similar", "miss" или "off"
+        self.cache_status = "miss" if use_cache else "off"
+        # Оценка числа токенов в промпте по частям
+        self.tokens: dict = {}
+        # Сколько токенов промпта Ollama обработала заново и за сколько миллисекунд
+        self.prompt_eval: dict = {}
+
+    def remember(self, answer: str) -> None:
+        """Сохраняет сгенерированный ответ в кэш"""
+        if self.use_cache:
+            answer_cache.put(self.question, self.embedding, [document.id for document in self.documents],
+                             answer, self.sources)
+
+
+def search_filter(question: str, params: RetrievalParams) -> Optional[dict]:
+    """Фильтр поиска: заданный в параметрах, а если его нет - по лекции, упомянутой в вопросе"""
+    return params.where if params.where is not None else question_filter(question)
+
+
+async def prepare_context(question: str, history: list, params: Optional[RetrievalParams] = None) -> RagContext:
+    """
+    Ищет ответ в кэше, а если его нет - находит фрагменты для генерации.
+    Кэш используется только для первого вопроса в чате с параметрами поиска по умолчанию,
+    так как последующие ответы зависят от переписки.
+    Порог близости тоже проверяется только для первого вопроса: уточняющий вопрос («а подробнее?»)
+    может быть не похож на фрагменты, но относиться к предыдущему ответу.
+    :param question: Текст вопроса
+    :param history: История переписки
+    :param params: Параметры поиска. None - параметры из настроек сервера
+    :return: RagContext
+    """
+    params = params or RetrievalParams()
+    context = RagContext(question, use_cache=ANSWER_CACHE_ENABLED and not history and params.is_default())
+
+    if context.use_cache:
+        with stage("cache_lookup"):
+            entry = answer_cache.get_exact(question)
+        if entry is not None:
+            context.cached_answer, context.sources = entry.answer, entry.sources
+            context.cache_status = "exact"
+            return context
+
+    if history:
+        params = replace(params, score_threshold=0)
+    where = search_filter(question, params)
+    context.embedding, context.documents, matched = await retrieve(question, replace(params, where=where))
+    if params.where is None and where and not context.documents:
+        # БД создана без метаданных лекций или такой лекции нет - ищем по всем фрагментам
+        context.embedding, context.documents, matched = await retrieve(question, params)
+    context.sources = get_sources(context.documents)
+    # Пустой результат при явном фильтре - это «под фильтр ничего не подходит», только если фрагментов не было
+    # и до отсечения по порогу. Иначе вопрос далёк от найденных фрагментов, как и без фильтра
+    context.no_match = not context.documents and params.where is not None and not matched
+    context.off_topic = not context.documents and params.score_threshold > 0 and not context.no_match
+
+    if context.use_cache and context.embedding is not None and context.documents:
+        with stage("cache_lookup"):
+            entry = answer_cache.get_similar(context.embedding, [document.id for document in context.documents])
+        if entry is not None:
+            context.cached_answer = entry.answer
+            context.cache_status = "similar"
+    return context
+
+
+def start_timer(session_id: str, mode: str) -> StageTimer:
+    """
+    Начинает замеры времени этапов запроса. Этапы во вложенных функциях замеряются через provider.metrics.stage
+    :param session_id: Идентификатор сеанса для журнала
+    :param mode: "json" или "stream"
+    :return: StageTimer
+    """
+    timer = StageTimer(rag_stage_seconds, metrics_sampler.sample(), chat_id=session_id, mode=mode)
+    current_timer.set(timer)
+    return timer
+
+
+def finish_timer(timer: StageTimer, context: RagContext, response_text: str, coalesced: bool) -> None:
+    """Обновляет счётчики запроса и пишет журнал с временем этапов"""
+    mode = timer.fields["mode"]
+    cache_status = "coalesced" if coalesced else context.cache_status
+    answer_tokens = estimate_tokens(response_text, CONTEXT_CHARS_PER_TOKEN)
+    rag_requests_total.inc(mode=mode, cache=cache_status)
+    rag_request_seconds.observe(timer.elapsed(), mode=mode)
+    if not coalesced:
+        rag_answer_tokens_total.inc(answer_tokens)
+    timer.log("rag_request", cache=cache_status, documents=len(context.documents),
+              prompt_tokens=context.tokens, prompt_eval=context.prompt_eval, answer_tokens=answer_tokens)
+
+
+async def answer_events(question: str, history: list, params: Optional[RetrievalParams] = None,
+                        reservation: Optional[Reservation] = None) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Поиск фрагментов и генерация ответа с ограничением числа одновременных запросов к ИИ.
+    :param question: Текст вопроса
+    :param history: История переписки
+    :param params: Параметры поиска. None - параметры из настроек сервера
+    :param reservation: Место в очереди, занятое заранее (start_rag). None - занять при запуске
+    :return: Генератор пар (тип события, данные): ("sources", list), ("token", str) и последним ("context", RagContext)
+    """
+    queued = time.perf_counter()
+    async with rag_limiter.slot(reservation):
+        record_stage("queue", time.perf_counter() - queued)
+        context = await prepare_context(question, history, params)
+        yield "sources", context.sources
+
+        if context.cached_answer is not None:
+            yield "token", context.cached_answer
+        elif context.off_topic:
+            rag_off_topic_total.inc()
+            yield "token", NOT_IN_COURSE_ANSWER
+        elif context.no_match:
+            yield "token", NO_MATCHING_FRAGMENTS_ANSWER
+        else:
+            # Генерирует ответ на основе промпта по частям
+            response_parts = []
+            prompt_input = build_prompt_input(context, history)
+            recorder = PromptEvalRecorder()
+            with stage("generate"):
+                async for token in document_chain.astream(prompt_input, config={"callbacks": [recorder]}):
+                    response_parts.append(token)
+                    yield "token", token
+            if recorder.tokens is not None:
+                context.prompt_eval = {"tokens": recorder.tokens,
+                                       "ms": round(recorder.seconds * 1000, 1) if recorder.seconds is not None else None}
+            context.remember("".join(response_parts))
+    yield "context", context
+
+
+async def start_rag(message: ChatMessage, session_id: str,
+                    mode: str) -> Tuple[AsyncIterator[Tuple[str, object]], Optional[Reservation]]:
+    """
+    Принимает запрос к ИИ до начала ответа: читает историю переписки и сразу занимает место в очереди.
+    Если очередь заполнена, выбрасывается QueueFullError, поэтому потоковый ответ получает 429 до начала потока.
+    Одинаковые первые вопросы в чатах, заданные одновременно, получают общий поиск фрагментов и общую генерацию.
+    Вопрос, присоединившийся к уже выполняющейся генерации, места в очереди не занимает и отказа не получает даже
+    при переполненной очереди: ради таких всплесков одинаковых вопросов генерации и объединяются.
+    :param message: Сообщение в чате
+    :param session_id: Идентификатор сеанса
+    :param mode: "json" или "stream" для метрик
+    :return: Генератор событий (см. rag_events) и место в очереди (None для присоединившегося вопроса).
+        Если генератор так и не будет прочитан, место нужно освободить через Reservation.release
+    """
+    timer = start_timer(session_id, mode)
+    params = params_from_message(message)
+    with timer.stage("history"):
+        history = await chat_history.aget(session_id)
+
+    if history:
+        # Ответ зависит от переписки, поэтому объединять такие запросы нельзя
+        reservation = rag_limiter.reserve()
+        events, coalesced = answer_events(message.question, history, params, reservation), False
+    else:
+        key = f"{question_hash(message.question)}:{params.key()}"
+        # Между проверкой и join нет await, поэтому генерация не может завершиться в промежутке.
+        # Генерация получает заранее занятое место и очередь больше не проверяет, поэтому отказ QueueFullError
+        # не может возникнуть внутри неё и дойти до присоединившихся вопросов
+        reservation = None if key in in_flight else rag_limiter.reserve()
+        flight, started = in_flight.join(key, lambda: answer_events(message.question, history, params, reservation))
+        events, coalesced = flight.subscribe(), not started
+    return rag_events(message, session_id, timer, events, coalesced, reservation), reservation
+
+
+async def rag_events(message: ChatMessage, session_id: str, timer: StageTimer,
+                     events: AsyncIterator[Tuple[str, object]], coalesced: bool,
+                     reservation: Optional[Reservation]) -> AsyncIterator[Tuple[str, object]]:
+    """
+    События ответа на вопрос, принятого start_rag.
+    История переписки записывается только после завершения генерации.
+    :param message: Сообщение в чате
+    :param session_id: Идентификатор сеанса
+    :param timer: Замеры времени этапов запроса
+    :param events: События генерации (answer_events или общей генерации)
+    :param coalesced: Запрос получает ответ чужой генерации
+    :param reservation: Место в очереди (None у присоединившегося вопроса). Освобождается, если генерация
+        так и не началась
+    :return: Генератор пар (тип события, данные): ("sources", list), ("token", str)
+    """
+    try:
+        response_parts = []
+        context = None
+        async for event, data in events:
+            if event == "context":
+                context = data
+                continue
+            if event == "token":
+                if not response_parts and timer.fields["mode"] == "stream":
+                    rag_first_token_seconds.observe(timer.elapsed())
+                response_parts.append(data)
+            yield event, data
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+    response_text = "".join(response_parts)
+    with timer.stage("history_append"):
+        await chat_history.aappend(session_id, message.question, response_text)
+    finish_timer(timer, context, response_text, coalesced)
+
+
+async def query_rag(message: ChatMessage, session_id: str = "") -> str:
     """
     RAG-запрос к БД Chroma.
     :param message: Сообщение в чате - текст для запроса к системе RAG
     :param session_id: Идентификатор сеанса str
     :return: str
     """
-    if session_id not in chat_history:
-        chat_history[session_id] = []
+    events, _ = await start_rag(message, session_id, "json")
+    response_parts = []
+    async for event, data in events:
+        if event == "token":
+            response_parts.append(data)
+    return "".join(response_parts)
+
+
+async def stream_rag(message: ChatMessage,
+                     session_id: str = "") -> Tuple[AsyncIterator[Tuple[str, object]], Optional[Reservation]]:
+    """
+    Потоковый RAG-запрос к БД Chroma.
+    Запрос принимается сразу (QueueFullError, если очередь заполнена), а события отдаёт возвращаемый генератор:
+    сначала найденные источники, затем токены ответа по мере их генерации.
+    :param message: Сообщение в чате - текст для запроса к системе RAG
+    :param session_id: Идентификатор сеанса str
+    :return: Генератор пар (тип события, данные): ("sources", list), ("token", str), ("done", None)
+        и место в очереди (см. start_rag)
+    """
+    events, reservation = await start_rag(message, session_id, "stream")
+
+    async def with_done() -> AsyncIterator[Tuple[str, object]]:
+        async for event, data in events:
+            yield event, data
+        yield "done", None
 
-    # Генерирует ответ на основе промпта
-    response_text = document_chain.invoke({"context": db.similarity_search(message.question, k=3),
-                                          "question": message.question,
-                                          "chat_history": chat_history[session_id]})
-    chat_history[session_id].append(HumanMessage(content=message.question))
-    chat_history[session_id].append(AIMessage(content=response_text))
-    return response_text
+    return with_done(), reservation
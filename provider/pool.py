@@ -0,0 +1,351 @@
+"""
+Пул серверов Ollama (OLLAMA_BASE_URLS): запросы к моделям распределяются между несколькими серверами.
+- Запрос получает доступный сервер с наименьшим числом выполняющихся запросов.
+- У каждого сервера своё ограничение одновременных генераций; если все серверы заняты, генерация ждёт.
+- Сервер, не ответивший на запрос (в том числе за время read_timeout), считается недоступным, пока фоновая
+  проверка (/api/tags) не увидит его снова.
+- Запрос к недоступному серверу повторяется на другом: генерация - только пока не получен первый токен,
+  эмбеддинги - всегда.
+- Для каждого сервера создаётся один AsyncClient и один Client, поэтому соединения HTTP используются повторно.
+"""
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import httpx
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import LLM
+from langchain_core.outputs import GenerationChunk
+from ollama import AsyncClient, Client, ResponseError
+
+# Сколько секунд ждать ответа сервера при проверке доступности
+HEALTH_TIMEOUT = 3
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """
+    Ошибка сервера, после которой запрос можно повторить на другом: нет соединения, ошибка 5xx,
+    модель не найдена (404) или очередь Ollama переполнена (429). Ошибки в самом запросе не повторяются
+    """
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500 or error.status_code in (404, 429)
+    return isinstance(error, (httpx.TransportError, ConnectionError, asyncio.TimeoutError))
+
+
+class NoBackendError(Exception):
+    """В пуле нет ни одного сервера Ollama"""
+
+
+class Backend:
+    def __init__(self, url: Optional[str], limit: int, timeout: httpx.Timeout):
+        """
+        Сервер Ollama в пуле
+        :param url: Адрес сервера. None - адрес по умолчанию (или из переменной OLLAMA_HOST)
+        :param limit: Сколько генераций сервер выполняет одновременно. 0 - без ограничения
+        :param timeout: Таймауты запросов. Без них зависший сервер держал бы запрос бесконечно, не вызывая отказа
+        """
+        self.url = url
+        self.name = url or "default"
+        self.limit = limit
+        self.client = AsyncClient(host=url, timeout=timeout)
+        # Клиент для синхронных запросов (ingest.py). httpx.Client можно использовать из нескольких потоков
+        self.sync_client = Client(host=url, timeout=timeout)
+        # Выполняющиеся запросы (генерации и эмбеддинги) и отдельно генерации
+        self.outstanding = 0
+        self.generating = 0
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def has_capacity(self) -> bool:
+        return not self.limit or self.generating < self.limit
+
+    def stats(self) -> dict:
+        return {"url": self.name, "healthy": self.healthy, "outstanding": self.outstanding,
+                "generating": self.generating, "limit": self.limit, "requests": self.requests,
+                "failures": self.failures, "last_error": self.last_error}
+
+
+class OllamaPool:
+    def __init__(self, urls: Sequence[Optional[str]], limit: int = 0, connect_timeout: float = 5,
+                 read_timeout: float = 120):
+        """
+        Пул серверов Ollama
+        :param urls: Адреса серверов
+        :param limit: Сколько генераций каждый сервер выполняет одновременно. 0 - без ограничения
+        :param connect_timeout: Сколько секунд ждать соединения с сервером
+        :param read_timeout: Сколько секунд ждать очередной части ответа (для потоковой генерации - каждого фрагмента).
+            0 - без ограничения
+        """
+        if not urls:
+            raise NoBackendError("Не задан ни один сервер Ollama")
+        timeout = httpx.Timeout(read_timeout or None, connect=connect_timeout)
+        self.backends = [Backend(url, limit, timeout) for url in urls]
+        self.failovers = 0
+        # Вызывается с сервером, запрос к которому повторён на другом (для счётчика в /metrics)
+        self.on_failover: Optional[Callable[[Backend], None]] = None
+        self._condition = asyncio.Condition()
+        # Выбор сервера и учёт запросов в синхронных вызовах из нескольких потоков
+        self._sync_lock = threading.Lock()
+        # Номер запроса: при равной загрузке серверы выбираются по очереди
+        self._turn = 0
+
+    def pick(self, exclude: Sequence[Backend] = (), generation: bool = False) -> Optional[Backend]:
+        """
+        Доступный сервер с наименьшим числом выполняющихся запросов. Если недоступны все, выбирается
+        из всех: проверка могла не успеть заметить, что сервер снова работает
+        :param exclude: Серверы, на которых запрос уже не удался
+        :param generation: Учитывать ограничение одновременных генераций
+        :return: Сервер или None, если все подходящие серверы заняты
+        """
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        candidates = [backend for backend in candidates if backend.healthy] or candidates
+        if generation:
+            candidates = [backend for backend in candidates if backend.has_capacity()]
+        if not candidates:
+            return None
+        self._turn += 1
+        count = len(self.backends)
+        return min(candidates, key=lambda backend: (backend.outstanding,
+                                                    (self.backends.index(backend) - self._turn) % count))
+
+    @asynccontextmanager
+    async def lease(self, exclude: Sequence[Backend] = (), generation: bool = False) -> AsyncIterator[Backend]:
+        """Занимает сервер на время запроса. Генерация ждёт, пока у одного из серверов не освободится место"""
+        async with self._condition:
+            backend = self.pick(exclude, generation)
+            while backend is None:
+                await self._condition.wait()
+                backend = self.pick(exclude, generation)
+            backend.outstanding += 1
+            backend.requests += 1
+            if generation:
+                backend.generating += 1
+        try:
+            yield backend
+        finally:
+            async with self._condition:
+                backend.outstanding -= 1
+                if generation:
+                    backend.generating -= 1
+                self._condition.notify_all()
+
+    def mark_failed(self, backend: Backend, error: BaseException) -> None:
+        """Помечает сервер недоступным до следующей успешной проверки"""
+        backend.failures += 1
+        backend.last_error = f"{type(error).__name__}: {error}"
+        if backend.healthy:
+            print(f"Сервер Ollama {backend.name} недоступен: {backend.last_error}")
+        backend.healthy = False
+
+    def _failed_over(self, backend: Backend) -> None:
+        self.failovers += 1
+        if self.on_failover is not None:
+            self.on_failover(backend)
+
+    async def call(self, function: Callable[[AsyncClient], Awaitable[Any]], generation: bool = False) -> Any:
+        """
+        Выполняет запрос на одном из серверов, при отказе сервера - на следующем
+        :param function: Запрос: принимает AsyncClient сервера и возвращает результат
+        :param generation: Запрос генерации, на который действует ограничение сервера
+        """
+        tried: List[Backend] = []
+        while True:
+            async with self.lease(tried, generation) as backend:
+                try:
+                    return await function(backend.client)
+                except Exception as e:
+                    if not is_backend_failure(e):
+                        raise
+                    self.mark_failed(backend, e)
+                    tried.append(backend)
+                    if len(tried) == len(self.backends):
+                        raise
+                    self._failed_over(backend)
+
+    async def generate(self, **kwargs) -> AsyncIterator[Any]:
+        """
+        Потоковая генерация (AsyncClient.generate с stream=True). Сервер меняется при отказе,
+        только пока не получен первый фрагмент ответа: начатый ответ нельзя продолжить на другом сервере
+        :return: Генератор фрагментов GenerateResponse
+        """
+        tried: List[Backend] = []
+        while True:
+            async with self.lease(tried, generation=True) as backend:
+                started = False
+                try:
+                    async for part in await backend.client.generate(stream=True, **kwargs):
+                        started = True
+                        yield part
+                    return
+                except Exception as e:
+                    if not is_backend_failure(e):
+                        raise
+                    self.mark_failed(backend, e)
+                    tried.append(backend)
+                    if started or len(tried) == len(self.backends):
+                        raise
+                    self._failed_over(backend)
+
+    async def broadcast(self, function: Callable[[AsyncClient], Awaitable[Any]]) -> List[Any]:
+        """
+        Выполняет запрос на всех серверах одновременно (например, загрузку модели при прогреве)
+        :return: Результаты серверов, ответивших без ошибки. Если ошибку вернули все, она выбрасывается
+        """
+        results = await asyncio.gather(*(function(backend.client) for backend in self.backends),
+                                       return_exceptions=True)
+        for backend, result in zip(self.backends, results):
+            if isinstance(result, Exception):
+                self.mark_failed(backend, result)
+        succeeded = [result for result in results if not isinstance(result, BaseException)]
+        if not succeeded:
+            raise results[0]
+        return succeeded
+
+    def call_sync(self, function: Callable[[Client], Any]) -> Any:
+        """
+        Синхронный вариант call для кода вне цикла событий, например потоков ingest.py.
+        Ограничение одновременных генераций здесь не действует
+        :param function: Запрос: принимает Client сервера и возвращает результат
+        """
+        tried: List[Backend] = []
+        while True:
+            with self._sync_lock:
+                backend = self.pick(tried)
+                backend.outstanding += 1
+                backend.requests += 1
+            try:
+                return function(backend.sync_client)
+            except Exception as e:
+                if not is_backend_failure(e):
+                    raise
+                with self._sync_lock:
+                    self.mark_failed(backend, e)
+                    tried.append(backend)
+                    if len(tried) == len(self.backends):
+                        raise
+                    self._failed_over(backend)
+            finally:
+                with self._sync_lock:
+                    backend.outstanding -= 1
+
+    async def check(self) -> None:
+        """Проверяет доступность всех серверов запросом списка моделей"""
+        async def probe(backend: Backend) -> None:
+            try:
+                await asyncio.wait_for(backend.client.list(), HEALTH_TIMEOUT)
+            except Exception as e:
+                self.mark_failed(backend, e)
+                return
+            if not backend.healthy:
+                print(f"Сервер Ollama {backend.name} снова доступен")
+            backend.healthy = True
+
+        await asyncio.gather(*(probe(backend) for backend in self.backends))
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def watch(self, interval: float) -> None:
+        """Проверяет доступность серверов каждые interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Ошибка при проверке серверов Ollama: {e}")
+
+    @property
+    def healthy(self) -> int:
+        return sum(backend.healthy for backend in self.backends)
+
+    @property
+    def outstanding(self) -> int:
+        return sum(backend.outstanding for backend in self.backends)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние и загрузка серверов и число повторов запросов на другом сервере"""
+        return {"healthy": self.healthy, "failovers": self.failovers,
+                "backends": [backend.stats() for backend in self.backends]}
+
+
+def _options(**options) -> Dict[str, Any]:
+    """Параметры модели без незаданных значений"""
+    return {key: value for key, value in options.items() if value is not None}
+
+
+class PooledOllamaLLM(LLM):
+    """Модель ответов для LangChain, запросы которой распределяются пулом серверов Ollama"""
+
+    pool: Any
+    model: str
+    temperature: Optional[float] = None
+    num_ctx: Optional[int] = None
+    keep_alive: Optional[Union[int, str]] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "ollama-pool"
+
+    def _request(self, prompt: str, stop: Optional[List[str]]) -> dict:
+        return {"model": self.model, "prompt": prompt, "keep_alive": self.keep_alive,
+                "options": _options(temperature=self.temperature, num_ctx=self.num_ctx, stop=stop)}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        request = self._request(prompt, stop)
+        return self.pool.call_sync(lambda client: client.generate(**request)).response
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        # Синхронный вызов нужен только вне сервера, поэтому ответ отдаётся одним фрагментом
+        chunk = GenerationChunk(text=self._call(prompt, stop, run_manager, **kwargs))
+        if run_manager:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        yield chunk
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        async for part in self.pool.generate(**self._request(prompt, stop)):
+            # Последний фрагмент несёт статистику Ollama (prompt_eval_count и др.), как у OllamaLLM
+            chunk = GenerationChunk(text=part.response or "",
+                                    generation_info=part.model_dump(exclude={"response", "context"})
+                                    if part.done else None)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join([chunk.text async for chunk in self._astream(prompt, stop, run_manager, **kwargs)])
+
+
+class PooledOllamaEmbeddings(Embeddings):
+    def __init__(self, pool: OllamaPool, model: str, keep_alive: Optional[Union[int, str]] = None):
+        """
+        Модель эмбеддингов для LangChain, запросы которой распределяются пулом серверов Ollama
+        :param pool: Пул серверов
+        :param model: Модель эмбеддингов
+        :param keep_alive: Сколько секунд Ollama держит модель в памяти после запроса
+        """
+        self.pool = pool
+        self.model = model
+        self.keep_alive = keep_alive
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return list(self.pool.call_sync(
+            lambda client: client.embed(model=self.model, input=texts, keep_alive=self.keep_alive)).embeddings)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        response = await self.pool.call(
+            lambda client: client.embed(model=self.model, input=texts, keep_alive=self.keep_alive))
+        return list(response.embeddings)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,62 @@
+"""
+Промпт для генерации ответа.
+Системный промпт не меняется от запроса к запросу, за ним идут переписка, а в последнем сообщении - найденные
+фрагменты и вопрос. Ollama хранит обработанный промпт (KV-кэш) и при следующем запросе заново обрабатывает
+только часть после общего начала: системный промпт для каждого вопроса и системный промпт с перепиской
+для уточняющих вопросов в том же чате.
+"""
+import os
+
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+
+SYSTEM_PROMPT = """
+                [INST]Ты помощник по изучению курса физики, который проходят студенты УрФУ. 
+                Твоя цель - это помогать студентам по физике, предлагая параграфы/страницы из учебных пособий, которые загружены в базу знаний.
+                Сейчас я даю тебе 3 файла, из которых нужно брать информацию и на них ссылаться. В первой находятся содержание этих двух конспектов. Остальные файлы сами конспекты, которыми нужно делиться.
+                В конце лекций есть вопросы по этим лекциям. Если студент просит помочь ответить на вопросы, то ты находишь эти вопросы и объясняешь ему, как ответить на эти вопросы.
+                Вот твои ограничения:
+                1. Ты не решаешь задачи за студентов, а объясняешь. Если он просит решить, то говори, что не делаешь этого и объясни, как решать задачу.
+                2. Ты используешь базу знаний. Нельзя ссылаться на другие источники.
+                3. Ты отвечаешь только по вопросам, связанные с физикой. Если спрашивает про другой предмет, отказывайся от ответа. Если вопрос связан с физикой и другим предметом, то ответь только про физику.
+                Вот, что твой ответ должен содержать:
+                1. Ты должен объяснить максимально подробно непонятную студенту тему вопроса, ссылаясь на конспекты, которые в базе знаний.
+                2. Указываешь лекцию, которую ты используешь для ответа, чтобы студент мог прочитать больше про тему вопроса и изучить материал сам. Не генерируй ссылки.
+                3. Используй кодировку UTF-8 в написаниях ответов и формул
+                4. Побольше цитируй конспекты, чтобы ответ был как можно подробным.
+                5. Ты пишешь, откуда взял информацию, а именно какой конспект (файл konspekt-part1.pdf или konspekt-part2.pdf) и на какой странице находится информация?
+                6. Отправляешь ему эту ссылку с архивом конспектов, чтобы он мог прочитать их. Отправляй ссылку как есть. Не изменяй её, не дополняй. Другие ссылки не отправлять. Вот ссылка (не дополняй её): "https://storage.yandexcloud.net/easy-physics/notes.zip"
+                7. Ссылку "https://storage.yandexcloud.net/easy-physics/notes.zip" никак не меняй. Цифры не дописывай. Ссылку не трогай. Отправь её только один раз в конце своего ответа.[/INST]
+"""
+# Фрагменты меняются с каждым вопросом, поэтому передаются вместе с ним после переписки
+QUESTION_PROMPT = """[INST]Отвечай на вопрос, основываясь только на следующем контексте:
+{context}[/INST]
+
+Вопрос: {question}"""
+
+prompt_template = ChatPromptTemplate.from_messages(
+    [
+        ("system", SYSTEM_PROMPT),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", QUESTION_PROMPT)
+    ]
+)
+
+# Каждый фрагмент передаётся в промпт с указанием файла, страницы, лекции и раздела, чтобы ИИ мог на них сослаться
+document_prompt = PromptTemplate.from_template("[{citation}]\n{page_content}")
+
+
+def citation(metadata: dict) -> str:
+    """Подпись фрагмента в промпте: файл, страница, лекция и раздел"""
+    source = metadata.get("source_file") or os.path.basename(metadata.get("source", "Неизвестно"))
+    parts = [source, f"стр. {metadata.get('page_number', metadata.get('page', 0) + 1)}"]
+    if metadata.get("lecture"):
+        parts.append(f"лекция {metadata['lecture']}")
+    if metadata.get("section"):
+        parts.append(f"{metadata['section']} {metadata.get('section_title', '')}".strip())
+    return ", ".join(parts)
+
+
+def format_document(document: Document) -> str:
+    """Фрагмент в том виде, в котором он попадает в промпт: с подписью и текстом"""
+    return document_prompt.format(citation=citation(document.metadata), page_content=document.page_content)
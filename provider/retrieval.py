@@ -0,0 +1,125 @@
+"""
+Параметры поиска фрагментов и отбор найденных кандидатов:
+фильтры по метаданным, порог косинусной близости и maximal marginal relevance (MMR).
+"""
+import json
+import re
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from provider.config import (HYBRID_FETCH_K, RETRIEVAL_K, RETRIEVAL_MMR, RETRIEVAL_MMR_LAMBDA,
+                             RETRIEVAL_SCORE_THRESHOLD)
+from provider.index import ChatMessage
+
+# Упоминание лекции в вопросе: "в лекции 5", "лекция №3"
+QUESTION_LECTURE_PATTERN = re.compile(r"лекци[яиюей]\s*(?:№\s*)?(\d+)", re.IGNORECASE)
+# Ответ на вопрос, для которого в конспектах не нашлось достаточно близких фрагментов
+NOT_IN_COURSE_ANSWER = ("В конспектах курса физики нет материала по этому вопросу. "
+                        "Я отвечаю только на вопросы по курсу физики - попробуйте переформулировать вопрос.")
+# Ответ на вопрос с явным фильтром (файл, лекция, страницы), в пределах которого не нашлось подходящих фрагментов
+NO_MATCHING_FRAGMENTS_ANSWER = ("В выбранной части конспектов (файл, лекция или страницы) нет подходящих фрагментов "
+                                "по этому вопросу. Попробуйте изменить или убрать фильтр.")
+
+
+@dataclass
+class RetrievalParams:
+    """Параметры поиска фрагментов для одного запроса"""
+    k: int = RETRIEVAL_K
+    fetch_k: int = HYBRID_FETCH_K
+    mmr: bool = RETRIEVAL_MMR
+    lambda_mult: float = RETRIEVAL_MMR_LAMBDA
+    score_threshold: float = RETRIEVAL_SCORE_THRESHOLD
+    # Фильтр по метаданным в формате where Chroma. None - без фильтра
+    where: Optional[dict] = field(default=None)
+
+    def __post_init__(self):
+        # Кандидатов не может быть меньше, чем фрагментов в ответе. Нормализация выполняется и для параметров
+        # по умолчанию, иначе при RETRIEVAL_K > HYBRID_FETCH_K ни один запрос не считался бы запросом по умолчанию
+        self.fetch_k = max(self.fetch_k, self.k)
+
+    def key(self) -> str:
+        """Строка, одинаковая для одинаковых параметров"""
+        return json.dumps(asdict(self), sort_keys=True, ensure_ascii=False)
+
+    def is_default(self) -> bool:
+        """Параметры из настроек сервера без фильтров"""
+        return self == RetrievalParams()
+
+
+def build_where(file: Optional[str] = None, lecture: Optional[int] = None,
+                page_from: Optional[int] = None, page_to: Optional[int] = None) -> Optional[dict]:
+    """
+    Фильтр по метаданным фрагментов в формате where Chroma
+    :param file: Имя файла конспекта
+    :param lecture: Номер лекции
+    :param page_from: Первая страница
+    :param page_to: Последняя страница
+    :return: Фильтр или None, если условий нет
+    """
+    conditions = []
+    if file:
+        conditions.append({"source_file": file})
+    if lecture is not None:
+        conditions.append({"lecture": lecture})
+    if page_from is not None:
+        conditions.append({"page_number": {"$gte": page_from}})
+    if page_to is not None:
+        conditions.append({"page_number": {"$lte": page_to}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def params_from_message(message: ChatMessage) -> RetrievalParams:
+    """Параметры поиска из сообщения. Незаданные параметры берутся из настроек сервера"""
+    values = {name: getattr(message, name) for name in ("k", "fetch_k", "mmr", "lambda_mult", "score_threshold")
+              if getattr(message, name) is not None}
+    return RetrievalParams(where=build_where(message.file, message.lecture, message.page_from, message.page_to),
+                           **values)
+
+
+def question_filter(question: str) -> Optional[dict]:
+    """
+    Фильтр по метаданным фрагментов для вопроса, в котором упомянута лекция.
+    Номера лекций в каждом конспекте свои, поэтому подходят фрагменты этой лекции из всех файлов
+    :return: Фильтр в формате where Chroma или None
+    """
+    match = QUESTION_LECTURE_PATTERN.search(question)
+    return {"lecture": int(match.group(1))} if match else None
+
+
+def cosine_similarities(query: Sequence[float], vectors: np.ndarray) -> np.ndarray:
+    """Косинусная близость вектора вопроса к каждому вектору"""
+    query = np.asarray(query, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, len(query))
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    return vectors @ query / np.maximum(norms, 1e-12)
+
+
+def maximal_marginal_relevance(query: Sequence[float], vectors: np.ndarray, k: int,
+                               lambda_mult: float) -> List[int]:
+    """
+    Отбор фрагментов через maximal marginal relevance: каждый следующий фрагмент близок к вопросу,
+    но не похож на уже выбранные
+    :param query: Вектор вопроса
+    :param vectors: Векторы кандидатов
+    :param k: Сколько фрагментов выбрать
+    :param lambda_mult: Баланс: 1 - только близость к вопросу, 0 - только разнообразие
+    :return: Номера выбранных кандидатов в порядке выбора
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not len(vectors):
+        return []
+    relevance = cosine_similarities(query, vectors)
+    normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = normalized @ normalized.T
+
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(vectors)):
+        redundancy = similarity[:, selected].max(axis=1)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
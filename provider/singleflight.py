@@ -0,0 +1,118 @@
+"""
+Объединение одинаковых одновременных запросов (single flight).
+Первый запрос запускает генерацию в отдельной задаче, а все запросы с тем же ключом, пришедшие до её окончания,
+получают те же события с самого начала: найденные источники и токены ответа.
+"""
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+
+class Flight:
+    def __init__(self, on_abandon: Callable[["Flight"], None]):
+        """
+        Выполняющаяся генерация, события которой получают все подписчики
+        :param on_abandon: Вызывается, если все подписчики отключились до окончания генерации
+        """
+        self.events: List[Tuple[str, object]] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._on_abandon = on_abandon
+        self._updated = asyncio.Event()
+
+    def _notify(self) -> None:
+        # Будим всех ожидающих и готовим событие для следующего обновления
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def publish(self, event: str, data) -> None:
+        self.events.append((event, data))
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[Tuple[str, object]]:
+        """
+        Все события генерации: уже полученные и новые по мере появления.
+        Если генерация завершилась ошибкой, она выбрасывается каждому подписчику
+        """
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.events):
+                    event = self.events[position]
+                    position += 1
+                    yield event
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self._on_abandon(self)
+
+
+class SingleFlight:
+    def __init__(self):
+        """Выполняющиеся генерации по ключу"""
+        self.flights: Dict[str, Flight] = {}
+        # Сколько запросов получили ответ чужой генерации
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    def __contains__(self, key: str) -> bool:
+        """Выполняется ли генерация с этим ключом: новый запрос с ним присоединится к ней, а не запустит свою"""
+        return key in self.flights
+
+    async def _drive(self, key: str, flight: Flight, events: AsyncIterator[Tuple[str, object]]) -> None:
+        try:
+            async for event, data in events:
+                flight.publish(event, data)
+        except BaseException as e:
+            flight.finish(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            flight.finish()
+        finally:
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def _abandon(self, key: str, flight: Flight) -> None:
+        # Ответ больше никому не нужен. Новые запросы с этим ключом начнут новую генерацию
+        self._forget(key, flight)
+        flight.task.cancel()
+
+    def join(self, key: str, producer: Callable[[], AsyncIterator[Tuple[str, object]]]) -> Tuple[Flight, bool]:
+        """
+        Присоединяется к генерации по ключу или запускает её в отдельной задаче.
+        События нужно сразу читать через Flight.subscribe: когда все подписчики отключаются, генерация отменяется
+        :param key: Ключ запроса, например хэш нормализованного вопроса
+        :param producer: Функция, создающая асинхронный генератор событий
+        :return: Генерация и признак того, что она запущена этим вызовом
+        """
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return flight, False
+        flight = Flight(lambda abandoned: self._abandon(key, abandoned))
+        self.flights[key] = flight
+        flight.task = asyncio.create_task(self._drive(key, flight, producer()))
+        return flight, True
+
+    def stats(self) -> dict:
+        """Число выполняющихся генераций и объединённых запросов"""
+        return {"in_flight": len(self.flights), "coalesced": self.coalesced}
@@ -0,0 +1,220 @@
+"""
+Компактный векторный индекс для поиска без клиента Chroma (VECTOR_BACKEND=numpy).
+Строится в ingest.py рядом с индексом фрагментов и хранится в каталоге БД (vector_index/):
+- vectors.npy - матрица векторов фрагментов в float16 или int8, строка i - фрагмент i индекса фрагментов;
+- scales.npy - множитель каждой строки для int8 (вектор = строка * множитель);
+- norms.npy - квадраты норм исходных векторов в float32 для расстояния L2;
+- meta.json - тип значений, размерность и метрика коллекции Chroma.
+Тексты и метаданные берутся из индекса фрагментов (chunk_index/). Все массивы открываются через mmap,
+а поиск - одно матричное умножение по всем векторам и точный выбор k лучших через argpartition.
+Для небольшого корпуса это быстрее HNSW и не требует загрузки БД Chroma в память.
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from provider.bm25 import metadata_matches
+from provider.chunk_index import ChunkIndex
+
+VECTOR_INDEX_DIR = "vector_index"
+DTYPES = {"float16": np.float16, "int8": np.int8}
+# Сколько строк матрицы переводится в float32 за раз при поиске
+BLOCK_ROWS = 4096
+# Сколько масок фильтров по метаданным хранится в памяти
+MAX_CACHED_FILTERS = 256
+
+
+def collection_space(collection) -> str:
+    """Метрика коллекции Chroma: "l2" (по умолчанию), "cosine" или "ip\""""
+    space = (collection.metadata or {}).get("hnsw:space")
+    if space is None:
+        try:
+            space = collection.configuration["hnsw"]["space"]
+        except (AttributeError, KeyError, TypeError):
+            space = None
+    return space or "l2"
+
+
+def build_vector_index(index_dir: str, ids: Sequence[str], embeddings: Sequence[Sequence[float]],
+                       dtype: str = "float16", space: str = "l2") -> None:
+    """
+    Строит векторный индекс и атомарно заменяет им старый. Индекс фрагментов уже должен быть построен
+    :param index_dir: Каталог БД
+    :param ids: Идентификаторы фрагментов
+    :param embeddings: Векторы фрагментов
+    :param dtype: Тип значений матрицы: "float16" или "int8"
+    :param space: Метрика коллекции Chroma, по которой упорядочиваются результаты
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Неизвестный тип векторного индекса: {dtype}. Допустимые значения: {', '.join(DTYPES)}")
+    chunks = ChunkIndex.open(index_dir)
+    try:
+        numbers = {doc_id.decode(): number for number, doc_id in enumerate(chunks.records["id"])}
+    finally:
+        chunks.close()
+    if len(numbers) != len(ids):
+        raise ValueError(f"В индексе фрагментов {len(numbers)} фрагментов, а векторов {len(ids)}")
+
+    vectors = np.zeros((len(ids), len(embeddings[0]) if len(ids) else 0), dtype=np.float32)
+    for doc_id, embedding in zip(ids, embeddings):
+        vectors[numbers[doc_id]] = embedding
+
+    target = os.path.join(index_dir, VECTOR_INDEX_DIR)
+    tmp_dir = target + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    if dtype == "int8":
+        # Симметричное квантование каждой строки: наибольшее по модулю значение переходит в 127
+        scales = np.maximum(np.abs(vectors).max(axis=1, initial=0), 1e-12) / 127
+        np.save(os.path.join(tmp_dir, "vectors.npy"), np.round(vectors / scales[:, None]).astype(np.int8))
+        np.save(os.path.join(tmp_dir, "scales.npy"), scales.astype(np.float32))
+    else:
+        np.save(os.path.join(tmp_dir, "vectors.npy"), vectors.astype(np.float16))
+    np.save(os.path.join(tmp_dir, "norms.npy"), np.einsum("ij,ij->i", vectors, vectors))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"dtype": dtype, "dimension": vectors.shape[1], "space": space}, f)
+
+    # Каталог нельзя заменить одним os.replace, поэтому старый индекс сначала переименовывается
+    old_dir = target + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, old_dir)
+    os.replace(tmp_dir, target)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class VectorIndex:
+    def __init__(self, path: str, chunks: ChunkIndex):
+        """
+        Векторный индекс, открытый через mmap. Методы query и get повторяют Collection Chroma,
+        поэтому индекс заменяет коллекцию при поиске
+        :param path: Каталог индекса (vector_index в каталоге БД)
+        :param chunks: Индекс фрагментов того же каталога БД
+        """
+        self.path = path
+        self.chunks = chunks
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        scales_path = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None
+        self.norms = np.load(os.path.join(path, "norms.npy"), mmap_mode="r")
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dtype = meta["dtype"]
+        self.space = meta["space"]
+        if len(self.vectors) != len(chunks):
+            raise ValueError(f"В векторном индексе {len(self.vectors)} строк, а в индексе фрагментов {len(chunks)}")
+        self.numbers = {doc_id.decode(): number for number, doc_id in enumerate(chunks.records["id"])}
+        # Метаданные фрагментов разбираются при первом поиске с фильтром
+        self._metadatas: Optional[List[dict]] = None
+        self._masks: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def open(cls, index_dir: str) -> Optional["VectorIndex"]:
+        """Открывает индекс из каталога БД или возвращает None, если индекса нет"""
+        path = os.path.join(index_dir, VECTOR_INDEX_DIR)
+        chunks = ChunkIndex.open(index_dir)
+        if chunks is None or not os.path.exists(os.path.join(path, "vectors.npy")):
+            return None
+        return cls(path, chunks)
+
+    def close(self) -> None:
+        self.chunks.close()
+
+    def count(self) -> int:
+        return len(self.vectors)
+
+    def rows(self, numbers: np.ndarray) -> np.ndarray:
+        """Векторы фрагментов в float32"""
+        vectors = np.asarray(self.vectors[numbers], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= np.asarray(self.scales[numbers])[:, None]
+        return vectors
+
+    def dot(self, query: np.ndarray) -> np.ndarray:
+        """Скалярные произведения вектора вопроса со всеми векторами. Матрица переводится в float32 по частям"""
+        result = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+            result[start:start + BLOCK_ROWS] = block @ query
+        if self.scales is not None:
+            result *= self.scales
+        return result
+
+    def mask(self, where: Optional[dict]) -> Optional[np.ndarray]:
+        """Номера фрагментов, подходящих под фильтр в формате where Chroma. None - без фильтра"""
+        if not where:
+            return None
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        numbers = self._masks.get(key)
+        if numbers is None:
+            if self._metadatas is None:
+                self._metadatas = [self.chunks.chunk(number).metadata for number in range(len(self.chunks))]
+            numbers = np.flatnonzero([metadata_matches(metadata, where) for metadata in self._metadatas])
+            if len(self._masks) >= MAX_CACHED_FILTERS:
+                self._masks.clear()
+            self._masks[key] = numbers
+        return numbers
+
+    def search(self, query: Sequence[float], k: int, where: Optional[dict] = None):
+        """
+        Точный поиск k ближайших фрагментов
+        :param query: Вектор вопроса
+        :param k: Количество фрагментов
+        :param where: Фильтр по метаданным в формате where Chroma
+        :return: Номера фрагментов от ближайшего и расстояния в метрике коллекции
+        """
+        query = np.asarray(query, dtype=np.float32)
+        dots = self.dot(query)
+        if self.space == "l2":
+            # |q - v|^2 = |q|^2 + |v|^2 - 2 q·v
+            distances = float(query @ query) + self.norms - 2 * dots
+        elif self.space == "cosine":
+            distances = 1 - dots / np.maximum(np.sqrt(self.norms) * np.linalg.norm(query), 1e-12)
+        else:
+            distances = 1 - dots
+
+        candidates = self.mask(where)
+        if candidates is not None:
+            distances = distances[candidates]
+        k = min(k, len(distances))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        top = top[np.argsort(distances[top], kind="stable")]
+        numbers = candidates[top] if candidates is not None else top
+        return numbers, distances[top]
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 10,
+              where: Optional[dict] = None, include: Sequence[str] = ("documents", "metadatas", "distances")) -> dict:
+        """Поиск для нескольких векторов вопросов. Результат в формате Collection.query Chroma"""
+        result = {"ids": [], "documents": [], "metadatas": [], "embeddings": [], "distances": []}
+        for query in query_embeddings:
+            numbers, distances = self.search(query, n_results, where)
+            chunks = [self.chunks.chunk(int(number)) for number in numbers]
+            result["ids"].append([chunk.id for chunk in chunks])
+            result["documents"].append([chunk.text for chunk in chunks])
+            result["metadatas"].append([chunk.metadata for chunk in chunks])
+            result["embeddings"].append(self.rows(numbers))
+            result["distances"].append(distances.tolist())
+        return {key: value for key, value in result.items() if key == "ids" or key in include}
+
+    def get(self, ids: Optional[Sequence[str]] = None, limit: Optional[int] = None,
+            include: Sequence[str] = ("documents", "metadatas")) -> dict:
+        """Фрагменты по идентификаторам. Результат в формате Collection.get Chroma"""
+        if ids is None:
+            numbers = np.arange(len(self.chunks) if limit is None else min(limit, len(self.chunks)))
+        else:
+            numbers = np.asarray([self.numbers[doc_id] for doc_id in ids if doc_id in self.numbers], dtype=np.int64)
+        chunks = [self.chunks.chunk(int(number)) for number in numbers]
+        result = {"ids": [chunk.id for chunk in chunks]}
+        if "documents" in include:
+            result["documents"] = [chunk.text for chunk in chunks]
+        if "metadatas" in include:
+            result["metadatas"] = [chunk.metadata for chunk in chunks]
+        if "embeddings" in include:
+            result["embeddings"] = self.rows(numbers)
+        return result
@@ -0,0 +1,81 @@
+"""
+Пул серверов Ollama: запрос к серверу, который принял соединение и завис, должен завершиться по таймауту
+и повториться на работающем сервере. Оба сервера - заглушки bench/fake_ollama.py в потоках этого процесса
+"""
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from provider.pool import OllamaPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+from fake_ollama import FakeOllamaConfig, create_server  # noqa: E402
+
+READ_TIMEOUT = 0.5
+HANG = 10
+
+
+@pytest.fixture
+def backends():
+    servers = [create_server("127.0.0.1", 0, FakeOllamaConfig(dim=8, embed_latency=0, token_latency=0,
+                                                             answer_tokens=3, hang=hang))
+               for hang in (HANG, 0)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def check_failover(pool: OllamaPool, failed_over: list) -> None:
+    hung, healthy = pool.backends
+    assert not hung.healthy and hung.failures == 1
+    assert healthy.healthy and healthy.failures == 0
+    assert failed_over == [hung]
+
+
+async def concurrently(function, count: int = 2) -> list:
+    # Одновременные запросы получают разные серверы (с наименьшим числом выполняющихся запросов),
+    # поэтому один из них гарантированно попадает на зависший сервер
+    return await asyncio.wait_for(asyncio.gather(*(function() for _ in range(count))), HANG / 2)
+
+
+def test_hung_backend_embeddings_fail_over(backends):
+    pool = OllamaPool(backends, read_timeout=READ_TIMEOUT)
+    failed_over = []
+    pool.on_failover = failed_over.append
+
+    responses = asyncio.run(concurrently(lambda: pool.call(lambda client: client.embed(model="m", input=["текст"]))))
+    assert all(len(response.embeddings) == 1 for response in responses)
+    check_failover(pool, failed_over)
+
+
+def test_hung_backend_generation_fails_over(backends):
+    pool = OllamaPool(backends, read_timeout=READ_TIMEOUT)
+    failed_over = []
+    pool.on_failover = failed_over.append
+
+    async def generate() -> str:
+        return "".join([part.response async for part in pool.generate(model="m", prompt="вопрос")])
+
+    answers = asyncio.run(concurrently(generate))
+    assert all(answers)
+    check_failover(pool, failed_over)
+
+
+def test_hung_backend_sync_call_fails_over(backends):
+    pool = OllamaPool(backends, read_timeout=READ_TIMEOUT)
+    failed_over = []
+    pool.on_failover = failed_over.append
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(pool.call_sync, lambda client: client.embed(model="m", input=["текст"]))
+                   for _ in range(2)]
+        responses = [future.result(timeout=HANG / 2) for future in futures]
+    assert all(len(response.embeddings) == 1 for response in responses)
+    check_failover(pool, failed_over)
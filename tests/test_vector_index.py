@@ -0,0 +1,93 @@
+"""
+Полнота поиска по компактному векторному индексу (float16 и int8) относительно точного перебора в float32
+и относительно поиска Chroma по тем же векторам. Векторы синтетические и детерминированные, поэтому тест
+не требует Ollama, а коллекция Chroma создаётся во временном каталоге
+"""
+import numpy as np
+import pytest
+
+from provider.chunk_index import build_chunk_index
+from provider.vector_index import VectorIndex, build_vector_index, collection_space
+
+COUNT = 2000
+DIMENSION = 64
+QUERIES = 200
+K = 10
+MIN_RECALL = {"float16": 0.99, "int8": 0.95}
+
+
+def synthetic_corpus(seed: int = 0):
+    """Нормированные векторы, сгруппированные вокруг центров, как эмбеддинги фрагментов на близкие темы"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((40, DIMENSION)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), COUNT)] + 0.3 * rng.standard_normal((COUNT, DIMENSION))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    queries = vectors[rng.integers(0, COUNT, QUERIES)] + 0.05 * rng.standard_normal((QUERIES, DIMENSION))
+    return vectors, queries.astype(np.float32)
+
+
+def exact_top_k(vectors: np.ndarray, query: np.ndarray, k: int) -> set:
+    return set(np.argsort(((vectors - query) ** 2).sum(axis=1), kind="stable")[:k].tolist())
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_recall_against_exact_search(tmp_path, dtype):
+    vectors, queries = synthetic_corpus()
+    ids = [f"chunk-{i}" for i in range(COUNT)]
+    metadatas = [{"source": "docs/konspekt.pdf", "page": i // 10, "lecture": i % 5} for i in range(COUNT)]
+    build_chunk_index(str(tmp_path), ids, [f"Текст фрагмента {i}" for i in range(COUNT)], metadatas)
+    build_vector_index(str(tmp_path), ids, vectors, dtype, "l2")
+
+    index = VectorIndex.open(str(tmp_path))
+    try:
+        # Номера фрагментов в индексе упорядочены по файлу и странице, поэтому сравниваются идентификаторы
+        recalls = []
+        for query in queries:
+            found = set(index.query([query], n_results=K)["ids"][0])
+            expected = {ids[number] for number in exact_top_k(vectors, query, K)}
+            recalls.append(len(found & expected) / K)
+        assert np.mean(recalls) >= MIN_RECALL[dtype]
+
+        lecture = [number for number in range(COUNT) if metadatas[number]["lecture"] == 2]
+        result = index.query([queries[0]], n_results=K, where={"lecture": 2}, include=["metadatas", "distances"])
+        assert all(metadata["lecture"] == 2 for metadata in result["metadatas"][0])
+        expected = {ids[lecture[number]] for number in exact_top_k(vectors[lecture], queries[0], K)}
+        assert len(set(result["ids"][0]) & expected) / K >= MIN_RECALL[dtype]
+        assert result["distances"][0] == sorted(result["distances"][0])
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_recall_against_chroma(tmp_path, dtype):
+    chromadb = pytest.importorskip("chromadb")
+    from langchain_chroma import Chroma
+
+    vectors, queries = synthetic_corpus()
+    ids = [f"chunk-{i}" for i in range(COUNT)]
+    texts = [f"Текст фрагмента {i}" for i in range(COUNT)]
+    metadatas = [{"source": "docs/konspekt.pdf", "page": i // 10, "lecture": i % 5} for i in range(COUNT)]
+
+    # Коллекция Chroma с теми же векторами, как её заполняет ingest.py
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    db = Chroma(client=client, collection_name="langchain")
+    batch_size = client.get_max_batch_size()
+    for start in range(0, COUNT, batch_size):
+        end = start + batch_size
+        db._collection.upsert(ids=ids[start:end], embeddings=vectors[start:end].tolist(),
+                              documents=texts[start:end], metadatas=metadatas[start:end])
+
+    index_dir = str(tmp_path / "index")
+    build_chunk_index(index_dir, ids, texts, metadatas)
+    build_vector_index(index_dir, ids, vectors, dtype, collection_space(db._collection))
+    index = VectorIndex.open(index_dir)
+    try:
+        recalls = []
+        for query in queries:
+            found = set(index.query([query], n_results=K)["ids"][0])
+            expected = {document.id for document in db.similarity_search_by_vector(query.tolist(), k=K)}
+            recalls.append(len(found & expected) / K)
+        assert np.mean(recalls) >= MIN_RECALL[dtype]
+    finally:
+        index.close()
+        client.close()